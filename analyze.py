@@ -14,6 +14,8 @@
 # the License.
 
 import argparse
+import concurrent.futures
+import hashlib
 import logging
 import os
 import textwrap
@@ -24,14 +26,19 @@ import shutil
 import sys
 import tempfile
 
-from typing import Iterable, Set, Any, Optional, Tuple
+from itertools import repeat
+from typing import Callable, Dict, Iterable, Set, Any, List, Optional, Tuple
 from datetime import datetime
 from io import StringIO
 
+import numpy as np
 import pandas as pd
 import pytz
 import altair as alt  # type: ignore
 
+import entitymatrix
+import eventstore
+
 
 """
 makes use of code and methods from my other projects at
@@ -389,28 +396,68 @@ def _get_snapshot_time_from_path(p, basename_suffix):
     return t
 
 
-def _get_snapshot_dfs(csvpaths, basename_suffix):
+# Below this many files, starting worker processes costs more than it saves.
+PARSE_PROCESS_POOL_MIN_FILES = 50
 
-    snapshot_dfs = []
-    column_names_seen = set()
+# Appending to the snapshot cache beyond this many chunks rewrites it as one.
+SNAPSHOT_CACHE_MAX_CHUNKS = 64
 
-    log.info(f"about to deserialize {len(csvpaths)} snapshot CSV files")
 
-    for p in csvpaths:
-        log.debug("attempt to parse %s", p)
-        snapshot_time = _get_snapshot_time_from_path(p, basename_suffix)
-        df = pd.read_csv(p)
+def _parse_csv_files(
+    parse: Callable[[str, str], Optional[pd.DataFrame]],
+    csvpaths: List[str],
+    basename_suffix: str,
+) -> List[Optional[pd.DataFrame]]:
+    """
+    Return `parse(p, basename_suffix)` for each path in `csvpaths`, in the same
+    order. With many files, run `parse` in a pool of worker processes
+    (--parse-processes). `parse` must be a module-level function.
+    """
+    nproc = ARGS.parse_processes or os.cpu_count() or 1
+    if nproc == 1 or len(csvpaths) < PARSE_PROCESS_POOL_MIN_FILES:
+        return [parse(p, basename_suffix) for p in csvpaths]
+
+    log.info("parse %s CSV files with %s processes", len(csvpaths), nproc)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nproc) as pool:
+        # `map()` yields results in input order. Fewer, larger chunks: less
+        # inter-process communication overhead.
+        return list(
+            pool.map(
+                parse,
+                csvpaths,
+                repeat(basename_suffix),
+                chunksize=max(1, len(csvpaths) // (4 * nproc)),
+            )
+        )
 
-        # mutate column names in-place.
-        top_x_snapshots_rename_columns(df)
 
-        # attach snapshot time as meta data prop to df
-        df.attrs["snapshot_time"] = snapshot_time
+def _parse_snapshot_csv(p, basename_suffix):
+    log.debug("attempt to parse %s", p)
+    snapshot_time = _get_snapshot_time_from_path(p, basename_suffix)
+    df = pd.read_csv(p)
 
-        # Add new column to each dataframe: `time`, with the same value for
-        # every row: the snapshot time.
-        df["time"] = snapshot_time
+    # mutate column names in-place.
+    top_x_snapshots_rename_columns(df)
 
+    # attach snapshot time as meta data prop to df (survives pickling, i.e.
+    # the transfer from a worker process).
+    df.attrs["snapshot_time"] = snapshot_time
+
+    # Add new column to each dataframe: `time`, with the same value for
+    # every row: the snapshot time.
+    df["time"] = snapshot_time
+    return df
+
+
+def _get_snapshot_dfs(csvpaths, basename_suffix):
+
+    snapshot_dfs = []
+    column_names_seen = set()
+
+    log.info(f"about to deserialize {len(csvpaths)} snapshot CSV files")
+
+    parsed = _parse_csv_files(_parse_snapshot_csv, csvpaths, basename_suffix)
+    for p, df in zip(csvpaths, parsed):
         if column_names_seen and set(df.columns) != column_names_seen:
             log.error("columns seen so far: %s", column_names_seen)
             log.error("columns in %s: %s", p, df.columns)
@@ -423,57 +470,389 @@ def _get_snapshot_dfs(csvpaths, basename_suffix):
     return snapshot_dfs
 
 
+def _transform_entity_name(ename, entity_type, cmn_ename_prefix):
+    if entity_type != "path":
+        return ename
+    entity_name_transformed = ename[len(cmn_ename_prefix) :]
+    # The root path (e.g., `owner/repo`) is now an empty string. That's
+    # not so cool, make the root be represented by a single slash.
+    if entity_name_transformed == "":
+        entity_name_transformed = "/"
+    return entity_name_transformed
+
+
+def _get_entity_matrix(dfa, entity_type, changed_times):
+    """
+    For --snapshot-cache-dir: return the persisted daily time x entity matrix
+    of views_unique (`entitymatrix.EntityMatrix`), after adding the snapshots
+    in `dfa` it does not contain yet. Rebuild it if it contains snapshots not
+    in `dfa`, or snapshots in `changed_times` (unix times of snapshot files
+    that changed or disappeared; `None`: unknown, anything may have changed).
+    """
+    path = os.path.join(ARGS.snapshot_cache_dir, f"top_{entity_type}s_matrix")
+    # Snapshot time per row, unix time (seconds).
+    times = dfa["time"].values.astype("datetime64[s]").astype(np.int64)
+
+    matrix = entitymatrix.EntityMatrix(path)
+    if matrix.snapshot_times and (
+        changed_times is None
+        or changed_times & matrix.snapshot_times
+        or not matrix.snapshot_times <= set(np.unique(times).tolist())
+    ):
+        log.info("entity matrix %s: snapshots changed or removed, rebuild", path)
+        matrix.clear()
+
+    new = ~np.isin(times, list(matrix.snapshot_times))
+    log.info("entity matrix %s: add %s of %s rows", path, new.sum(), len(dfa))
+    if new.any():
+        matrix.update(
+            times[new],
+            dfa[entity_type].values[new],
+            dfa["views_unique"].values[new].astype(float),
+        )
+    return matrix
+
+
 def _build_entity_dfs(dfa, entity_type, unique_entity_names):
 
     cmn_ename_prefix = os.path.commonprefix(list(unique_entity_names))
     log.info("_build_entity_dfs. cmn_ename_prefix: %s", cmn_ename_prefix)
     log.info("dfa:\n%s", dfa)
 
-    entity_dfs = {}
-    for ename in unique_entity_names:
-        # Do a subselection
-        edf = dfa[dfa[entity_type] == ename]
-        # Now use datetime column as index
-        newindex = edf["time"]
-        edf = edf.drop(columns=["time"])
+    # Make it so that there is at most one data point per day, in case
+    # individual snapshots were taken with higher frequency: group the rows
+    # by entity and by 24-hour bin, take max() for each group. The bins start
+    # at midnight (UTC), like those of `resample("24h")`. One pass over `dfa`
+    # for all entities (entity names as integer codes), instead of one
+    # subselection and resample per entity.
+    # Names that are the same after transformation (e.g. paths `/o/r` and
+    # `/o/r/`) are one entity: group by the transformed name, i.e. merge the
+    # rows of colliding names (max() per day). Before, the dataframe of one
+    # of them overwrote the other (which one depended on set iteration order).
+    transformed = {
+        ename: _transform_entity_name(ename, entity_type, cmn_ename_prefix)
+        for ename in unique_entity_names
+    }
+    codes, uniques = pd.factorize(dfa[entity_type].map(transformed))
+    days = pd.DatetimeIndex(dfa["time"].dt.floor("D"), name="time")
+    dfg = dfa.drop(columns=["time"]).groupby([codes, days]).max()
+    log.info("%s entities, %s entity-days", len(uniques), len(dfg))
+
+    # `dfg` is sorted by code, then by day: the rows of entity `code` are
+    # `starts[code]:ends[code]`.
+    gcodes = dfg.index.get_level_values(0).values
+    gdays = dfg.index.get_level_values(1)
+    starts = np.searchsorted(gcodes, np.arange(len(uniques)), side="left")
+    ends = np.searchsorted(gcodes, np.arange(len(uniques)), side="right")
+
+    # `resample()` also creates a bin for each day without snapshot. Its NaN
+    # values make the metric columns floaty (for the entity at hand). Do the
+    # same, so that the result is exactly the same: for all entities with a
+    # gap, take their rows from a float copy of `dfg`.
+    has_rows = ends > starts
+    has_gap = np.zeros(len(uniques), dtype=bool)
+    span_days = (gdays[ends[has_rows] - 1] - gdays[starts[has_rows]]).days + 1
+    has_gap[has_rows] = span_days > (ends - starts)[has_rows]
+
+    # Remove bins with missing data (what `dropna()` per entity did), and map
+    # the row ranges to the remaining rows.
+    keep = dfg.notna().all(axis=1).values
+    kept_before = np.concatenate(([0], np.cumsum(keep)))
+    dfk = dfg.droplevel(0)[keep]
+    dff = dfk
+    if has_gap.any():
+        dff = dfk.astype(
+            {c: float for c in dfk.columns if pd.api.types.is_integer_dtype(dfk[c])}
+        )
+    edfs_by_code = {
+        code: (dff if gap else dfk).iloc[kept_before[a] : kept_before[b]]
+        for code, (gap, a, b) in enumerate(zip(has_gap, starts, ends))
+    }
 
-        edf.index = newindex
-        edf = edf.sort_index()
+    code_by_ename = {ename: code for code, ename in enumerate(uniques)}
+    empty = dfg.iloc[:0].droplevel(0)
 
-        # Do entity name processing
+    entity_dfs = {}
+    for ename in unique_entity_names:
+        # Build up `entity_dfs` using the transformed ename.
         log.debug("ename before transformation: %s", ename)
-        if entity_type == "path":
-            entity_name_transformed = ename[len(cmn_ename_prefix) :]
-            # The root path (e.g., `owner/repo`) is now an empty string. That's
-            # not so cool, make the root be represented by a single slash.
-            if entity_name_transformed == "":
-                entity_name_transformed = "/"
-            edf.rename(columns={ename: entity_name_transformed}, inplace=True)
-            # Also change `ename` from here on, so that `entity_dfs` is built
-            # up using the transformed ename.
-            ename = entity_name_transformed
-
-        # Make it so that there is at most one data point per day, in case
-        # individual snapshots were taken with higher frequency.
-        n_hour_bins = 24
-        log.debug("len(edf): %s", len(edf))
-        log.debug("downsample entity DF into %s-hour bins", n_hour_bins)
-        # Resample the DF into N-hour bins. Take max() for each group. Do
-        # `dropna()` on the resampler to remove all up-sampled data points (in
-        # case snapshots were taken at much lower frequency). Default behavior
-        # of the resampling operation is to note the value for each bin at the
-        # left edge of the bin, and to have the bin be closed on the left edge
-        # (right edge of the bin belongs to next bin).
-        edf = edf.resample(f"{n_hour_bins}h").max().dropna()
-        # log.debug("len(edf): %s", len(edf))
-
-        # print(edf)
+        ename = transformed[ename]
+        if ename in entity_dfs:
+            continue
+
+        edf = edfs_by_code.get(code_by_ename.get(ename), empty)
         entity_dfs[ename] = edf
         log.info(f"created dataframe for {entity_type}: {ename} -- len: {len(edf)}")
 
     return entity_dfs
 
 
+def _get_unchanged_snapshot_dfs(snapshot_dfs, basename_suffix, markerpaths):
+    # fetch.py with --dedup-state-path writes a zero-byte marker file instead
+    # of a snapshot with the same content as the previous one. Expand each
+    # marker into a copy of the most recent snapshot before the marker time.
+    # `snapshot_dfs` may hold rows of many snapshots per dataframe (e.g. the
+    # compacted aggregate): select by the `time` column.
+    marker_suffix = basename_suffix + ".unchanged"
+    if not markerpaths:
+        return []
+    dfall = pd.concat(snapshot_dfs) if snapshot_dfs else pd.DataFrame({"time": []})
+
+    unchanged_dfs = []
+    for p in markerpaths:
+        t = _get_snapshot_time_from_path(p, marker_suffix)
+        previous = dfall["time"][dfall["time"] < t]
+        if not len(previous):
+            log.warning("no snapshot before %s, ignore marker file %s", t, p)
+            continue
+        df = dfall[dfall["time"] == previous.max()].copy()
+        df.attrs["snapshot_time"] = t
+        df["time"] = t
+        unchanged_dfs.append(df)
+
+    return unchanged_dfs
+
+
+def _file_sha256(p):
+    h = hashlib.sha256()
+    with open(p, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _unix_times(isotimes):
+    return [int(pd.Timestamp(t).timestamp()) for t in isotimes]
+
+
+def _read_snapshot_cache(chunks_dir, manifest_path):
+    # Return manifest and rows (or `None`) of the snapshot cache. Start over if
+    # it is incomplete, e.g. after an interruption while updating it.
+    empty: dict = {"files": {}, "chunks": [], "next_chunk": 0}
+    if not os.path.exists(manifest_path):
+        return empty, None
+
+    with open(manifest_path, "rb") as f:
+        manifest = json.loads(f.read().decode("utf-8"))
+    if "chunks" not in manifest:
+        log.info("snapshot cache %s: old format, rebuild", chunks_dir)
+        return empty, None
+    try:
+        dfs = [
+            pd.read_pickle(os.path.join(chunks_dir, name))
+            for name, _ in manifest["chunks"]
+        ]
+    except Exception as e:
+        log.warning("snapshot cache %s: cannot read (%s), rebuild", chunks_dir, e)
+        return empty, None
+    if [len(df) for df in dfs] != [n for _, n in manifest["chunks"]]:
+        log.warning("snapshot cache %s: inconsistent, rebuild", chunks_dir)
+        return empty, None
+    if not dfs:
+        return manifest, None
+    return manifest, pd.concat(dfs, ignore_index=True)
+
+
+def _write_snapshot_cache(chunks_dir, manifest_path, manifest, dfs, dfn, drop_times):
+    # Append the new rows `dfn` as a chunk. With rows dropped, or with too
+    # many chunks: write all rows (`dfs`) as one chunk instead. The chunk
+    # first, then the manifest referring to it.
+    os.makedirs(chunks_dir, exist_ok=True)
+    chunks = manifest["chunks"]
+    n_new = len(dfn) if dfn is not None else 0
+    if drop_times or len(chunks) >= SNAPSHOT_CACHE_MAX_CHUNKS:
+        chunks.clear()
+        dfn = pd.concat(dfs, ignore_index=True) if dfs else None
+        log.info("snapshot cache: rewrite as one chunk")
+
+    if dfn is not None and len(dfn):
+        name = f"{manifest['next_chunk']:06d}.pkl"
+        manifest["next_chunk"] += 1
+        # Pragmatic strategy against partial write / encoding problems.
+        path = os.path.join(chunks_dir, name)
+        dfn.to_pickle(path + ".tmp")
+        os.rename(path + ".tmp", path)
+        chunks.append([name, len(dfn)])
+
+    with open(manifest_path + ".tmp", "wb") as f:
+        f.write(json.dumps(manifest, indent=2).encode("utf-8"))
+    os.rename(manifest_path + ".tmp", manifest_path)
+    log.info(
+        "snapshot cache: add %s rows (%s in total, %s chunks)",
+        n_new,
+        sum(n for _, n in chunks),
+        len(chunks),
+    )
+
+    # Chunks not referred to (anymore), e.g. after a rewrite.
+    referenced = {n for n, _ in chunks}
+    for name in os.listdir(chunks_dir):
+        if name not in referenced:
+            os.unlink(os.path.join(chunks_dir, name))
+
+
+def _get_snapshot_dfs_incremental(
+    csvpaths, markerpaths, basename_suffix, reference_dfs
+):
+    """
+    Same result as `_get_snapshot_dfs()` plus `_get_unchanged_snapshot_dfs()`
+    (but as a single dataframe, in a list), for --snapshot-cache-dir: parse
+    only snapshot (and marker) files not seen by a previous run. Markers may
+    also refer to snapshots in `reference_dfs`.
+
+    The cache directory holds, per snapshot kind, the rows of all snapshots
+    ingested so far and a manifest: size, mtime, SHA-256 and snapshot time
+    per file. A file counts as known if size and mtime match (or else the
+    hash). The rows of files that changed or disappeared are dropped;
+    changed files are parsed again.
+
+    The rows are stored in chunks (pickled dataframes), listed in the
+    manifest. The rows of new files are appended as a new chunk. Dropping
+    rows, or too many chunks, rewrites all rows as a single chunk.
+
+    Also return the snapshot times (unix time, seconds) of the files that
+    changed or disappeared, or `None` if the cache was (re)built from scratch
+    (anything may have changed).
+    """
+    marker_suffix = basename_suffix + ".unchanged"
+    kind = basename_suffix.strip("_").split(".")[0]
+    chunks_dir = os.path.join(ARGS.snapshot_cache_dir, f"{kind}.chunks")
+    manifest_path = os.path.join(ARGS.snapshot_cache_dir, f"{kind}.manifest.json")
+
+    manifest, dfc = _read_snapshot_cache(chunks_dir, manifest_path)
+    rebuild = not manifest["files"]
+
+    known = manifest["files"]
+    paths = {os.path.basename(p): p for p in csvpaths + markerpaths}
+
+    new, drop_times = [], []
+    manifest_changed = False
+    for name in sorted(set(known) - set(paths)):
+        log.info("snapshot cache: %s disappeared, drop its rows", name)
+        drop_times.append(known.pop(name)["snapshot_time"])
+
+    for name, p in sorted(paths.items()):
+        st = os.stat(p)
+        entry = known.get(name)
+        if entry is not None:
+            if entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+                continue
+            if entry["sha256"] == _file_sha256(p):
+                entry.update(size=st.st_size, mtime_ns=st.st_mtime_ns)
+                manifest_changed = True
+                continue
+            log.info("snapshot cache: %s changed, parse again", name)
+            drop_times.append(entry["snapshot_time"])
+        new.append(p)
+
+    if dfc is not None and drop_times:
+        dfc = dfc[~dfc["time"].isin(pd.to_datetime(drop_times, utc=True))]
+
+    log.info(
+        "snapshot cache: %s files known, %s new or changed",
+        len(paths) - len(new),
+        len(new),
+    )
+
+    snapshot_dfs = _get_snapshot_dfs(
+        [p for p in new if p.endswith(basename_suffix)], basename_suffix
+    )
+    if dfc is not None and snapshot_dfs:
+        if set(dfc.columns) != set(snapshot_dfs[0].columns):
+            log.error("columns in snapshot cache: %s", dfc.columns)
+            log.error("columns in %s: %s", new[0], snapshot_dfs[0].columns)
+            log.error("inconsistent set of column names across CSV files")
+            sys.exit(1)
+
+    # A marker refers to the most recent snapshot before it, which is likely
+    # a known one.
+    snapshot_dfs += _get_unchanged_snapshot_dfs(
+        ([dfc] if dfc is not None else []) + snapshot_dfs + reference_dfs,
+        basename_suffix,
+        [p for p in new if p.endswith(marker_suffix)],
+    )
+
+    for p in new:
+        st = os.stat(p)
+        suffix = marker_suffix if p.endswith(marker_suffix) else basename_suffix
+        known[os.path.basename(p)] = {
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "sha256": _file_sha256(p),
+            "snapshot_time": _get_snapshot_time_from_path(p, suffix).isoformat(),
+        }
+
+    dfn = pd.concat(snapshot_dfs, ignore_index=True) if snapshot_dfs else None
+    dfs = [df for df in (dfc, dfn) if df is not None]
+    changed_times = None if rebuild else set(_unix_times(drop_times))
+
+    if new or drop_times or manifest_changed:
+        _write_snapshot_cache(chunks_dir, manifest_path, manifest, dfs, dfn, drop_times)
+    else:
+        log.info("snapshot cache: unchanged")
+
+    if not dfs:
+        return [], changed_times
+    dfa = pd.concat(dfs, ignore_index=True).sort_values("time", kind="stable")
+    return [dfa], changed_times
+
+
+def _read_top_x_aggregate(entity_type):
+    # Return the compacted snapshots as list of zero or one dataframe, in the
+    # shape of the dataframes returned by `_get_snapshot_dfs()`.
+    if not ARGS.top_x_aggregate_inpath:
+        return []
+
+    path = ARGS.top_x_aggregate_inpath.format(entity=entity_type)
+    if not os.path.exists(path):
+        log.info("previous aggregate file does not exist: %s", path)
+        return []
+
+    log.info("read previous aggregate: %s", path)
+    df = pd.read_parquet(path)
+    # Entity names: categorical in the file, plain strings in memory (like
+    # when read from the individual snapshot CSV files).
+    df["entity"] = df["entity"].astype(str)
+    df = df.rename(columns={"entity": entity_type, "snapshot_time": "time"})
+    log.info("%s rows in previous aggregate", len(df))
+    return [df]
+
+
+def _write_top_x_aggregate(dfa, entity_type, paths_read):
+    """
+    Write the rows of all top referrer/path snapshots to a single Parquet file
+    (long format: snapshot_time, entity, views_total, views_unique; entity
+    names dictionary-encoded). Delete the snapshot files the rows were read
+    from (--delete-top-x-snapshots).
+    """
+    path = ARGS.top_x_aggregate_outpath.format(entity=entity_type)
+    if os.path.exists(path) and not ARGS.top_x_aggregate_inpath:
+        log.error(
+            "would overwrite output aggregate w/o reading input aggregate -- you know what you're doing?"
+        )
+        sys.exit(1)
+
+    df = dfa.rename(columns={entity_type: "entity", "time": "snapshot_time"})
+    df = df.sort_values("snapshot_time", kind="stable").reset_index(drop=True)
+    df["entity"] = df["entity"].astype("category")
+
+    log.info("write aggregate (%s rows) to %s", len(df), path)
+    # Pragmatic strategy against partial write / encoding problems.
+    tpath = path + ".tmp"
+    df.to_parquet(tpath, index=False)
+    os.rename(tpath, path)
+
+    if ARGS.delete_top_x_snapshots:
+        # Iterate through precisely the set of files that was read above.
+        # If unlinkling fails at OS boundary then don't crash this program.
+        for p in paths_read:
+            log.info("delete %s as of --delete-top-x-snapshots", p)
+            try:
+                os.unlink(p)
+            except Exception as e:
+                log.warning("could not unlink %s: %s", p, str(e))
+
+
 def _glob_csvpaths(basename_suffix):
     basename_pattern = f"*{basename_suffix}"
     csvpaths = glob.glob(os.path.join(ARGS.snapshotdir, basename_pattern))
@@ -491,7 +870,21 @@ def analyse_top_x_snapshots(entity_type, date_axis_lim):
     log.info("read 'top %s' snapshots (CSV docs)", entity_type)
     basename_suffix = f"_top_{entity_type}s_snapshot.csv"
     csvpaths = _glob_csvpaths(basename_suffix)
-    snapshot_dfs = _get_snapshot_dfs(csvpaths, basename_suffix)
+    markerpaths = _glob_csvpaths(basename_suffix + ".unchanged")
+
+    # Snapshots compacted by a previous run (--top-x-aggregate-outpath).
+    prev_agg_dfs = _read_top_x_aggregate(entity_type)
+
+    if ARGS.snapshot_cache_dir:
+        snapshot_dfs, changed_times = _get_snapshot_dfs_incremental(
+            csvpaths, markerpaths, basename_suffix, prev_agg_dfs
+        )
+    else:
+        snapshot_dfs = _get_snapshot_dfs(csvpaths, basename_suffix)
+        snapshot_dfs += _get_unchanged_snapshot_dfs(
+            snapshot_dfs + prev_agg_dfs, basename_suffix, markerpaths
+        )
+    snapshot_dfs += prev_agg_dfs
 
     # for df in snapshot_dfs:
     #     print(df)
@@ -519,13 +912,45 @@ def analyse_top_x_snapshots(entity_type, date_axis_lim):
     # First, create a dataframe containing all information.
     dfa = pd.concat(snapshot_dfs)
 
+    if prev_agg_dfs:
+        # A snapshot may be in the aggregate and still on disk, e.g. after a
+        # failed deletion.
+        dfa = dfa.drop_duplicates(subset=["time", entity_type])
+
+    if ARGS.top_x_aggregate_outpath:
+        _write_top_x_aggregate(dfa, entity_type, csvpaths + markerpaths)
+
     if len(dfa) == 0:
         log.info("leave early: no data for entity of type %s", entity_type)
         return
 
-    # Build a dict: key is path/referrer name, and value is DF with
-    # corresponding raw time series.
-    entity_dfs = _build_entity_dfs(dfa, entity_type, unique_entity_names)
+    if ARGS.snapshot_cache_dir:
+        # Read the per-referrer/path time series from the persisted time x
+        # entity matrix instead of building them from `dfa`.
+        matrix = _get_entity_matrix(dfa, entity_type, changed_times)
+        cmn_ename_prefix = os.path.commonprefix(list(unique_entity_names))
+        # Transformed name -> entity indices. Names that are the same after
+        # transformation are one entity (as in `_build_entity_dfs()`).
+        matrix_enames: Dict[str, List[int]] = {}
+        for i, e in enumerate(matrix.entities):
+            t = _transform_entity_name(e, entity_type, cmn_ename_prefix)
+            matrix_enames.setdefault(t, []).append(i)
+    else:
+        # Build a dict: key is path/referrer name, and value is DF with
+        # corresponding raw time series.
+        entity_dfs = _build_entity_dfs(dfa, entity_type, unique_entity_names)
+
+    def _get_views_unique_series(ename):
+        if not ARGS.snapshot_cache_dir:
+            return entity_dfs[ename]["views_unique"]
+        series = [matrix.series(matrix.entities[i]) for i in matrix_enames[ename]]
+        # Same name: max per day.
+        s = series[0] if len(series) == 1 else pd.concat(series, axis=1).max(axis=1)
+        # Same dtype as the views_unique column built by `_build_entity_dfs()`:
+        # integer unless there are days without data in between.
+        if len(s) and (s.index[-1] - s.index[0]).days + 1 == len(s):
+            s = s.astype(np.int64)
+        return s
 
     # It's important to clarify what each data point in a per-referrer raw time
     # series means. Each data point has been returned by the GitHub traffic
@@ -545,23 +970,30 @@ def analyse_top_x_snapshots(entity_type, date_axis_lim):
     # One interesting way to look at the data: find the top 5 referrers based
     # on unique views, and for the entire time range seen.
 
-    max_vu_map = {}
-    for ename, edf in entity_dfs.items():
-        # TODO: do not pick max() value across time series for top-n
-        # consideration. That represents a peak, a single point in time which
-        # could be long ago. It's more meaningful to integerate over time,
-        # considering the entire time frame. That however might put a little
-        # too much weight on the past, too -- so maybe perform two
-        # integrations: entire time frame, and last three weeks. Build top N
-        # for both of these, and then merge.
-        max_vu_map[ename] = edf["views_unique"].max()
-    del ename, edf
+    # TODO: do not pick max() value across time series for top-n
+    # consideration. That represents a peak, a single point in time which
+    # could be long ago. It's more meaningful to integerate over time,
+    # considering the entire time frame. That however might put a little
+    # too much weight on the past, too -- so maybe perform two
+    # integrations: entire time frame, and last three weeks. Build top N
+    # for both of these, and then merge.
+    if ARGS.snapshot_cache_dir:
+        colmax = matrix.column_max()
+        max_vu_map = {
+            ename: np.fmax.reduce(colmax[indices])
+            for ename, indices in matrix_enames.items()
+        }
+    else:
+        max_vu_map = {}
+        for ename, edf in entity_dfs.items():
+            max_vu_map[ename] = edf["views_unique"].max()
+        del ename, edf
 
     # Sort dict so that the first item is the referrer/path with the highest
-    # views_unique seen.
-    sorted_dict = {
-        k: v for k, v in sorted(max_vu_map.items(), key=lambda i: i[1], reverse=True)
-    }
+    # views_unique seen. Same views_unique: sort by name (the order of
+    # `max_vu_map` depends on set iteration order).
+    by_name = sorted(max_vu_map.items())
+    sorted_dict = {k: v for k, v in sorted(by_name, key=lambda i: i[1], reverse=True)}
 
     log.info(f"{entity_type}, highest views_unique seen: {sorted_dict}")
 
@@ -582,7 +1014,7 @@ def analyse_top_x_snapshots(entity_type, date_axis_lim):
     # series (ename is for example 'linkedin.com' if this is a top_referrers
     # analysis).
     individual_series = [
-        pd.Series(entity_dfs[ename]["views_unique"], name=ename)
+        pd.Series(_get_views_unique_series(ename), name=ename)
         for ename in top_n_enames
     ]
 
@@ -768,6 +1200,56 @@ def analyse_top_x_snapshots(entity_type, date_axis_lim):
     )
 
 
+def _parse_views_clones_fragment(p, basename_suffix):
+    log.info("attempt to parse %s", p)
+    snapshot_time = _get_snapshot_time_from_path(p, basename_suffix)
+
+    df = pd.read_csv(
+        p,
+        index_col=["time_iso8601"],
+        date_parser=lambda col: pd.to_datetime(col, utc=True),
+    )
+
+    # Skip logic for empty data frames. The CSV files written should never
+    # be empty, but if such a bad file made it into the file system then
+    # skipping here facilitates debugging and enhanced robustness.
+    if len(df) == 0:
+        log.warning("empty dataframe parsed from %s, skip", p)
+        return None
+
+    # A time series fragment might look like this:
+    #
+    # df_views_clones:
+    #                            clones_total  ...  views_unique
+    # time_iso8601                             ...
+    # 2020-12-21 00:00:00+00:00           NaN  ...             2
+    # 2020-12-22 00:00:00+00:00           2.0  ...            23
+    # 2020-12-23 00:00:00+00:00           2.0  ...            20
+    # ...
+    # 2021-01-03 00:00:00+00:00           8.0  ...            21
+    # 2021-01-04 00:00:00+00:00           7.0  ...            18
+    #
+    # Note the NaN and the floaty type.
+
+    # All metrics are known to be integers by definition here. NaN values
+    # are expected to be present anywhere in this dataframe, and they
+    # semantically mean "0". Therefore, replace those with zeros. Also see
+    # https://github.com/jgehrcke/github-repo-stats/issues/4
+    df = df.fillna(0)
+    # Make sure numbers are treated as integers from here on. This actually
+    # matters in a cosmetic way only for outputting the aggregate CSV later
+    # #       # not for plotting and number crunching).
+    df = df.astype(int)
+
+    # attach snapshot time as meta data prop to df
+    df.attrs["snapshot_time"] = snapshot_time
+
+    # The index is not of string type anymore, but of type
+    # `pd.DatetimeIndex`. Reflect that in the name.
+    df.index.rename("time", inplace=True)
+    return df
+
+
 def analyse_view_clones_ts_fragments() -> pd.DataFrame:
 
     log.info("read views/clones time series fragments (CSV docs)")
@@ -778,54 +1260,12 @@ def analyse_view_clones_ts_fragments() -> pd.DataFrame:
     snapshot_dfs: list[pd.DataFrame] = []
     column_names_seen: Set[str] = set()
 
-    for p in csvpaths:
-        log.info("attempt to parse %s", p)
-        snapshot_time = _get_snapshot_time_from_path(p, basename_suffix)
-
-        df = pd.read_csv(
-            p,
-            index_col=["time_iso8601"],
-            date_parser=lambda col: pd.to_datetime(col, utc=True),
-        )
-
-        # Skip logic for empty data frames. The CSV files written should never
-        # be empty, but if such a bad file made it into the file system then
-        # skipping here facilitates debugging and enhanced robustness.
-        if len(df) == 0:
-            log.warning("empty dataframe parsed from %s, skip", p)
+    parsed = _parse_csv_files(_parse_views_clones_fragment, csvpaths, basename_suffix)
+    for p, df in zip(csvpaths, parsed):
+        if df is None:
             continue
 
-        # A time series fragment might look like this:
-        #
-        # df_views_clones:
-        #                            clones_total  ...  views_unique
-        # time_iso8601                             ...
-        # 2020-12-21 00:00:00+00:00           NaN  ...             2
-        # 2020-12-22 00:00:00+00:00           2.0  ...            23
-        # 2020-12-23 00:00:00+00:00           2.0  ...            20
-        # ...
-        # 2021-01-03 00:00:00+00:00           8.0  ...            21
-        # 2021-01-04 00:00:00+00:00           7.0  ...            18
-        #
-        # Note the NaN and the floaty type.
-
-        # All metrics are known to be integers by definition here. NaN values
-        # are expected to be present anywhere in this dataframe, and they
-        # semantically mean "0". Therefore, replace those with zeros. Also see
-        # https://github.com/jgehrcke/github-repo-stats/issues/4
-        df = df.fillna(0)
-        # Make sure numbers are treated as integers from here on. This actually
-        # matters in a cosmetic way only for outputting the aggregate CSV later
-        # #       # not for plotting and number crunching).
-        df = df.astype(int)
-
-        # attach snapshot time as meta data prop to df
-        df.attrs["snapshot_time"] = snapshot_time
-
-        # The index is not of string type anymore, but of type
-        # `pd.DatetimeIndex`. Reflect that in the name.
-        df.index.rename("time", inplace=True)
-
+        snapshot_time = df.attrs["snapshot_time"]
         if column_names_seen and set(df.columns) != column_names_seen:
             log.error("columns seen so far: %s", column_names_seen)
             log.error("columns in %s: %s", p, df.columns)
@@ -1390,14 +1830,20 @@ def read_stars_over_time_from_csv() -> pd.DataFrame:
         log.info("stargazer_ts_inpath not provided, return emtpy df")
         return pd.DataFrame()
 
-    log.info("Parse stargazer time series (raw) CSV: %s", ARGS.stargazer_ts_inpath)
-    df = pd.read_csv(
-        ARGS.stargazer_ts_inpath,
-        index_col=["time_iso8601"],
-        date_parser=lambda col: pd.to_datetime(col, utc=True),
-    )
-    # df = df.astype(int)
-    df.index.rename("time", inplace=True)
+    if eventstore.is_store_path(ARGS.stargazer_ts_inpath):
+        log.info(
+            "Read stargazer time series (raw) event store: %s", ARGS.stargazer_ts_inpath
+        )
+        df = eventstore.read_dataframe(ARGS.stargazer_ts_inpath, "stars_cumulative")
+    else:
+        log.info("Parse stargazer time series (raw) CSV: %s", ARGS.stargazer_ts_inpath)
+        df = pd.read_csv(
+            ARGS.stargazer_ts_inpath,
+            index_col=["time_iso8601"],
+            date_parser=lambda col: pd.to_datetime(col, utc=True),
+        )
+        # df = df.astype(int)
+        df.index.rename("time", inplace=True)
     log.info("stars_cumulative, raw data: %s", df["stars_cumulative"])
 
     if not len(df):
@@ -1429,14 +1875,18 @@ def read_forks_over_time_from_csv() -> pd.DataFrame:
         log.info("fork_ts_inpath not provided, return emtpy df")
         return pd.DataFrame()
 
-    log.info("Parse fork time series (raw) CSV: %s", ARGS.fork_ts_inpath)
-    df = pd.read_csv(
-        ARGS.fork_ts_inpath,
-        index_col=["time_iso8601"],
-        date_parser=lambda col: pd.to_datetime(col, utc=True),
-    )
-    # df = df.astype(int)
-    df.index.rename("time", inplace=True)
+    if eventstore.is_store_path(ARGS.fork_ts_inpath):
+        log.info("Read fork time series (raw) event store: %s", ARGS.fork_ts_inpath)
+        df = eventstore.read_dataframe(ARGS.fork_ts_inpath, "forks_cumulative")
+    else:
+        log.info("Parse fork time series (raw) CSV: %s", ARGS.fork_ts_inpath)
+        df = pd.read_csv(
+            ARGS.fork_ts_inpath,
+            index_col=["time_iso8601"],
+            date_parser=lambda col: pd.to_datetime(col, utc=True),
+        )
+        # df = df.astype(int)
+        df.index.rename("time", inplace=True)
     log.info("forks_cumulative, raw data: %s", df["forks_cumulative"])
 
     if not len(df):
@@ -1575,7 +2025,8 @@ def parse_args():
         "--stargazer-ts-inpath",
         default="",
         metavar="PATH",
-        help="Read raw stargazer time series from CSV file. File must exist, may be empty.",
+        help="Read raw stargazer time series from CSV file (or from event store "
+        "file, if PATH ends with .events). File must exist, may be empty.",
     )
 
     parser.add_argument(
@@ -1590,7 +2041,8 @@ def parse_args():
         "--fork-ts-inpath",
         default="",
         metavar="PATH",
-        help="Read raw fork time series from CSV file. File must exist, may be empty.",
+        help="Read raw fork time series from CSV file (or from event store "
+        "file, if PATH ends with .events). File must exist, may be empty.",
     )
 
     parser.add_argument(
@@ -1607,6 +2059,50 @@ def parse_args():
         help="Read aggregate CSV file in addition to regular time series snapshots discovery",
     )
 
+    parser.add_argument(
+        "--top-x-aggregate-outpath",
+        default="",
+        metavar="PATH",
+        help="Write all top referrers/paths snapshots to a single Parquet file. "
+        "PATH must contain {entity} (replaced by referrer or path). Example: "
+        "top_{entity}s_aggregate.parquet",
+    )
+
+    parser.add_argument(
+        "--top-x-aggregate-inpath",
+        default="",
+        metavar="PATH",
+        help="Read top referrers/paths aggregate files in addition to snapshot "
+        "discovery. PATH must contain {entity}.",
+    )
+
+    parser.add_argument(
+        "--delete-top-x-snapshots",
+        default=False,
+        action="store_true",
+        help="Delete individual top referrers/paths snapshot files after having "
+        "written aggregate file",
+    )
+
+    parser.add_argument(
+        "--parse-processes",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Parse snapshot CSV files in N worker processes. Default: 0 (one "
+        "per CPU core). 1: parse in the main process.",
+    )
+
+    parser.add_argument(
+        "--snapshot-cache-dir",
+        default="",
+        metavar="PATH",
+        help="Keep the parsed top referrers/paths snapshots in this directory, "
+        "plus a manifest of the snapshot files ingested, plus a daily time x "
+        "entity matrix of unique views. Subsequent runs parse only new snapshot "
+        "files, and add only new snapshots to the matrix.",
+    )
+
     parser.add_argument(
         "--delete-ts-fragments",
         default=False,
@@ -1625,6 +2121,15 @@ def parse_args():
                 "--delete-ts-fragments must only be set with --views-clones-aggregate-outpath"
             )
 
+    for path in (args.top_x_aggregate_outpath, args.top_x_aggregate_inpath):
+        if path and "{entity}" not in path:
+            sys.exit(f"missing {{entity}} in aggregate path: {path}")
+
+    if args.delete_top_x_snapshots and not args.top_x_aggregate_outpath:
+        sys.exit(
+            "--delete-top-x-snapshots must only be set with --top-x-aggregate-outpath"
+        )
+
     if os.path.exists(args.output_directory):
         if not os.path.isdir(args.output_directory):
             log.error(
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# Copyright 2018 - 2020 Dr. Jan-Philip Gehrcke
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+Daily time x entity matrix of one top referrers/paths metric, persisted in a
+directory. Used by analyze.py (with --snapshot-cache-dir) for views_unique.
+Each cell holds the maximum across the snapshots taken on that day (UTC),
+like the per-entity time series built by analyze.py.
+
+Directory layout:
+
+    meta.json       layout generation G, first day (unix time / 86400),
+                    number of days, entity names (entity index: position in
+                    list), entity indices of the dense columns, record count
+                    per tail run, unix times of the snapshots included
+    dense.G.f8      float64, days x hot entities, row-major. NaN: no data
+    tail.G.bin      long tail entities in coordinate format (TAIL_DTYPE):
+                    entity index, day index, value. A sequence of runs, each
+                    sorted by entity, then day
+    colmax.G.f8     float64, max value per entity
+
+Entities with data on at least HOT_MIN_DAY_FRACTION of all days are hot.
+The others (usually the vast majority of paths) form the long tail. The
+files are memory-mapped when reading. meta.json is written last: data
+beyond what it refers to (e.g. after an interruption) is ignored, files of
+another generation are removed.
+
+`update()` appends: a row per new day to dense.f8, one run with the cells of
+the long tail entities to tail.bin. Cells of known days are updated in place
+with an element-wise max (which can be repeated without harm). Entities seen
+for the first time join the long tail. The layout (first day, hot entities)
+is rebuilt from all cells (as a new generation) only if a snapshot precedes
+the first day, or if the tail has MAX_TAIL_RUNS runs.
+"""
+
+import json
+import logging
+import os
+from typing import Dict, List, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+log = logging.getLogger()
+
+HOT_MIN_DAY_FRACTION = 0.1
+MAX_TAIL_RUNS = 64
+SECONDS_PER_DAY = 86400
+TAIL_DTYPE = np.dtype([("entity", "<i4"), ("day", "<i4"), ("value", "<f8")])
+
+
+def _map(path: str, dtype, shape) -> np.ndarray:
+    # `memmap()` cannot map zero bytes.
+    if not int(np.prod(shape)):
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+
+def _write(path: str, data: bytes) -> None:
+    # Pragmatic strategy against partial write / encoding problems.
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.rename(path + ".tmp", path)
+
+
+def _append(path: str, size: int, data: bytes) -> None:
+    # Cut off what is beyond `size` (not referred to by meta.json), append.
+    with open(path, "ab"):
+        pass
+    with open(path, "r+b") as f:
+        f.truncate(size)
+        f.seek(size)
+        f.write(data)
+
+
+def _cells(
+    e: np.ndarray, d: np.ndarray, v: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # One cell per entity and day: the max. Sorted by entity, then day.
+    if not len(e):
+        return e, d, v
+    order = np.lexsort((d, e))
+    e, d, v = e[order], d[order], v[order]
+    new_cell = (e[1:] != e[:-1]) | (d[1:] != d[:-1])
+    starts = np.flatnonzero(np.r_[True, new_cell])
+    return e[starts], d[starts], np.maximum.reduceat(v, starts)
+
+
+class EntityMatrix:
+    def __init__(self, path: str) -> None:
+        """
+        Open the matrix persisted in directory `path` (empty if there is
+        none yet).
+        """
+        self.path = path
+        self.generation = 0
+        self.clear()
+        if os.path.exists(os.path.join(path, "meta.json")):
+            with open(os.path.join(path, "meta.json"), "rb") as f:
+                meta = json.loads(f.read().decode("utf-8"))
+            self.generation = meta["generation"]
+            self.first_day = meta["first_day"]
+            self.ndays = meta["ndays"]
+            self.entities = meta["entities"]
+            self.hot = meta["hot"]
+            self.tail_runs = meta["tail_runs"]
+            self.snapshot_times = set(meta["snapshot_times"])
+            self._index = {e: i for i, e in enumerate(self.entities)}
+            self._col = {i: c for c, i in enumerate(self.hot)}
+            self._map()
+            log.info(
+                "entity matrix %s: %s days, %s entities (%s hot), %s snapshots",
+                path,
+                self.ndays,
+                len(self.entities),
+                len(self.hot),
+                len(self.snapshot_times),
+            )
+
+    def clear(self) -> None:
+        """
+        Forget all data (in memory). The next `update()` rewrites all files.
+        """
+        self.first_day = 0
+        self.ndays = 0
+        self.entities: List[str] = []
+        # Entity index per dense column.
+        self.hot: List[int] = []
+        # Record count per tail run.
+        self.tail_runs: List[int] = []
+        self.snapshot_times: Set[int] = set()
+        # Entity index per name, dense column per entity index.
+        self._index: Dict[str, int] = {}
+        self._col: Dict[int, int] = {}
+        self.dense = np.empty((0, 0))
+        self.tail = np.empty(0, dtype=TAIL_DTYPE)
+        self.colmax = np.empty(0)
+
+    def _file(self, name: str) -> str:
+        # E.g. `dense.f8` -> `dense.3.f8`.
+        base, ext = name.split(".")
+        return os.path.join(self.path, f"{base}.{self.generation}.{ext}")
+
+    def _map(self) -> None:
+        self.dense = _map(self._file("dense.f8"), "<f8", (self.ndays, len(self.hot)))
+        self.tail = _map(self._file("tail.bin"), TAIL_DTYPE, (sum(self.tail_runs),))
+        self.colmax = _map(self._file("colmax.f8"), "<f8", (len(self.entities),))
+
+    def _write_meta(self) -> None:
+        meta = {
+            "generation": self.generation,
+            "first_day": self.first_day,
+            "ndays": self.ndays,
+            "entities": self.entities,
+            "hot": self.hot,
+            "tail_runs": self.tail_runs,
+            "snapshot_times": sorted(self.snapshot_times),
+        }
+        # Last: refers to the data written before.
+        _write(os.path.join(self.path, "meta.json"), json.dumps(meta).encode("utf-8"))
+
+        current = {self._file(n) for n in ("dense.f8", "tail.bin", "colmax.f8")}
+        for name in os.listdir(self.path):
+            p = os.path.join(self.path, name)
+            if name.startswith(("dense.", "tail.", "colmax.")) and p not in current:
+                os.unlink(p)
+
+    def _coordinates(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # All cells with data: entity index, day (absolute), value. Tail runs
+        # may hold more than one cell per entity and day.
+        days, cols = np.nonzero(~np.isnan(self.dense))
+        hot = np.asarray(self.hot, dtype=np.int64)
+        return (
+            np.concatenate([hot[cols], self.tail["entity"]]),
+            np.concatenate([days, self.tail["day"]]) + self.first_day,
+            np.concatenate([self.dense[days, cols], self.tail["value"]]),
+        )
+
+    def update(
+        self, times: np.ndarray, entities: np.ndarray, values: np.ndarray
+    ) -> None:
+        """
+        Add snapshot rows: snapshot time (unix time, seconds), entity name,
+        value (NaN: no data). Write the changes to the directory.
+        """
+        n_known = len(self.entities)
+        ent = np.fromiter(
+            (self._index.setdefault(e, len(self._index)) for e in entities),
+            dtype=np.int64,
+            count=len(entities),
+        )
+        self.entities.extend(list(self._index)[n_known:])
+        self.snapshot_times.update(np.unique(times).tolist())
+
+        valid = ~np.isnan(values)
+        e, d, v = _cells(ent[valid], times[valid] // SECONDS_PER_DAY, values[valid])
+
+        colmax = np.full(len(self.entities), np.nan)
+        colmax[:n_known] = self.colmax
+        np.fmax.at(colmax, e, v)
+
+        os.makedirs(self.path, exist_ok=True)
+        if (
+            not self.ndays
+            or (len(d) and d.min() < self.first_day)
+            or len(self.tail_runs) >= MAX_TAIL_RUNS
+        ):
+            e0, d0, v0 = self._coordinates()
+            self._relayout(*_cells(np.r_[e0, e], np.r_[d0, d], np.r_[v0, v]))
+        else:
+            self._append(e, d - self.first_day, v)
+
+        _write(self._file("colmax.f8"), colmax.astype("<f8").tobytes())
+        self._write_meta()
+        self._map()
+
+    def _relayout(self, e: np.ndarray, d: np.ndarray, v: np.ndarray) -> None:
+        # Decide about first day and hot entities, write dense and tail files
+        # from scratch. `e`, `d`, `v`: one cell per entity and (absolute) day.
+        self.first_day = int(d.min()) if len(d) else 0
+        self.ndays = int(d.max()) - self.first_day + 1 if len(d) else 0
+        d = d - self.first_day
+        self.generation += 1
+        log.info("entity matrix %s: relayout, %s days", self.path, self.ndays)
+
+        days_with_data = np.bincount(e, minlength=len(self.entities))
+        is_hot = days_with_data >= max(1, HOT_MIN_DAY_FRACTION * self.ndays)
+        self.hot = np.flatnonzero(is_hot).tolist()
+        self._col = {i: c for c, i in enumerate(self.hot)}
+        col = np.full(len(self.entities), -1)
+        col[self.hot] = np.arange(len(self.hot))
+
+        hot = is_hot[e]
+        dense = np.full((self.ndays, len(self.hot)), np.nan)
+        dense[d[hot], col[e[hot]]] = v[hot]
+        # Still sorted by entity, then day: a single run.
+        tail = np.empty(np.count_nonzero(~hot), dtype=TAIL_DTYPE)
+        tail["entity"] = e[~hot]
+        tail["day"] = d[~hot]
+        tail["value"] = v[~hot]
+        self.tail_runs = [len(tail)] if len(tail) else []
+
+        _write(self._file("dense.f8"), dense.astype("<f8").tobytes())
+        _write(self._file("tail.bin"), tail.tobytes())
+
+    def _append(self, e: np.ndarray, d: np.ndarray, v: np.ndarray) -> None:
+        # `e`, `d`, `v`: one cell per entity and day (relative to the first
+        # day, none before it), sorted by entity, then day.
+        ncols = len(self.hot)
+        col = np.fromiter((self._col.get(i, -1) for i in e), np.int64, len(e))
+        hot = col >= 0
+
+        ndays = max(self.ndays, int(d.max()) + 1) if len(d) else self.ndays
+        dense_path = self._file("dense.f8")
+        _append(
+            dense_path,
+            self.ndays * ncols * 8,
+            np.full((ndays - self.ndays, ncols), np.nan, dtype="<f8").tobytes(),
+        )
+        self.ndays = ndays
+        if hot.any():
+            dense = np.memmap(dense_path, "<f8", mode="r+", shape=(ndays, ncols))
+            rows, cols = d[hot], col[hot]
+            dense[rows, cols] = np.fmax(dense[rows, cols], v[hot])
+            dense.flush()
+            del dense
+
+        tail = np.empty(np.count_nonzero(~hot), dtype=TAIL_DTYPE)
+        tail["entity"] = e[~hot]
+        tail["day"] = d[~hot]
+        tail["value"] = v[~hot]
+        if len(tail):
+            _append(
+                self._file("tail.bin"),
+                sum(self.tail_runs) * TAIL_DTYPE.itemsize,
+                tail.tobytes(),
+            )
+            self.tail_runs.append(len(tail))
+
+    def column_max(self) -> np.ndarray:
+        """
+        Return the max value per entity (in entity index order).
+        """
+        return np.array(self.colmax)
+
+    def series(self, entity: str) -> pd.Series:
+        """
+        Return the days with data for `entity`: values, DatetimeIndex `time`
+        (UTC midnight).
+        """
+        i = self._index[entity]
+        if i in self._col:
+            values = np.asarray(self.dense[:, self._col[i]])
+            days = np.flatnonzero(~np.isnan(values))
+            values = values[days]
+        else:
+            # Binary search in each run.
+            parts = []
+            offset = 0
+            for n in self.tail_runs:
+                run = self.tail[offset : offset + n]
+                lo, hi = np.searchsorted(run["entity"], [i, i + 1])
+                parts.append(np.asarray(run[lo:hi]))
+                offset += n
+            cells = np.concatenate(parts) if parts else self.tail[:0]
+            days, values = _cells(cells["entity"], cells["day"], cells["value"])[1:]
+
+        epochs = (self.first_day + days.astype(np.int64)) * SECONDS_PER_DAY
+        index = pd.DatetimeIndex(
+            pd.to_datetime(epochs, unit="s", utc=True), name="time"
+        )
+        return pd.Series(values, index=index, name=entity)
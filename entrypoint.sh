@@ -119,6 +119,72 @@ git config --local user.email "action@github.com"
 git config --local user.name "GitHub Action"
 set +x
 
+# Push the commits to the remote branch (unless GHRS_TESTING is set).
+push_data_branch() {
+    if [ -z ${GHRS_TESTING+x} ]; then
+        echo "GHRS_TESTING is unset"
+    else
+        echo "GHRS_TESTING is set. do not push"
+        return 0
+    fi
+
+    # Now, push the changes to the remote branch. Note that there might have been
+    # other jobs running, pushing to the same branch in the meantime. In that case,
+    # the push fails with "updates were rejected because the remote contains work
+    # that you do not have locally." -- assume that changes are actually isolated
+    # (not in conflict, but happening in distinct directories) and therefore assume
+    # that a rather simple pull/push loop will after all help synchronize the
+    # concurrent racers here. Also see issue #9 and #11.
+
+    # Abort waiting upon this deadline.
+    MAX_WAIT_SECONDS=500
+    DEADLINE=$(($(date +%s) + ${MAX_WAIT_SECONDS}))
+
+    while true
+    do
+
+        if (( $(date +%s) > ${DEADLINE} )); then
+            echo "pull/push loop: deadline hit: waited for ${MAX_WAIT_SECONDS} s"
+            exit 1
+        fi
+
+        # Do a pull right before the push. They should be looked at as an 'atomic
+        # unit', doing them right after one another in repeated fashion is the
+        # recipe for long-term convergence here. The first push is quite likely to
+        # succeed though: it is very unlikely that another racer pushes between the
+        # pull/push below.
+
+        # The pull may however also fail. In that case, stay in the loop. Two
+        # expected pull failure modes that we thought about so far:
+        #
+        # - transient issues -- in thase case it's good to retry
+        # - when further above the data branch was freshly created in the local
+        #   checkout then this pull fails with "There is no tracking information
+        #   for the current branch." -- in that case the subsequent push will
+        #   succeed, and create the remote branch.
+
+        set -x
+        git pull origin "${DATA_BRANCH_NAME}" || echo "pull failed, ignore (continue)"
+
+        set +e
+        git push --set-upstream origin "${DATA_BRANCH_NAME}"
+        PUSH_ECODE=$?
+        set -e
+        set +x
+
+        if [ $PUSH_ECODE -ne 0 ]; then
+            echo "warn: git push returned with code ${PUSH_ECODE}, retry soon"
+        else
+            echo "pull/push loop: push succeeded, leave loop"
+            break
+        fi
+
+        echo "pull/push loop:sleep for 10 s"
+        sleep 10
+    done
+}
+
+
 # Do not write to the root of the repository, but to a directory named after
 # the stats respository (owner/repo). So that this data repository can be used
 # by GHRS for more than one stats repository using the same git branch.
@@ -138,14 +204,20 @@ echo "fetch.py for ${STATS_REPOSPEC}"
 export PYTHONUNBUFFERED="on"
 
 set +e
-# Note that the *-raw.csv files contain each star/fork event. These files do
-# for now not need to be in the repository (but it will make sense to store
-# them there once addressing the 10k star problem).
+# Note that the *-raw.events files contain each star/fork event (binary, see
+# eventstore.py). They are stored in the data repository (together with the
+# *-raw.state.json sync state files) so that the next run can update them
+# incrementally instead of fetching all stargazers again. Likewise,
+# snapshots-dedup.state.json allows for skipping traffic snapshots which did
+# not change since the previous run.
 set -x
 python "${GHRS_FILES_ROOT_PATH}/fetch.py" "${STATS_REPOSPEC}" \
     --snapshot-directory=newsnapshots \
-    --fork-ts-outpath=forks-raw.csv \
-    --stargazer-ts-outpath=stars-raw.csv
+    --fork-ts-outpath=forks-raw.events \
+    --stargazer-ts-outpath=stars-raw.events \
+    --incremental \
+    --full-sync-every=30 \
+    --dedup-state-path=snapshots-dedup.state.json
 FETCH_ECODE=$?
 set +x
 set -e
@@ -155,7 +227,17 @@ if [ $FETCH_ECODE -ne 0 ]; then
     # viewer, give CPython's stderr emitted above a little time to be captured
     # and forwarded by the GH Action log viewer.
     sleep 0.1
-    echo "error: fetch.py returned with code ${FETCH_ECODE} -- exit."
+    echo "error: fetch.py returned with code ${FETCH_ECODE}"
+    # A full stargazer/fork sync that did not complete leaves a journal of
+    # the pages fetched so far (*.journal). Push it, so that the next run
+    # resumes from there.
+    set -x
+    git add --all -- '*.journal' || echo "git add failed, ignore (continue)"
+    if git commit -m "ghrs: journal ${UPDATE_ID} for ${STATS_REPOSPEC}"; then
+        push_data_branch
+    fi
+    set +x
+    echo "exit."
     exit $FETCH_ECODE
 fi
 
@@ -172,6 +254,7 @@ git status --untracked=no --porcelain
 
 # exit code 0 when nothing added
 git add ghrs-data/snapshots
+git add snapshots-dedup.state.json || echo "git add failed, ignore (continue)"
 
 # exit code 1 upon 'nothing to commit, working tree clean'
 git commit -m "ghrs: snap ${UPDATE_ID} for ${STATS_REPOSPEC}" || echo "commit failed, ignore (continue)"
@@ -187,13 +270,16 @@ python "${GHRS_FILES_ROOT_PATH}/analyze.py" \
     --resources-directory "${GHRS_FILES_ROOT_PATH}/resources" \
     --output-directory latest-report \
     --outfile-prefix "" \
-    --stargazer-ts-inpath "stars-raw.csv" \
-    --fork-ts-inpath "forks-raw.csv" \
+    --stargazer-ts-inpath "stars-raw.events" \
+    --fork-ts-inpath "forks-raw.events" \
     --stargazer-ts-resampled-outpath "ghrs-data/stargazers.csv" \
     --fork-ts-resampled-outpath "ghrs-data/forks.csv" \
     --views-clones-aggregate-outpath "ghrs-data/views_clones_aggregate.csv" \
     --views-clones-aggregate-inpath "ghrs-data/views_clones_aggregate.csv" \
     --delete-ts-fragments \
+    --top-x-aggregate-outpath "ghrs-data/top_{entity}s_aggregate.parquet" \
+    --top-x-aggregate-inpath "ghrs-data/top_{entity}s_aggregate.parquet" \
+    --delete-top-x-snapshots \
     "${STATS_REPOSPEC}" ghrs-data/snapshots
 ANALYZE_ECODE=$?
 set +x
@@ -205,8 +291,10 @@ if [ $ANALYZE_ECODE -ne 0 ]; then
 fi
 
 set -x
-# Commit the changed view/clone aggregate, and the deletion of snapshot files
+# Commit the changed view/clone and top referrers/paths aggregates, and the
+# deletion of snapshot files
 git add ghrs-data/views_clones_aggregate.csv
+git add ghrs-data/top_referrers_aggregate.parquet ghrs-data/top_paths_aggregate.parquet || echo "git add failed, ignore (continue)"
 git add ghrs-data/snapshots
 
 # exit code 1 upon 'nothing to commit, working tree clean'
@@ -216,6 +304,10 @@ git commit -m "ghrs: vc agg ${UPDATE_ID} for ${STATS_REPOSPEC}" || echo "commit
 # Note that either of ghrs-data/forks.csv or ghrs-data/stargazers.csv may
 # be missing
 git add ghrs-data/forks.csv ghrs-data/stargazers.csv || echo "git add failed, ignore (continue)"
+git add stars-raw.events stars-raw.state.json || echo "git add failed, ignore (continue)"
+git add forks-raw.events forks-raw.state.json || echo "git add failed, ignore (continue)"
+# Journals of a previously interrupted full sync: removed upon completion.
+git add --all -- '*.journal' || echo "git add failed, ignore (continue)"
 git commit -m "ghrs: stars and forks ${UPDATE_ID} for ${STATS_REPOSPEC}" || echo "commit failed, ignore  (continue)"
 
 echo "Translate HTML report into PDF, via headless Chrome"
@@ -255,67 +347,7 @@ git add README.md
 git commit -m "ghrs: report ${UPDATE_ID} for ${STATS_REPOSPEC}"
 set +x
 
-if [ -z ${GHRS_TESTING+x} ]; then
-    echo "GHRS_TESTING is unset"
-else
-    echo "GHRS_TESTING is set. terminate before push/pull loop"
-    exit 0
-fi
-
-# Now, push the changes to the remote branch. Note that there might have been
-# other jobs running, pushing to the same branch in the meantime. In that case,
-# the push fails with "updates were rejected because the remote contains work
-# that you do not have locally." -- assume that changes are actually isolated
-# (not in conflict, but happening in distinct directories) and therefore assume
-# that a rather simple pull/push loop will after all help synchronize the
-# concurrent racers here. Also see issue #9 and #11.
-
-# Abort waiting upon this deadline.
-MAX_WAIT_SECONDS=500
-DEADLINE=$(($(date +%s) + ${MAX_WAIT_SECONDS}))
-
-while true
-do
-
-    if (( $(date +%s) > ${DEADLINE} )); then
-        echo "pull/push loop: deadline hit: waited for ${MAX_WAIT_SECONDS} s"
-        exit 1
-    fi
-
-    # Do a pull right before the push. They should be looked at as an 'atomic
-    # unit', doing them right after one another in repeated fashion is the
-    # recipe for long-term convergence here. The first push is quite likely to
-    # succeed though: it is very unlikely that another racer pushes between the
-    # pull/push below.
-
-    # The pull may however also fail. In that case, stay in the loop. Two
-    # expected pull failure modes that we thought about so far:
-    #
-    # - transient issues -- in thase case it's good to retry
-    # - when further above the data branch was freshly created in the local
-    #   checkout then this pull fails with "There is no tracking information
-    #   for the current branch." -- in that case the subsequent push will
-    #   succeed, and create the remote branch.
-
-    set -x
-    git pull origin "${DATA_BRANCH_NAME}" || echo "pull failed, ignore (continue)"
-
-    set +e
-    git push --set-upstream origin "${DATA_BRANCH_NAME}"
-    PUSH_ECODE=$?
-    set -e
-    set +x
-
-    if [ $PUSH_ECODE -ne 0 ]; then
-        echo "warn: git push returned with code ${PUSH_ECODE}, retry soon"
-    else
-        echo "pull/push loop: push succeeded, leave loop"
-        break
-    fi
-
-    echo "pull/push loop:sleep for 10 s"
-    sleep 10
-done
+push_data_branch
 
 echo "finished"
 exit 0
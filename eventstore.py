@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# Copyright 2018 - 2020 Dr. Jan-Philip Gehrcke
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+Append-only binary store for the star/fork event time series: sorted unix
+timestamps (seconds), one per event. Written by fetch.py, read by analyze.py.
+Used for event log paths ending with `.events`.
+
+File layout (little endian):
+
+    header:  8 bytes magic (b"GHRSEVT1"), 8 bytes reserved (zero)
+    chunk:   int64 event count N, uint32 CRC32 of the payload,
+             4 bytes reserved (zero), payload: N int64 values
+    chunk:   ...
+
+Each update appends one chunk holding the new events only. The values are
+delta-encoded: each one is the difference to the previous event (across
+chunk boundaries; the very first one is the absolute timestamp). Decoding is
+a cumulative sum over the memory-mapped chunk payloads.
+
+An incomplete or corrupt trailing chunk (e.g. process killed while
+appending) is ignored when reading, and cut off by the next update.
+
+CSV import/export (the format fetch.py writes for `.csv` paths):
+
+    python eventstore.py to-csv stars-raw.events stars-raw.csv
+    python eventstore.py from-csv stars-raw.csv stars-raw.events
+"""
+
+import argparse
+import logging
+import os
+import struct
+import sys
+import zlib
+from datetime import datetime, timezone
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+log = logging.getLogger()
+
+FILE_EXTENSION = ".events"
+MAGIC = b"GHRSEVT1"
+HEADER_SIZE = 16
+# Event count, CRC32, padding: keeps the payloads 8-byte aligned.
+CHUNK_HEADER = struct.Struct("<qI4x")
+
+
+class EventStoreError(Exception):
+    pass
+
+
+def is_store_path(path: str) -> bool:
+    return path.endswith(FILE_EXTENSION)
+
+
+def _scan(buf) -> Tuple[List[np.ndarray], int]:
+    """
+    Parse the file contents in `buf` (bytes-like, e.g. memory-mapped). Return
+    the delta-encoded payloads of all valid chunks (views into `buf`), and
+    the size of the valid part of the file.
+    """
+    if len(buf) < HEADER_SIZE or bytes(buf[: len(MAGIC)]) != MAGIC:
+        raise EventStoreError("not an event store file (bad header)")
+
+    chunks = []
+    offset = HEADER_SIZE
+    while offset + CHUNK_HEADER.size <= len(buf):
+        count, crc = CHUNK_HEADER.unpack_from(buf, offset)
+        start = offset + CHUNK_HEADER.size
+        end = start + 8 * count
+        if count < 0 or end > len(buf):
+            log.warning("event store: ignore incomplete chunk at offset %s", offset)
+            break
+        payload = buf[start:end]
+        if zlib.crc32(payload) != crc:
+            log.warning("event store: ignore corrupt chunk at offset %s", offset)
+            break
+        chunks.append(np.frombuffer(payload, dtype="<i8"))
+        offset = end
+
+    if offset != len(buf):
+        log.warning("event store: ignore %s trailing bytes", len(buf) - offset)
+
+    return chunks, offset
+
+
+def _read(path: str) -> Tuple[np.ndarray, int]:
+    # `memmap()` cannot map an empty file (e.g. truncated, or created by
+    # `touch`).
+    if os.path.getsize(path) == 0:
+        raise EventStoreError("empty file")
+    mm = np.memmap(path, dtype=np.uint8, mode="r")
+    chunks, valid_size = _scan(mm)
+    if not chunks:
+        return np.empty(0, dtype=np.int64), valid_size
+    # `concatenate()` copies: the result does not refer to the mapping.
+    return np.cumsum(np.concatenate(chunks), dtype=np.int64), valid_size
+
+
+def read_events(path: str) -> np.ndarray:
+    """
+    Return the event timestamps (int64 unix time, seconds, sorted).
+    """
+    return _read(path)[0]
+
+
+def read_dataframe(path: str, column: str) -> pd.DataFrame:
+    """
+    Return the event time series in the shape of the CSV file written by
+    fetch.py: DatetimeIndex `time` (UTC), one row per event, cumulative
+    event count in `column`.
+    """
+    epochs = read_events(path)
+    dtidx = pd.DatetimeIndex(pd.to_datetime(epochs, unit="s", utc=True), name="time")
+    return pd.DataFrame(
+        data={column: np.arange(1, len(epochs) + 1, dtype=np.int64)}, index=dtidx
+    )
+
+
+def _chunk(epochs: np.ndarray, previous: int) -> bytes:
+    payload = np.diff(epochs, prepend=previous).astype("<i8").tobytes()
+    return CHUNK_HEADER.pack(len(epochs), zlib.crc32(payload)) + payload
+
+
+def write_events(path: str, epochs) -> None:
+    """
+    Update the store at `path` to hold `epochs` (sorted int64 unix
+    timestamps). If the store holds a prefix of `epochs` (the usual case:
+    new events have been added), append the remainder as a new chunk.
+    Otherwise (or if the store does not exist yet) write a new file.
+    """
+    epochs = np.asarray(epochs, dtype=np.int64)
+
+    if os.path.exists(path):
+        try:
+            existing, valid_size = _read(path)
+        except EventStoreError as e:
+            log.warning("event store %s: %s -- rewrite", path, e)
+        else:
+            n = len(existing)
+            if n <= len(epochs) and np.array_equal(existing, epochs[:n]):
+                log.info("event store %s: append %s events", path, len(epochs) - n)
+                with open(path, "r+b") as f:
+                    # Cut off what `_read()` ignored.
+                    f.truncate(valid_size)
+                    f.seek(valid_size)
+                    if len(epochs) > n:
+                        f.write(_chunk(epochs[n:], existing[-1] if n else 0))
+                    f.flush()
+                    os.fsync(f.fileno())
+                return
+
+            log.info("event store %s: not a prefix of the new events -- rewrite", path)
+
+    log.info("event store %s: write %s events", path, len(epochs))
+    # Pragmatic strategy against partial write / encoding problems.
+    tpath = path + ".tmp"
+    with open(tpath, "wb") as f:
+        f.write(MAGIC + bytes(HEADER_SIZE - len(MAGIC)))
+        if len(epochs):
+            f.write(_chunk(epochs, 0))
+        # The new content must be on disk before it replaces the old file,
+        # and the rename must be on disk before the store is reported as
+        # written (as after an append).
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tpath, path)
+    dirfd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+
+def to_csv(store_path: str, csv_path: str, column: str) -> None:
+    # Same format as written by pandas in fetch.py.
+    epochs = read_events(store_path)
+    with open(csv_path, "w") as f:
+        f.write(f"time_iso8601,{column}\n")
+        for count, t in enumerate(epochs.tolist(), 1):
+            ts = datetime.fromtimestamp(t, tz=timezone.utc).isoformat(sep=" ")
+            f.write(f"{ts},{count}\n")
+
+
+def from_csv(csv_path: str, store_path: str) -> None:
+    epochs = []
+    with open(csv_path) as f:
+        # Skip header line.
+        next(f)
+        for line in f:
+            if line.strip():
+                ts = line.split(",", 1)[0]
+                epochs.append(int(datetime.fromisoformat(ts).timestamp()))
+    write_events(store_path, np.sort(np.array(epochs, dtype=np.int64)))
+
+
+def main() -> None:
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s.%(msecs)03d %(levelname)s: %(message)s",
+        datefmt="%y%m%d-%H:%M:%S",
+    )
+    parser = argparse.ArgumentParser(
+        description="Convert between event store files and event log CSV files"
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("to-csv", help="Export event store to CSV file")
+    p.add_argument("store_path", metavar="STORE")
+    p.add_argument("csv_path", metavar="CSV")
+    p.add_argument(
+        "--column",
+        default="",
+        help="Name of the cumulative count column. Default: derived from the "
+        "file name (stars_cumulative or forks_cumulative)",
+    )
+
+    p = sub.add_parser("from-csv", help="Import CSV file into (new) event store")
+    p.add_argument("csv_path", metavar="CSV")
+    p.add_argument("store_path", metavar="STORE")
+
+    args = parser.parse_args()
+
+    if args.command == "to-csv":
+        column = args.column
+        if not column:
+            name = os.path.basename(args.store_path)
+            column = "forks_cumulative" if "fork" in name else "stars_cumulative"
+        to_csv(args.store_path, args.csv_path, column)
+    else:
+        if os.path.exists(args.store_path):
+            sys.exit(f"error: {args.store_path} exists")
+        from_csv(args.csv_path, args.store_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,21 +14,41 @@
 # the License.
 
 import argparse
+import array
+import calendar
+import concurrent.futures
+import contextvars
+import hashlib
 import logging
+import math
 import os
 import json
-from datetime import datetime
+import random
+import re
+import signal
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import sys
-from typing import Tuple
+from typing import Any, Callable, Dict, Iterable, Iterator, Tuple, List, Optional
+from urllib.parse import parse_qs, urlparse
 
 
+import numpy as np
 import pandas as pd
-from github import Github, Repository  # type: ignore
+from github import (  # type: ignore
+    Github,
+    GithubException,
+    GithubIntegration,
+    Repository,
+)
 import requests
-import retrying  # type: ignore
 import pytz
 
+import eventstore
+
 
 """
 prior art
@@ -55,107 +75,1045 @@ logging.basicConfig(
 NOW = pytz.timezone("UTC").localize(datetime.utcnow())
 INVOCATION_TIME_STRING = NOW.strftime("%Y-%m-%d_%H%M%S")
 
-if not os.environ.get("GHRS_GITHUB_API_TOKEN", None):
-    sys.exit("error: environment variable GHRS_GITHUB_API_TOKEN empty or not set")
+# The traffic API returns the last 14 days. Data older than that is lost
+# unless it was fetched before.
+TRAFFIC_HORIZON = timedelta(days=14)
+
+# Allow for pointing fetch.py to a different API server, e.g. to a GitHub
+# Enterprise instance or to the mock server in tests/mock_github_api.py.
+GITHUB_API_BASE_URL = os.environ.get(
+    "GHRS_GITHUB_API_BASE_URL", "https://api.github.com"
+).rstrip("/")
+
+# GraphQL API endpoint. GitHub Enterprise: https://host/api/v3 for REST,
+# https://host/api/graphql for GraphQL.
+GITHUB_GRAPHQL_URL = re.sub(r"/v3$", "", GITHUB_API_BASE_URL) + "/graphql"
+
+# Page size for paginated API responses (stargazers, forks). 100 is the
+# maximum allowed by the GitHub API.
+PER_PAGE = 100
+
+# The REST API serves the stargazer list up to this page only (422 response
+# beyond: "pagination is limited for this resource"), i.e. the first 40000
+# stargazers. See `stargazers_events_api()`.
+REST_STARGAZERS_MAX_PAGES = 400
+
+# Maximum number of concurrent requests when fetching the pages of a
+# paginated list (per list).
+PAGE_FETCH_CONCURRENCY = 4
+
+# The stargazer list contains the `starred_at` timestamp only when requested
+# with this media type.
+STARGAZER_MEDIA_TYPE = "application/vnd.github.v3.star+json"
+
+# Only used for wrapping API response data in pygithub objects, see
+# `fetch_repo()`. pygithub's HTTP client is not thread-safe (one connection
+# object per `Github` instance, mutated for every request).
+GHUB = Github(base_url=GITHUB_API_BASE_URL, per_page=PER_PAGE)
+
+# All HTTP requests go through this session, see `api_request()`. The
+# connection pool must be at least as large as the number of concurrent
+# requests: four traffic API requests, plus the pages of the stargazer and
+# fork lists. The `Authorization` header is set in main().
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.headers.update({"Accept": "application/vnd.github.v3+json"})
+for _prefix in ("https://", "http://"):
+    HTTP_SESSION.mount(
+        _prefix,
+        requests.adapters.HTTPAdapter(pool_maxsize=4 + 2 * PAGE_FETCH_CONCURRENCY),
+    )
+HTTP_TIMEOUT_SECONDS = 15
+
+# Retry policy for transient errors (connection errors, 5xx responses,
+# secondary rate limit), see `api_get()`.
+MAX_ATTEMPTS = 8
+BACKOFF_MAX_SECONDS = 120.0
+
+# Set in main() if --http-cache-dir is given.
+HTTP_CACHE: Optional["ResponseCache"] = None
+
+# Batch mode: the `BatchBudget` and the repository the current request is
+# made for. Set per repository, see `fetch_batch()`.
+REQUEST_BUDGET: contextvars.ContextVar[
+    Optional[Tuple["BatchBudget", str]]
+] = contextvars.ContextVar("REQUEST_BUDGET", default=None)
+
+# Batch mode: number of requests guaranteed to each repository for a few
+# pages of stars/forks (repository metadata and traffic API requests are not
+# charged). See `BatchBudget`.
+BATCH_MIN_REQUESTS_PER_REPO = 20
+
+# API used for the stargazer and fork time series (rest or graphql). Set in
+# main() via --events-api.
+EVENTS_API = "rest"
+
+# Select nothing but the event timestamps (and the fork IDs, needed for the
+# incremental sync), newest first. This is about 20x less data than the
+# corresponding REST list resources, which return full user/repository
+# objects. Also see `graphql_pages()`.
+GRAPHQL_STARGAZERS_QUERY = """
+query($owner: String!, $name: String!, $perPage: Int!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    conn: stargazers(
+      first: $perPage
+      after: $cursor
+      orderBy: {field: STARRED_AT, direction: DESC}
+    ) {
+      pageInfo { hasNextPage endCursor }
+      items: edges { starredAt }
+    }
+  }
+}
+"""
 
-GHUB = Github(login_or_token=os.environ["GHRS_GITHUB_API_TOKEN"].strip(), per_page=100)
+GRAPHQL_FORKS_QUERY = """
+query($owner: String!, $name: String!, $perPage: Int!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    conn: forks(
+      first: $perPage
+      after: $cursor
+      orderBy: {field: CREATED_AT, direction: DESC}
+    ) {
+      pageInfo { hasNextPage endCursor }
+      items: nodes { databaseId createdAt }
+    }
+  }
+}
+"""
 
 
 def main() -> None:
+    global HTTP_CACHE, EVENTS_API, TOKEN_POOL
+
     args = parse_args()
-    # Full name of repo with slash (including owner/org)
-    repo: Repository.Repository = GHUB.get_repo(args.repo)
-    log.info("Working with repository `%s`", repo)
-    log.info("Request quota limit: %s", GHUB.get_rate_limit())
+    EVENTS_API = args.events_api
+
+    # Checked here, not at import time: allow for importing this module
+    # without token, e.g. for benchmarking individual functions.
+    TOKEN_POOL = token_pool_from_env()
+
+    if args.http_cache_dir:
+        HTTP_CACHE = ResponseCache(args.http_cache_dir)
+
+    skipped: Dict[str, str] = {}
+    intervals: Dict[str, float] = {}
+    results: Dict[str, dict]
+    if args.repos_file:
+        repo_list = read_repo_list(args.repos_file)
+        repospecs = list(repo_list)
+        intervals = {r: h for r, h in repo_list.items() if h is not None}
+    elif args.org:
+        repospecs, skipped = discover_repos(
+            args.org, args.skip_archived, args.skip_forks
+        )
+    else:
+        # Full name of repo with slash (including owner/org)
+        repospecs = [args.repo]
+
+    if args.dry_run:
+        plan_batch(repospecs, args)
+        log.info("%s. Request quota: %s", ACCOUNTING.summary(), TOKEN_POOL.summary())
+        log.info("dry run: done")
+        return
+
+    if args.schedule or not args.repo:
+        # Grow the connection pool for the number of concurrent requests.
+        for prefix in ("https://", "http://"):
+            HTTP_SESSION.mount(
+                prefix,
+                requests.adapters.HTTPAdapter(
+                    pool_maxsize=args.batch_concurrency
+                    * (4 + 2 * PAGE_FETCH_CONCURRENCY)
+                ),
+            )
 
-    (
-        df_views_clones,
-        df_referrers_snapshot_now,
-        df_paths_snapshot_now,
-    ) = fetch_all_traffic_api_endpoints(repo)
+    if args.daemon:
+        # Finish the current round, then exit.
+        signal.signal(signal.SIGTERM, lambda signum, frame: SHUTDOWN.set())
 
-    outdir_path = args.snapshot_directory
-    log.info("current working directory: %s", os.getcwd())
-    log.info("write output CSV files to directory: %s", outdir_path)
+    if args.schedule:
+        results = run_schedule(repospecs, args, intervals)
+    elif args.repo:
+        process_repo(args.repo, args)
+        results = {}
+    else:
+        results = fetch_batch(repospecs, args)
 
-    if len(df_views_clones):
-        df_views_clones.to_csv(
-            os.path.join(
-                outdir_path,
-                f"{INVOCATION_TIME_STRING}_views_clones_series_fragment.csv",
-            )
+    if HTTP_CACHE is not None:
+        log.info(
+            "HTTP cache: %s of %s responses served from cache (304)",
+            HTTP_CACHE.hits,
+            HTTP_CACHE.lookups,
         )
-    else:
-        log.info("do not write df_views_clones: empty")
 
-    if len(df_referrers_snapshot_now):
-        df_referrers_snapshot_now.to_csv(
-            os.path.join(
-                outdir_path, f"{INVOCATION_TIME_STRING}_top_referrers_snapshot.csv"
-            )
+    log.info("%s. Request quota: %s", ACCOUNTING.summary(), ACCOUNTING.quota_summary())
+    if "graphql" in ACCOUNTING.quota_last:
+        log.info("GraphQL request quota: %s", ACCOUNTING.quota_summary("graphql"))
+    if len(TOKEN_POOL.credentials) > 1:
+        log.info("Per credential: %s", TOKEN_POOL.summary())
+    if args.cost_report_outpath:
+        ACCOUNTING.write_report(
+            args.cost_report_outpath, args.repo or args.repos_file or args.org
         )
-    else:
-        log.info("do not write df_referrers_snapshot_now: empty")
+    if args.manifest_outpath:
+        write_manifest(args.manifest_outpath, args, results, skipped)
 
-    if len(df_paths_snapshot_now):
-        df_paths_snapshot_now.to_csv(
-            os.path.join(
-                outdir_path, f"{INVOCATION_TIME_STRING}_top_paths_snapshot.csv"
-            )
+    if any(r["status"] == "failed" for r in results.values()):
+        sys.exit(1)
+
+    log.info("done!")
+
+
+def repo_path(template: str, repospec: str) -> str:
+    # `{owner}` and `{repo}` placeholders, e.g. `_ghrs_{owner}_{repo}`.
+    owner, name = repospec.split("/")
+    return template.replace("{owner}", owner).replace("{repo}", name)
+
+
+def process_repo(
+    repospec: str,
+    args: argparse.Namespace,
+    repo: Optional[Repository.Repository] = None,
+    starsforks: bool = True,
+) -> bool:
+    """
+    Fetch and write all data for one repository (with `starsforks=False`:
+    the traffic data only). Return False if fetching the stars/forks stopped
+    early (see `BatchBudget`).
+    """
+    if repo is None:
+        repo = fetch_repo(repospec)
+    log.info("Working with repository `%s`", repo)
+    # The quota is reported by the headers of every API response, no need for
+    # a dedicated (and itself rate-limited) /rate_limit request.
+    log.info("Request quota: %s", ACCOUNTING.quota_summary())
+
+    snapshot_directory = repo_path(args.snapshot_directory, repospec)
+    prepare_output_directory(snapshot_directory)
+
+    # Fetching the fork and stargazer time series may take many HTTP requests
+    # (one per 100 forks/stars). Do that concurrently with fetching the
+    # traffic API endpoints.
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=2, thread_name_prefix="starsforks"
+    ) as executor:
+        futures = []
+        if starsforks:
+            futures = submit_starsforks(executor, repo, repospec, args)
+
+        (
+            df_views_clones,
+            df_referrers_snapshot_now,
+            df_paths_snapshot_now,
+        ) = fetch_all_traffic_api_endpoints(repo)
+
+        write_traffic_snapshots(
+            snapshot_directory,
+            df_views_clones,
+            df_referrers_snapshot_now,
+            df_paths_snapshot_now,
+            repo_path(args.dedup_state_path, repospec),
         )
-    else:
-        log.info("do not write df_paths_snapshot_now: empty")
 
-    if args.fork_ts_outpath:
-        fetch_and_write_fork_ts(repo, args.fork_ts_outpath)
+        return wait_starsforks(repospec, futures)
 
+
+def fetch_starsforks(
+    repo: Repository.Repository, repospec: str, args: argparse.Namespace
+) -> bool:
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=2, thread_name_prefix="starsforks"
+    ) as executor:
+        return wait_starsforks(
+            repospec, submit_starsforks(executor, repo, repospec, args)
+        )
+
+
+def submit_starsforks(
+    executor: concurrent.futures.Executor,
+    repo: Repository.Repository,
+    repospec: str,
+    args: argparse.Namespace,
+) -> List[concurrent.futures.Future]:
+    futures = []
+    if args.fork_ts_outpath:
+        futures.append(
+            submit_in_context(
+                executor,
+                fetch_and_write_fork_ts,
+                repo,
+                repo_path(args.fork_ts_outpath, repospec),
+                args.incremental,
+                args.full_sync_every,
+            )
+        )
     if args.stargazer_ts_outpath:
-        fetch_and_write_stargazer_ts(repo, args.stargazer_ts_outpath)
+        futures.append(
+            submit_in_context(
+                executor,
+                fetch_and_write_stargazer_ts,
+                repo,
+                repo_path(args.stargazer_ts_outpath, repospec),
+                args.incremental,
+                args.full_sync_every,
+            )
+        )
+    return futures
+
+
+def wait_starsforks(repospec: str, futures: List[concurrent.futures.Future]) -> bool:
+    # Re-raises an exception (including SystemExit) raised in the thread.
+    complete = True
+    for fut in futures:
+        try:
+            fut.result()
+        except RequestBudgetExceeded as e:
+            # Not an error: resumed by the next run (see `PageJournal`).
+            log.warning("%s: stop fetching stars/forks: %s", repospec, e)
+            complete = False
+    return complete
+
+
+def read_repo_list(path: str) -> Dict[str, Optional[float]]:
+    # One owner/repo per line, optionally followed by the fetch interval in
+    # hours (for --schedule). Empty lines and lines starting with # are
+    # ignored.
+    with open(path, "rb") as f:
+        lines = f.read().decode("utf-8").splitlines()
+
+    repo_list: Dict[str, Optional[float]] = {}
+    for line in lines:
+        if not line.strip() or line.startswith("#"):
+            continue
+        fields = line.split()
+        try:
+            if fields[0].count("/") != 1 or len(fields) > 2:
+                raise ValueError
+            repo_list[fields[0]] = float(fields[1]) if len(fields) == 2 else None
+        except ValueError:
+            sys.exit(f"{path}: bad line: {line}")
+
+    log.info("read %s repositories from %s", len(repo_list), path)
+    return repo_list
+
+
+def fetch_batch(repospecs: List[str], args: argparse.Namespace) -> Dict[str, dict]:
+    """
+    Process repositories concurrently (at most `--batch-concurrency` at a
+    time), sharing `HTTP_SESSION` and the request quota (see
+    `BatchBudget`). An error for one repository does not affect the others.
+    Return the outcome per repository: `status` is one of `ok`, `incomplete`
+    (stars/forks not fetched completely), `failed` (with `error`).
+
+    The order is determined by `plan_batch()`. Stars/forks of repositories
+    for which the quota is not expected to suffice are fetched last, after
+    the traffic data of all repositories has been fetched.
+    """
+    results = {}
+    plan = plan_batch(repospecs, args)
+    for repospec in repospecs:
+        if repospec not in plan:
+            results[repospec] = {"status": "failed", "error": "no repository metadata"}
+
+    budget = BatchBudget(list(plan))
+    deferred = [r for r, p in plan.items() if p["deferred"]]
+
+    def process(repospec, phase):
+        REQUEST_BUDGET.set((budget, repospec))
+        repo = plan[repospec]["repo"]
+        done = phase == "starsforks" or repospec not in deferred
+        try:
+            if phase == "traffic":
+                return process_repo(repospec, args, repo, repospec not in deferred)
+            return fetch_starsforks(repo, repospec, args)
+        except Exception:
+            done = True
+            raise
+        finally:
+            if done:
+                budget.finish(repospec)
+
+    def run_phase(phase, phase_repospecs):
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=args.batch_concurrency, thread_name_prefix="repo"
+        ) as executor:
+            futures = {
+                submit_in_context(executor, process, repospec, phase): repospec
+                for repospec in phase_repospecs
+            }
+            for fut in concurrent.futures.as_completed(futures):
+                repospec = futures[fut]
+                try:
+                    complete = fut.result()
+                except Exception as e:
+                    log.exception("%s: failed: %s", repospec, e)
+                    results[repospec] = {"status": "failed", "error": str(e)}
+                else:
+                    results[repospec] = {"status": "ok" if complete else "incomplete"}
+
+    run_phase("traffic", list(plan))
+    if deferred:
+        log.info("fetch deferred stars/forks: %s", deferred)
+        run_phase("starsforks", [r for r in deferred if results[r]["status"] == "ok"])
+
+    failed = [r for r in repospecs if results[r]["status"] == "failed"]
+    log.info(
+        "batch: %s repositories processed, %s failed %s",
+        len(repospecs),
+        len(failed),
+        failed,
+    )
+    # In input order.
+    return {r: results[r] for r in repospecs}
+
+
+def plan_batch(repospecs: List[str], args: argparse.Namespace) -> Dict[str, dict]:
+    """
+    Fetch the repository objects (one request each), estimate the number of
+    requests needed per repository and compare the total with the remaining
+    request quota. Return the plan per repository, cheapest stars/forks
+    sync first (repositories whose object could not be fetched are
+    missing).
+
+    The traffic API only returns the last 14 days: its requests are
+    reserved first. Stars/forks syncs are then admitted cheapest first, as
+    long as the quota suffices. The remaining ones are `deferred`: to be
+    run after everything else (and possibly stopped early by
+    `BatchBudget`, then resumed by a later run).
+    """
+    repos = {}
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=args.batch_concurrency, thread_name_prefix="plan"
+    ) as executor:
+        futures = {executor.submit(fetch_repo, r): r for r in repospecs}
+        for fut in concurrent.futures.as_completed(futures):
+            try:
+                repos[futures[fut]] = fut.result()
+            except Exception as e:
+                log.exception("%s: cannot fetch repository: %s", futures[fut], e)
+
+    plan = {}
+    for repospec, repo in repos.items():
+        p = {"repo": repo, "traffic": 4, "deferred": False}
+        p["stars"], p["stars_sync"] = estimate_sync_requests(
+            repo.stargazers_count,
+            repo_path(args.stargazer_ts_outpath, repospec),
+            "stars",
+            args,
+        )
+        p["forks"], p["forks_sync"] = estimate_sync_requests(
+            repo.forks_count, repo_path(args.fork_ts_outpath, repospec), "forks", args
+        )
+        plan[repospec] = p
+    plan = dict(sorted(plan.items(), key=lambda i: i[1]["stars"] + i[1]["forks"]))
+
+    # Stars/forks syncs use the GraphQL quota with --events-api=graphql.
+    resource = "graphql" if EVENTS_API == "graphql" else "core"
+    core_left = TOKEN_POOL.remaining("core")
+    if core_left is not None:
+        core_left -= sum(p["traffic"] for p in plan.values())
+    left = core_left if resource == "core" else TOKEN_POOL.remaining(resource)
+
+    for repospec, p in plan.items():
+        cost = p["stars"] + p["forks"]
+        if left is not None:
+            p["deferred"] = cost > left
+            if not p["deferred"]:
+                left -= cost
+        log.info(
+            "plan: %s: %s stars (%s), %s forks (%s), %s traffic requests%s",
+            repospec,
+            p["stars"],
+            p["stars_sync"],
+            p["forks"],
+            p["forks_sync"],
+            p["traffic"],
+            " -- stars/forks deferred" if p["deferred"] else "",
+        )
 
-    log.info("done!")
+    log.info(
+        "plan: %s requests for %s repositories, stars/forks deferred for %s. "
+        "Remaining quota: %s (core), %s (graphql)",
+        sum(p["stars"] + p["forks"] + p["traffic"] for p in plan.values()),
+        len(plan),
+        sum(p["deferred"] for p in plan.values()),
+        TOKEN_POOL.remaining("core"),
+        TOKEN_POOL.remaining("graphql"),
+    )
+    return plan
+
+
+def discover_repos(
+    owner: str, skip_archived: bool, skip_forks: bool
+) -> Tuple[List[str], Dict[str, str]]:
+    """
+    List the repositories of organization or user `owner`. Return the
+    repositories to process (sorted by name), and the skipped ones along with
+    the reason.
+
+    The traffic API requires push access: skip repositories for which the
+    `permissions` object (present in responses to authenticated requests)
+    says otherwise.
+    """
+    try:
+        pages = fetch_all_pages(
+            f"{GITHUB_API_BASE_URL}/orgs/{owner}/repos", list, params={"type": "all"}
+        )
+    except GithubException as e:
+        if e.status != 404:
+            raise
+        log.info("%s: not an organization, list repositories of user", owner)
+        pages = fetch_all_pages(
+            f"{GITHUB_API_BASE_URL}/users/{owner}/repos", list, params={"type": "owner"}
+        )
 
+    repospecs = []
+    skipped = {}
+    for r in sorted((r for p in pages for r in p), key=lambda r: r["full_name"]):
+        if skip_archived and r.get("archived"):
+            skipped[r["full_name"]] = "archived"
+        elif skip_forks and r.get("fork"):
+            skipped[r["full_name"]] = "fork"
+        elif not r.get("permissions", {}).get("push", True):
+            skipped[r["full_name"]] = "no push access (required for traffic API)"
+        else:
+            repospecs.append(r["full_name"])
 
-def fetch_and_write_stargazer_ts(repo: Repository.Repository, path: str):
-    dfstarscsv = get_stars_over_time(repo)
-    log.info("stars_cumulative, for CSV file:\n%s", dfstarscsv)
-    tpath = path + ".tmp"  # todo: rnd string
     log.info(
-        "write stargazer time series to %s, then rename to %s",
-        tpath,
-        path,
+        "%s: %s repositories, skip %s", owner, len(repospecs) + len(skipped), skipped
     )
-    dfstarscsv.to_csv(tpath, index_label="time_iso8601")
+    return repospecs, skipped
+
+
+def write_manifest(
+    path: str,
+    args: argparse.Namespace,
+    results: Dict[str, dict],
+    skipped: Dict[str, str],
+) -> None:
+    repos = {}
+    for repospec, result in results.items():
+        repos[repospec] = {
+            **result,
+            "snapshot_directory": repo_path(args.snapshot_directory, repospec),
+            "stargazer_ts_outpath": repo_path(args.stargazer_ts_outpath, repospec),
+            "fork_ts_outpath": repo_path(args.fork_ts_outpath, repospec),
+            "cost": ACCOUNTING.repo_cost(repospec),
+        }
+    for repospec, reason in skipped.items():
+        repos[repospec] = {"status": "skipped", "reason": reason}
+
+    report = ACCOUNTING.report()
+    manifest = {
+        "org": args.org,
+        "repos_file": args.repos_file,
+        "invocation_time": report["invocation_time"],
+        "wall_seconds": report["wall_seconds"],
+        "totals": report["totals"],
+        "rate_limit_last_seen": report["rate_limit_last_seen"],
+        "repos": dict(sorted(repos.items())),
+    }
+    log.info("write manifest to %s", path)
+    tpath = path + ".tmp"
+    with open(tpath, "wb") as f:
+        f.write(json.dumps(manifest, indent=2).encode("utf-8"))
     os.rename(tpath, path)
 
 
-def fetch_and_write_fork_ts(repo: Repository.Repository, path: str):
-    dfforkcsv = get_forks_over_time(repo)
+def set_invocation_time(t: float) -> None:
+    # For a long-running process: the time used for snapshot file names and
+    # sync state.
+    global NOW, INVOCATION_TIME_STRING
+    NOW = datetime.fromtimestamp(t, tz=pytz.utc)
+    INVOCATION_TIME_STRING = NOW.strftime("%Y-%m-%d_%H%M%S")
+
+
+def newest_snapshot_time(snapshot_directory: str) -> Optional[float]:
+    """
+    Return the time of the most recent successful traffic fetch (unix time)
+    as encoded in the file names in `snapshot_directory`, or `None`.
+
+    The views/clones fragment is the one that matters (the traffic API
+    returns 14 days), but any traffic snapshot file is considered: with
+    --dedup-state-path, an unchanged fragment is not written.
+    """
+    if not os.path.isdir(snapshot_directory):
+        return None
+
+    newest = None
+    for name in os.listdir(snapshot_directory):
+        if not name.endswith(
+            ("_views_clones_series_fragment.csv", "_snapshot.csv", ".unchanged")
+        ):
+            continue
+        try:
+            t = datetime.strptime(name[:17], "%Y-%m-%d_%H%M%S")
+        except ValueError:
+            continue
+        t_unix = calendar.timegm(t.timetuple())
+        newest = t_unix if newest is None else max(newest, t_unix)
+    return newest
+
+
+def last_fetch_time(repospec: str, args: argparse.Namespace) -> Optional[float]:
+    """
+    Return the time of the most recent successful traffic fetch for
+    `repospec` (unix time), or `None`: the newer one of what the snapshot
+    file names tell and what the dedup state file (if any) records.
+    """
+    times = [newest_snapshot_time(repo_path(args.snapshot_directory, repospec))]
+    if args.dedup_state_path:
+        state = read_sync_state(repo_path(args.dedup_state_path, repospec))
+        if "last_fetch" in state:
+            t = datetime.strptime(state["last_fetch"], "%Y-%m-%d_%H%M%S")
+            times.append(calendar.timegm(t.timetuple()))
+    return max((t for t in times if t is not None), default=None)
+
+
+class DeadlineScheduler:
+    """
+    Decide which repositories to fetch when, for the long-running mode
+    (--schedule). A repository is due `interval` seconds after its last
+    successful fetch. Due repositories are fetched in order of urgency: the
+    one whose data is closest to falling out of the traffic API's 14-day
+    horizon first (never fetched: most urgent).
+
+    A failed fetch is retried after a backoff delay. It keeps its deadline,
+    i.e. it is then more urgent than any repository fetched since.
+
+    With `jitter` (a fraction of the interval), each fetch is scheduled up to
+    that much later, at random: repositories with the same interval do not
+    stay in lockstep.
+
+    `clock` and `sleep` can be replaced (e.g. by a `FakeClock`).
+    """
+
+    RETRY_DELAY_SECONDS = 60
+    RETRY_DELAY_MAX_SECONDS = 3600
+
+    def __init__(
+        self,
+        last_success: Dict[str, Optional[float]],
+        intervals: Dict[str, float],
+        jitter: float = 0.0,
+        clock=time.time,
+        sleep=time.sleep,
+    ):
+        self.last_success = dict(last_success)
+        self.intervals = intervals
+        self.jitter = jitter
+        self._clock = clock
+        self._sleep = sleep
+        self.rounds = 0
+        self.failures = {r: 0 for r in last_success}
+        self._retry_at = {r: 0.0 for r in last_success}
+        self._next = {r: self._next_fetch(r) for r in last_success}
+
+    def _next_fetch(self, repospec: str) -> float:
+        last = self.last_success[repospec]
+        if last is None:
+            return -math.inf
+        return last + self.intervals[repospec] * (1 + self.jitter * random.random())
+
+    def deadline(self, repospec: str) -> float:
+        last = self.last_success[repospec]
+        if last is None:
+            return -math.inf
+        return last + TRAFFIC_HORIZON.total_seconds()
+
+    def due_at(self, repospec: str) -> float:
+        return max(self._next[repospec], self._retry_at[repospec])
+
+    def due(self) -> List[str]:
+        # Most urgent first. Same deadline: more failures first.
+        now = self._clock()
+        return sorted(
+            (r for r in self.last_success if self.due_at(r) <= now),
+            key=lambda r: (self.deadline(r), -self.failures[r]),
+        )
+
+    def record(self, repospec: str, ok: bool) -> None:
+        if ok:
+            self.last_success[repospec] = self._clock()
+            self.failures[repospec] = 0
+            self._retry_at[repospec] = 0.0
+            self._next[repospec] = self._next_fetch(repospec)
+            return
+
+        self.failures[repospec] += 1
+        delay = min(
+            self.RETRY_DELAY_MAX_SECONDS,
+            self.RETRY_DELAY_SECONDS * 2 ** (self.failures[repospec] - 1),
+        )
+        self._retry_at[repospec] = self._clock() + delay
+        log.info("%s: retry in %s s", repospec, delay)
+
+    def wait_until_due(self) -> None:
+        delay = min(self.due_at(r) for r in self.last_success) - self._clock()
+        if delay > 0:
+            log.info("schedule: next fetch in %.0f s", delay)
+            self._sleep(delay)
+
+
+class FakeClock:
+    """
+    For testing the long-running mode: time starts at `start` (unix time)
+    and only advances by calls to `sleep()`, which return immediately.
+    """
+
+    def __init__(self, start: float):
+        self._t = start
+
+    def time(self) -> float:
+        return self._t
+
+    def sleep(self, seconds: float) -> None:
+        self._t += seconds
+
+
+def run_schedule(
+    repospecs: List[str], args: argparse.Namespace, intervals: Dict[str, float]
+) -> Dict[str, dict]:
+    """
+    Long-running mode: fetch the repositories repeatedly, as decided by
+    `DeadlineScheduler`. Each round fetches the due repositories (see
+    `fetch_batch()`), the most urgent ones first. If the remaining quota is
+    not sufficient for fetching the traffic data of all of them, fetch only
+    as many as it is expected to suffice for (at least one).
+
+    Stop after `--schedule-max-rounds` rounds (if set), or when `SHUTDOWN`
+    is set. Return the outcome of the last fetch per repository.
+    """
+    clock = time.time
+    sleep = SHUTDOWN.wait
+    if os.environ.get("GHRS_FAKE_CLOCK_START"):
+        fake_clock = FakeClock(float(os.environ["GHRS_FAKE_CLOCK_START"]))
+        clock, sleep = fake_clock.time, fake_clock.sleep
+        log.info("schedule: use fake clock, start at %s", clock())
+
+    scheduler = DeadlineScheduler(
+        {r: last_fetch_time(r, args) for r in repospecs},
+        {r: intervals.get(r, args.schedule_interval) * 3600 for r in repospecs},
+        args.schedule_jitter,
+        clock,
+        sleep,
+    )
+
+    if args.metrics_port:
+        serve_metrics(args.metrics_host, args.metrics_port, scheduler)
+
+    results: Dict[str, dict] = {}
+    while not SHUTDOWN.is_set() and (
+        not args.schedule_max_rounds or scheduler.rounds < args.schedule_max_rounds
+    ):
+        due = scheduler.due()
+        if not due:
+            scheduler.wait_until_due()
+            continue
+
+        # Repository object and four traffic API endpoints.
+        remaining = TOKEN_POOL.remaining("core")
+        if remaining is not None and remaining < 5 * len(due):
+            due = due[: max(1, remaining // 5)]
+
+        scheduler.rounds += 1
+        log.info(
+            "schedule: round %s, fetch (most urgent first): %s", scheduler.rounds, due
+        )
+        set_invocation_time(clock())
+        round_results = fetch_batch(due, args)
+        for repospec, result in round_results.items():
+            scheduler.record(repospec, result["status"] != "failed")
+        results.update(round_results)
+
+    log.info("schedule: stop after %s rounds", scheduler.rounds)
+    return results
+
+
+# Set upon SIGTERM in --daemon mode.
+SHUTDOWN = threading.Event()
+
+
+def serve_metrics(host: str, port: int, scheduler: DeadlineScheduler) -> None:
+    """
+    Serve in a background thread:
+
+    - /healthz: JSON document. Status 503 if, for any repository, less than a
+      day is left before traffic data falls out of the 14-day horizon.
+    - /metrics: request and schedule metrics, Prometheus text format.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            log.debug(format, *args)
+
+        def do_GET(self):
+            if self.path == "/healthz":
+                now = scheduler._clock()
+                at_risk = [
+                    r
+                    for r, last in scheduler.last_success.items()
+                    if last is not None and scheduler.deadline(r) - now < 86400
+                ]
+                doc = {"rounds": scheduler.rounds, "at_risk": at_risk}
+                return self.send(
+                    json.dumps(doc).encode("utf-8"),
+                    "application/json",
+                    503 if at_risk else 200,
+                )
+            if self.path == "/metrics":
+                return self.send(metrics_text(scheduler).encode("utf-8"), "text/plain")
+            self.send(b"not found\n", "text/plain", 404)
+
+        def send(self, body: bytes, ctype: str, status: int = 200) -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    log.info("metrics: listening on %s:%s", host, server.server_address[1])
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+
+
+def metrics_text(scheduler: DeadlineScheduler) -> str:
+    t = ACCOUNTING.totals()
+    lines = [
+        "# TYPE ghrs_http_requests_total counter",
+        f"ghrs_http_requests_total {t['requests']}",
+        "# TYPE ghrs_http_requests_failed_total counter",
+        f"ghrs_http_requests_failed_total {t['failed']}",
+        "# TYPE ghrs_http_response_bytes_total counter",
+        f"ghrs_http_response_bytes_total {t['bytes']}",
+        "# TYPE ghrs_schedule_rounds_total counter",
+        f"ghrs_schedule_rounds_total {scheduler.rounds}",
+        "# TYPE ghrs_rate_limit_remaining gauge",
+    ]
+    for resource in ("core", "graphql"):
+        remaining = TOKEN_POOL.remaining(resource)
+        if remaining is not None:
+            lines.append(
+                f'ghrs_rate_limit_remaining{{resource="{resource}"}} {remaining}'
+            )
+
+    lines.append("# TYPE ghrs_repo_last_success_timestamp_seconds gauge")
+    for r, last in scheduler.last_success.items():
+        if last is not None:
+            lines.append(
+                f'ghrs_repo_last_success_timestamp_seconds{{repo="{r}"}} {last}'
+            )
+    lines.append("# TYPE ghrs_repo_next_fetch_timestamp_seconds gauge")
+    for r in scheduler.last_success:
+        due = scheduler.due_at(r)
+        if due > 0:
+            lines.append(f'ghrs_repo_next_fetch_timestamp_seconds{{repo="{r}"}} {due}')
+    lines.append("# TYPE ghrs_repo_consecutive_failures gauge")
+    for r, n in scheduler.failures.items():
+        lines.append(f'ghrs_repo_consecutive_failures{{repo="{r}"}} {n}')
+    return "\n".join(lines) + "\n"
+
+
+def submit_in_context(executor, fn, *args) -> concurrent.futures.Future:
+    # Run `fn` in a copy of the current thread's context: keep `ContextVar`
+    # values (`REQUEST_BUDGET`) across thread pools.
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+def submit_budget_exempt(executor, fn, *args) -> concurrent.futures.Future:
+    # Like `submit_in_context()`, but do not charge the requests made by `fn`
+    # to the `BatchBudget` of the current repository (if any).
+    ctx = contextvars.copy_context()
+    ctx.run(REQUEST_BUDGET.set, None)
+    return executor.submit(ctx.run, fn, *args)
+
+
+def write_traffic_snapshots(
+    outdir_path: str,
+    df_views_clones: pd.DataFrame,
+    df_referrers_snapshot_now: pd.DataFrame,
+    df_paths_snapshot_now: pd.DataFrame,
+    dedup_state_path: str = "",
+) -> None:
+    log.info("current working directory: %s", os.getcwd())
+    log.info("write output CSV files to directory: %s", outdir_path)
+
+    # Content hash of the most recent snapshot, per kind (file name suffix).
+    dedup_state = read_sync_state(dedup_state_path) if dedup_state_path else None
+
+    for suffix, df in (
+        ("_views_clones_series_fragment.csv", df_views_clones),
+        ("_top_referrers_snapshot.csv", df_referrers_snapshot_now),
+        ("_top_paths_snapshot.csv", df_paths_snapshot_now),
+    ):
+        if not len(df):
+            log.info("do not write %s: empty", suffix)
+            continue
+        write_snapshot(outdir_path, suffix, df, dedup_state)
+
+    if dedup_state is not None:
+        # Independent of whether a file was written: with all snapshots
+        # unchanged (or empty), the snapshot file names do not tell about
+        # this fetch (see `last_fetch_time()`).
+        dedup_state["last_fetch"] = INVOCATION_TIME_STRING
+        write_sync_state(dedup_state_path, dedup_state)
+
+
+def write_snapshot(
+    outdir_path: str, suffix: str, df: pd.DataFrame, dedup_state: Optional[dict]
+) -> None:
+    """
+    Write `df` to `<invocation time><suffix>` in `outdir_path`.
+
+    With `dedup_state`: if the content is the same as the one of the previous
+    snapshot of this kind, do not write it. For a time series fragment, that
+    is all: its samples are already known. A top referrers/paths snapshot
+    however is a data point at the time of the snapshot. Write a zero-byte
+    marker file instead (`<invocation time><suffix>.unchanged`), which
+    analyze.py reads as a copy of the previous snapshot.
+    """
+    path = os.path.join(outdir_path, f"{INVOCATION_TIME_STRING}{suffix}")
+    content = df.to_csv()
+
+    if dedup_state is not None:
+        digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        prev = dedup_state.get(suffix)
+        if prev is not None and prev["sha256"] == digest:
+            log.info("unchanged since %s: %s", prev["time"], suffix)
+            if suffix.endswith("_snapshot.csv"):
+                with open(path + ".unchanged", "wb"):
+                    pass
+            return
+        dedup_state[suffix] = {"sha256": digest, "time": INVOCATION_TIME_STRING}
+
+    log.info("write %s", path)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def fetch_and_write_stargazer_ts(
+    repo: Repository.Repository,
+    path: str,
+    incremental: bool = False,
+    full_sync_every: int = 0,
+):
+    # The file at `path` is the event log: one row per star event (with the
+    # cumulative count) in a CSV file, or one timestamp per star event in an
+    # event store (see eventstore.py). The state file next to it carries the
+    # sync cursor. In incremental mode, only fetch the stargazers not yet contained
+    # in the event log (the API returns them in order of starring, i.e. the
+    # new ones are on the last page(s)).
+    state_path = sync_state_path(path)
+    state = read_sync_state(state_path)
+
+    if incremental and event_log_up_to_date(
+        path, state, repo.stargazers_count, full_sync_every
+    ):
+        log.info("stargazer count unchanged: skip fetching stargazers")
+        return
+
+    df_prev = None
+    if incremental:
+        df_prev = read_event_log(path, "stars_cumulative", state, full_sync_every)
+
+    journal = None
+    if df_prev is not None:
+        dfstarscsv = get_stars_over_time_incremental(repo, df_prev)
+    else:
+        journal = PageJournal(
+            journal_path(path), f"{stargazers_events_api(repo)} {repo.url}/stargazers"
+        )
+        with journal:
+            dfstarscsv = get_stars_over_time(repo, journal)
+        state["last_full_sync"] = NOW.isoformat()
+
+    log.info("stars_cumulative, for CSV file:\n%s", dfstarscsv)
+    write_event_log(path, dfstarscsv)
+
+    state["event_count"] = len(dfstarscsv)
+    state["last_event_time"] = (
+        dfstarscsv.index[-1].isoformat() if len(dfstarscsv) else None
+    )
+    state["api_count"] = repo.stargazers_count
+    write_sync_state(state_path, state)
+
+    if journal is not None:
+        journal.remove()
+
+
+def fetch_and_write_fork_ts(
+    repo: Repository.Repository,
+    path: str,
+    incremental: bool = False,
+    full_sync_every: int = 0,
+):
+    # Same approach as for stargazers. The fork list however can be requested
+    # newest-first. The newest known fork (see `fork_watermark()`) is part of
+    # the sync state, so that an incremental sync can stop right after it.
+    state_path = sync_state_path(path)
+    state = read_sync_state(state_path)
+
+    if incremental and event_log_up_to_date(
+        path, state, repo.forks_count, full_sync_every
+    ):
+        log.info("fork count unchanged: skip fetching forks")
+        return
+
+    df_prev = None
+    # A sync state written by a previous version has `fork_ids` (the IDs of
+    # all known forks) instead: do a full sync, once.
+    state.pop("fork_ids", None)
+    if incremental and "fork_watermark" in state:
+        df_prev = read_event_log(path, "forks_cumulative", state, full_sync_every)
+
+    journal = None
+    if df_prev is not None:
+        dfforkcsv, watermark = get_forks_over_time_incremental(
+            repo, df_prev, state["fork_watermark"]
+        )
+    else:
+        journal = PageJournal(journal_path(path), f"{EVENTS_API} {repo.url}/forks")
+        with journal:
+            dfforkcsv, watermark = get_forks_over_time(repo, journal)
+        state["last_full_sync"] = NOW.isoformat()
+
     log.info("forks_cumulative, for CSV file:\n%s", dfforkcsv)
-    tpath = path + ".tmp"  # todo: rnd string
-    log.info(
-        "write fork time series to %s, then rename to %s",
-        tpath,
-        path,
+    write_event_log(path, dfforkcsv)
+
+    state["event_count"] = len(dfforkcsv)
+    state["last_event_time"] = (
+        dfforkcsv.index[-1].isoformat() if len(dfforkcsv) else None
     )
-    dfforkcsv.to_csv(tpath, index_label="time_iso8601")
-    os.rename(tpath, path)
+    state["fork_watermark"] = watermark
+    state["api_count"] = repo.forks_count
+    write_sync_state(state_path, state)
+
+    if journal is not None:
+        journal.remove()
 
 
 def fetch_all_traffic_api_endpoints(
     repo,
 ) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
 
-    log.info("fetch top referrers")
-    df_referrers_snapshot_now = referrers_to_df(fetch_top_referrers(repo))
-
-    log.info("fetch top paths")
-    df_paths_snapshot_now = paths_to_df(fetch_top_paths(repo))
-
-    log.info("fetch data for clones")
-    df_clones = clones_or_views_to_df(fetch_clones(repo), "clones")
-
-    log.info("fetch data for views")
-    df_views = clones_or_views_to_df(fetch_views(repo), "views")
+    # The four traffic API endpoints are independent of each other: fetch
+    # them concurrently, each with its own retry loop. The wall time of this
+    # phase is then determined by the slowest request.
+    log.info("fetch top referrers, top paths, clones, views")
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=4, thread_name_prefix="traffic"
+    ) as executor:
+        # Traffic API requests are not charged to the batch budget (see
+        # `BatchBudget`).
+        fut_referrers = submit_budget_exempt(executor, fetch_top_referrers, repo)
+        fut_paths = submit_budget_exempt(executor, fetch_top_paths, repo)
+        fut_clones = submit_budget_exempt(executor, fetch_clones, repo)
+        fut_views = submit_budget_exempt(executor, fetch_views, repo)
+
+        df_referrers_snapshot_now = referrers_to_df(fut_referrers.result())
+        df_paths_snapshot_now = paths_to_df(fut_paths.result())
+        df_clones = clones_or_views_to_df(fut_clones.result(), "clones")
+        df_views = clones_or_views_to_df(fut_views.result(), "views")
 
     # Note that df_clones and df_views should have the same datetime index, but
     # there is no guarantee for that. Create two separate data frames, then
@@ -184,14 +1142,68 @@ def parse_args():
     parser.add_argument(
         "repo",
         metavar="REPOSITORY",
+        nargs="?",
+        default="",
         help="Owner/organization and repository. Must contain a slash. "
         "Example: coke/truck",
     )
 
+    parser.add_argument(
+        "--repos-file",
+        default="",
+        metavar="PATH",
+        help="Batch mode: process the repositories listed in this file (one "
+        "owner/repo per line) instead of REPOSITORY. Output paths may contain "
+        "the placeholders {owner} and {repo}; --stargazer-ts-outpath and "
+        "--fork-ts-outpath must contain {repo}.",
+    )
+
+    parser.add_argument(
+        "--batch-concurrency",
+        type=int,
+        default=4,
+        metavar="N",
+        help="Batch mode: number of repositories processed concurrently. "
+        "Default: 4",
+    )
+
+    parser.add_argument(
+        "--org",
+        default="",
+        metavar="NAME",
+        help="Batch mode: process all repositories of this organization (or "
+        "user) for which the API token has push access (required for the "
+        "traffic API). Same output path rules as for --repos-file.",
+    )
+
+    parser.add_argument(
+        "--skip-archived",
+        default=False,
+        action="store_true",
+        help="With --org: skip archived repositories",
+    )
+
+    parser.add_argument(
+        "--skip-forks",
+        default=False,
+        action="store_true",
+        help="With --org: skip repositories that are forks",
+    )
+
+    parser.add_argument(
+        "--manifest-outpath",
+        default="",
+        metavar="PATH",
+        help="Batch mode: write a JSON manifest to this file: per repository "
+        "the outcome (or why it was skipped), the output paths, and the number "
+        "of HTTP requests, response bytes and request time spent on it. "
+        "Default (with --org): _ghrs_{org}_manifest.json",
+    )
+
     parser.add_argument(
         "--snapshot-directory",
         type=str,
-        default="",
+        default="_ghrs_{owner}_{repo}",
         help="Snapshot/fragment directory. Default: _ghrs_{owner}_{repo}",
     )
 
@@ -199,46 +1211,194 @@ def parse_args():
         "--fork-ts-outpath",
         default="",
         metavar="PATH",
-        help="Fetch fork time series and write to this CSV file. Overwrite if file exists.",
+        help="Fetch fork time series and write to this CSV file (overwrite if "
+        "file exists). If PATH ends with .events: binary event store, new "
+        "events are appended (see eventstore.py).",
     )
 
     parser.add_argument(
         "--stargazer-ts-outpath",
         default="",
         metavar="PATH",
-        help="Fetch stargazer time series and write to this CSV file. Overwrite if file exists.",
+        help="Fetch stargazer time series and write to this CSV file (overwrite "
+        "if file exists). If PATH ends with .events: binary event store, new "
+        "events are appended (see eventstore.py).",
+    )
+
+    parser.add_argument(
+        "--http-cache-dir",
+        default="",
+        metavar="PATH",
+        help="Persist API responses (body and ETag/Last-Modified) in this "
+        "directory and send conditional requests. A 304 Not Modified response "
+        "does not count against the rate limit. Default: no cache.",
+    )
+
+    parser.add_argument(
+        "--events-api",
+        default="rest",
+        choices=("rest", "graphql"),
+        help="API for fetching the stargazer and fork time series. graphql: "
+        "transfer nothing but the timestamps (about 20x less data than rest), "
+        "but fetch pages one after another (cursor-based pagination). "
+        "Default: rest.",
+    )
+
+    parser.add_argument(
+        "--dedup-state-path",
+        default="",
+        metavar="PATH",
+        help="Do not write traffic snapshots which have the same content as "
+        "the previous one (of the same kind), as recorded in this JSON file. "
+        "For top referrers/paths, write a zero-byte *.unchanged marker file "
+        "instead (understood by analyze.py). Default: write all snapshots",
+    )
+
+    parser.add_argument(
+        "--schedule",
+        default=False,
+        action="store_true",
+        help="Long-running mode: fetch the repositories repeatedly, each one "
+        "every --schedule-interval hours, the one closest to losing traffic "
+        "data (based on the newest snapshot in its snapshot directory) first. "
+        "Retry failed fetches with priority.",
+    )
+
+    parser.add_argument(
+        "--schedule-interval",
+        type=float,
+        default=24,
+        metavar="HOURS",
+        help="With --schedule: fetch interval per repository. Default: 24",
+    )
+
+    parser.add_argument(
+        "--schedule-jitter",
+        type=float,
+        default=0.1,
+        metavar="FRACTION",
+        help="With --schedule: delay each fetch by up to this fraction of the "
+        "interval, at random. Default: 0.1",
+    )
+
+    parser.add_argument(
+        "--daemon",
+        default=False,
+        action="store_true",
+        help="Same as --schedule, plus: exit cleanly upon SIGTERM (after the "
+        "current round). Combine with --metrics-port.",
+    )
+
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=0,
+        metavar="PORT",
+        help="With --schedule/--daemon: serve /healthz and /metrics "
+        "(Prometheus text format) on this port. Default: 0 (do not serve)",
+    )
+
+    parser.add_argument(
+        "--metrics-host",
+        default="127.0.0.1",
+        metavar="HOST",
+        help="Address to listen on for --metrics-port. Default: 127.0.0.1",
+    )
+
+    parser.add_argument(
+        "--schedule-max-rounds",
+        type=int,
+        default=0,
+        metavar="N",
+        help="With --schedule: exit after N rounds of fetching. Default: 0 "
+        "(never)",
+    )
+
+    parser.add_argument(
+        "--dry-run",
+        default=False,
+        action="store_true",
+        help="Fetch the repository object(s) only: log the estimated number "
+        "of requests per repository and the plan for fetching them, then "
+        "exit",
+    )
+
+    parser.add_argument(
+        "--cost-report-outpath",
+        default="",
+        metavar="PATH",
+        help="Write a JSON report about the HTTP requests of this run to this "
+        "file: requests, response bytes and latency per API endpoint, and the "
+        "request quota as reported by the API. Overwrite if file exists.",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        default=False,
+        action="store_true",
+        help="Update the stargazer and fork time series CSV files "
+        "incrementally: only fetch events newer than the ones already in the "
+        "files. Requires the state files (*.state.json) written by a previous "
+        "run next to the CSV files. Falls back to a full sync otherwise.",
+    )
+
+    parser.add_argument(
+        "--full-sync-every",
+        type=int,
+        default=0,
+        metavar="DAYS",
+        help="With --incremental: do a full sync if the last one is more than "
+        "DAYS days ago. This reconciles events not reflected by incremental "
+        "updates (e.g. removed stars). Default: 0 (never).",
     )
 
     args = parser.parse_args()
 
-    if "/" not in args.repo:
-        sys.exit("missing slash in REPOSITORY spec")
+    if [bool(args.repo), bool(args.repos_file), bool(args.org)].count(True) != 1:
+        sys.exit("specify one of REPOSITORY, --repos-file, --org")
 
-    ownerid, repoid = args.repo.split("/")
-    outdir_path_default = f"_ghrs_{ownerid}_{repoid}"
+    if args.repo and "/" not in args.repo:
+        sys.exit("missing slash in REPOSITORY spec")
 
     if not args.snapshot_directory:
-        args.snapshot_directory = outdir_path_default
+        args.snapshot_directory = "_ghrs_{owner}_{repo}"
+
+    if args.repos_file or args.org:
+        for p in (
+            args.snapshot_directory,
+            args.stargazer_ts_outpath,
+            args.fork_ts_outpath,
+            args.dedup_state_path,
+        ):
+            if p and "{repo}" not in p:
+                sys.exit(f"batch mode: output path must contain {{repo}}: {p}")
+
+    if args.daemon:
+        args.schedule = True
+
+    if args.org and not args.manifest_outpath:
+        args.manifest_outpath = f"_ghrs_{args.org}_manifest.json"
 
     log.info("processed args: %s", json.dumps(vars(args), indent=2))
+    return args
+
 
-    if os.path.exists(args.snapshot_directory):
-        if not os.path.isdir(args.snapshot_directory):
+def prepare_output_directory(path: str) -> None:
+    if os.path.exists(path):
+        if not os.path.isdir(path):
             log.error(
                 "the specified output directory path does not point to a directory: %s",
-                args.snapshot_directory,
+                path,
             )
             sys.exit(1)
 
-        log.info("output directory already exists: %s", args.snapshot_directory)
+        log.info("output directory already exists: %s", path)
 
     else:
-        log.info("create output directory: %s", args.snapshot_directory)
-        log.info("absolute path: %s", os.path.abspath(args.snapshot_directory))
+        log.info("create output directory: %s", path)
+        log.info("absolute path: %s", os.path.abspath(path))
         # If there is a race: do not error out.
-        os.makedirs(args.snapshot_directory, exist_ok=True)
-
-    return args
+        os.makedirs(path, exist_ok=True)
 
 
 def referrers_to_df(top_referrers) -> pd.DataFrame:
@@ -246,9 +1406,9 @@ def referrers_to_df(top_referrers) -> pd.DataFrame:
     series_views_unique = []
     series_views_total = []
     for p in top_referrers:
-        series_referrers.append(p.referrer)
-        series_views_total.append(int(p.count))
-        series_views_unique.append(int(p.uniques))
+        series_referrers.append(p["referrer"])
+        series_views_total.append(int(p["count"]))
+        series_views_unique.append(int(p["uniques"]))
 
     df = pd.DataFrame(
         data={
@@ -271,9 +1431,9 @@ def paths_to_df(top_paths) -> pd.DataFrame:
     series_views_unique = []
     series_views_total = []
     for p in top_paths:
-        series_url_paths.append(p.path)
-        series_views_total.append(int(p.count))
-        series_views_unique.append(int(p.uniques))
+        series_url_paths.append(p["path"])
+        series_views_total.append(int(p["count"]))
+        series_views_unique.append(int(p["uniques"]))
 
     df = pd.DataFrame(
         data={
@@ -300,11 +1460,13 @@ def clones_or_views_to_df(items, metric) -> pd.DataFrame:
     series_timestamps = []
 
     for sample in items:
-        # GitHub API docs say "Timestamps are aligned to UTC".
-        # `sample.timestamp` is a tz-naive datetime object.
-        series_timestamps.append(sample.timestamp)
-        series_count_total.append(int(sample.count))
-        series_count_unique.append(int(sample.uniques))
+        # GitHub API docs say "Timestamps are aligned to UTC". Parse into
+        # tz-naive datetime object, example: 2020-12-21T00:00:00Z
+        series_timestamps.append(
+            datetime.strptime(sample["timestamp"], "%Y-%m-%dT%H:%M:%SZ")
+        )
+        series_count_total.append(int(sample["count"]))
+        series_count_unique.append(int(sample["uniques"]))
 
     # Attach timezone information to `pd.DatetimeIndex` (make this index
     # tz-aware, leave actual numbers intact).
@@ -322,80 +1484,407 @@ def clones_or_views_to_df(items, metric) -> pd.DataFrame:
     return df
 
 
-def get_forks_over_time(repo: Repository.Repository) -> pd.DataFrame:
-    # TODO: for ~10k forks repositories, this operation is too costly for doing
-    # it as part of each analyzer invocation. Move this to the fetcher, and
-    # persist the data.
+def get_forks_over_time(
+    repo: Repository.Repository, journal: Optional["PageJournal"] = None
+) -> Tuple[pd.DataFrame, Optional[dict]]:
+    # Full sync. For ~10k forks repositories this operation is costly: use
+    # --incremental for building on the data persisted by a previous run.
+    # With `journal`: resume an interrupted full sync.
     log.info("fetch fork time series for repo %s", repo)
 
-    reqlimit_before = GHUB.get_rate_limit().core.remaining
-    log.info("GH request limit before operation: %s", reqlimit_before)
+    if EVENTS_API == "graphql":
+        # Cursor-based pagination: one page after another.
+        pages: Iterable[Tuple[array.array, ...]] = graphql_fork_pages(repo, journal)
+    else:
+        # Reduce each page to fork IDs and creation times right away, instead
+        # of keeping the (large) fork objects around. Oldest first: forks
+        # created in the meantime do not shift the pages of an interrupted
+        # fetch (see `PageJournal`).
+        pages = fetch_all_pages(
+            f"{repo.url}/forks",
+            rest_fork_page_arrays,
+            params={"sort": "oldest"},
+            journal=journal,
+        )
 
-    forks = []
-    for count, fork in enumerate(repo.get_forks(), 1):
-        # Store `PullRequest` object with integer key in dictionary.
-        forks.append(fork)
-        if count % 200 == 0:
-            log.info("%s forks fetched", count)
+    fork_ids = array.array("q")
+    forktimes = array.array("q")
+    for ids, times in pages:
+        fork_ids.extend(ids)
+        forktimes.extend(times)
+    log.info("current fork count: %s", len(forktimes))
 
-    reqlimit_after = GHUB.get_rate_limit().core.remaining
-    log.info("GH request limit after operation: %s", reqlimit_after)
-    log.info("http requests made (approximately): %s", reqlimit_before - reqlimit_after)
-    log.info("current fork count: %s", len(forks))
+    df = build_cumulative_df(forktimes, "forks_cumulative")
+    log.info("forks df: \n%s", df)
+    return df, fork_watermark(fork_ids, forktimes)
+
+
+def fork_watermark(
+    ids: Iterable[int], times: Iterable[int], prev: Optional[dict] = None
+) -> Optional[dict]:
+    """
+    Return the creation time (seconds since epoch) of the newest of the forks
+    `ids` (created at `times`), and the IDs of all forks created at that time
+    (usually one). Take the previous watermark `prev` into account. `None`
+    if there are no forks at all.
+
+    Unlike the IDs of all known forks, this is small: persist it in the sync
+    state, for the next incremental sync.
+    """
+    forks = list(zip(ids, times))
+    if prev is not None:
+        forks.extend((i, prev["created_at"]) for i in prev["ids"])
+    if not forks:
+        return None
+    newest = max(t for _, t in forks)
+    return {"created_at": newest, "ids": sorted({i for i, t in forks if t == newest})}
+
+
+def get_forks_over_time_incremental(
+    repo: Repository.Repository, df_prev: pd.DataFrame, watermark: Optional[dict]
+) -> Tuple[pd.DataFrame, Optional[dict]]:
+    log.info("fetch new forks for repo %s (incremental)", repo)
+
+    # Request the fork list newest-first. Fetch one page after another, and
+    # stop at the first fork older than the newest known one (`watermark`).
+    # Forks created at the same time as the newest known one are new unless
+    # their ID is known.
+    if EVENTS_API == "graphql":
+        pages: Iterator[Tuple[array.array, array.array]] = graphql_fork_pages(repo)
+    else:
+        pages = rest_fork_pages_newest_first(repo)
+
+    new_ids = array.array("q")
+    new_forktimes = array.array("q")
+    hit_known_fork = False
+    for ids, times in pages:
+        for fork_id, t in zip(ids, times):
+            if watermark is not None:
+                if t < watermark["created_at"]:
+                    log.info("hit fork older than the newest known one, stop")
+                    hit_known_fork = True
+                    break
+                if t == watermark["created_at"] and fork_id in watermark["ids"]:
+                    continue
+            new_ids.append(fork_id)
+            new_forktimes.append(t)
+
+        if hit_known_fork:
+            break
+
+    log.info("new forks: %s", len(new_ids))
+
+    df = build_cumulative_df(
+        np.concatenate([index_to_epochs(df_prev.index), new_forktimes]),
+        "forks_cumulative",
+    )
 
-    # The GitHub API returns ISO 8601 timestamp strings encoding the timezone
-    # via the Z suffix, i.e. Zulu time, i.e. UTC. pygithub doesn't parse that
-    # timezone. That is, whereas the API returns `starred_at` in UTC, the
-    # datetime obj created by pygithub is a naive one. Correct for that.
-    forktimes_aware = [pytz.timezone("UTC").localize(f.created_at) for f in forks]
+    if len(df) != repo.forks_count:
+        # For example, deleted forks are not seen by the incremental sync.
+        # Also see --full-sync-every.
+        log.warning(
+            "event count (%s) differs from current fork count (%s)",
+            len(df),
+            repo.forks_count,
+        )
 
-    # Create sorted pandas DatetimeIndex
-    dtidx = pd.to_datetime(forktimes_aware)
-    dtidx = dtidx.sort_values()
+    log.info("forks df: \n%s", df)
+    return df, fork_watermark(new_ids, new_forktimes, watermark)
 
-    # Each timestamp corresponds to *1* fork event. Build cumulative sum over
-    # time.
-    df = pd.DataFrame(
-        data={"fork_events": [1] * len(forks)},
-        index=dtidx,
+
+def rest_fork_page_arrays(items: list) -> Tuple[array.array, array.array]:
+    return array.array("q", (f["id"] for f in items)), epochs_from_items(
+        items, "created_at"
+    )
+
+
+def rest_fork_pages_newest_first(
+    repo: Repository.Repository,
+) -> Iterator[Tuple[array.array, array.array]]:
+    page = 1
+    while True:
+        items = fetch_page(f"{repo.url}/forks", page, {"sort": "newest"}).json()
+        yield rest_fork_page_arrays(items)
+        if len(items) < PER_PAGE:
+            # Last page.
+            return
+        page += 1
+
+
+def graphql_fork_pages(
+    repo: Repository.Repository, journal: Optional["PageJournal"] = None
+) -> Iterator[Tuple[array.array, ...]]:
+    # Newest first. `databaseId` is the ID used by the REST API: the fork IDs
+    # in the sync state do not depend on --events-api.
+    return graphql_pages(
+        GRAPHQL_FORKS_QUERY,
+        repo,
+        lambda nodes: (
+            array.array("q", (n["databaseId"] for n in nodes)),
+            array.array("q", (parse_api_timestamp(n["createdAt"]) for n in nodes)),
+        ),
+        journal,
+    )
+
+
+def sync_state_path(event_log_path: str) -> str:
+    # stars-raw.csv -> stars-raw.state.json
+    return os.path.splitext(event_log_path)[0] + ".state.json"
+
+
+def read_sync_state(path: str) -> dict:
+    if not os.path.exists(path):
+        log.info("sync state file does not exist (yet): %s", path)
+        return {}
+
+    log.info("read sync state from %s", path)
+    with open(path, "rb") as f:
+        return json.loads(f.read().decode("utf-8"))
+
+
+def write_sync_state(path: str, state: dict) -> None:
+    log.info("write sync state to %s: %s", path, state)
+    # Pragmatic strategy against partial write / encoding problems.
+    tpath = path + ".tmp"
+    with open(tpath, "wb") as f:
+        f.write(json.dumps(state, indent=2).encode("utf-8"))
+    os.rename(tpath, path)
+
+
+def write_event_log(path: str, df: pd.DataFrame) -> None:
+    if eventstore.is_store_path(path):
+        # Appends the new events only (if the previous ones are unchanged).
+        eventstore.write_events(path, index_to_epochs(df.index))
+        return
+
+    tpath = path + ".tmp"  # todo: rnd string
+    log.info("write event log to %s, then rename to %s", tpath, path)
+    df.to_csv(tpath, index_label="time_iso8601")
+    os.rename(tpath, path)
+
+
+def full_sync_due(state: dict, full_sync_every: int) -> bool:
+    if "last_full_sync" not in state:
+        log.info("no full sync recorded in sync state -- do full sync")
+        return True
+
+    last_full_sync = datetime.fromisoformat(state["last_full_sync"])
+    if full_sync_every and NOW - last_full_sync > timedelta(days=full_sync_every):
+        log.info(
+            "last full sync at %s is more than %s days ago -- do full sync",
+            last_full_sync,
+            full_sync_every,
+        )
+        return True
+
+    return False
+
+
+def event_log_up_to_date(
+    path: str, state: dict, api_count: int, full_sync_every: int
+) -> bool:
+    """
+    Cheap change detection, without a single request to the stargazer/fork
+    list: compare the count in the repository object (`stargazers_count`,
+    `forks_count`) with the count recorded in the sync state by the previous
+    sync. This is the count reported by the API, not the number of events in
+    the log: the two differ, e.g. for stargazers whose account was deleted.
+
+    An unstar plus a new star in between two runs go unnoticed: the periodic
+    full sync takes care of that.
+    """
+    if state.get("api_count") != api_count:
+        log.info("count changed: %s -> %s", state.get("api_count"), api_count)
+        return False
+
+    if not os.path.exists(path):
+        log.info("event log does not exist (yet): %s", path)
+        return False
+
+    return not full_sync_due(state, full_sync_every)
+
+
+def estimate_sync_requests(
+    count: int, path: str, kind: str, args: argparse.Namespace
+) -> Tuple[int, str]:
+    """
+    Estimate the number of requests for syncing the star or fork (`kind`)
+    event log at `path`, for `count` events. Return the estimate and the kind
+    of sync (full, incremental, unchanged). This decides based on the sync
+    state like `fetch_and_write_stargazer_ts()` and
+    `fetch_and_write_fork_ts()` do, without reading the event log.
+    """
+    if not path:
+        return 0, "not requested"
+
+    full = max(1, math.ceil(count / PER_PAGE))
+    if not args.incremental:
+        return full, "full"
+
+    state = read_sync_state(sync_state_path(path))
+    if event_log_up_to_date(path, state, count, args.full_sync_every):
+        return 0, "unchanged"
+
+    if (
+        not os.path.exists(path)
+        or full_sync_due(state, args.full_sync_every)
+        or "api_count" not in state
+        or (kind == "forks" and "fork_watermark" not in state)
+    ):
+        return full, "full"
+
+    # Newest first: the pages holding the new events, plus the page holding
+    # the first known one.
+    return 1 + max(0, count - state["api_count"]) // PER_PAGE, "incremental"
+
+
+def read_event_log(
+    path: str, column: str, state: dict, full_sync_every: int
+) -> Optional[pd.DataFrame]:
+    """
+    Read the event log written by a previous run, as the basis for an
+    incremental sync. Return `None` if a full sync is required instead.
+    """
+    if not os.path.exists(path):
+        log.info("event log does not exist (yet): %s -- do full sync", path)
+        return None
+
+    if full_sync_due(state, full_sync_every):
+        return None
+
+    last_full_sync = datetime.fromisoformat(state["last_full_sync"])
+
+    log.info("read event log for incremental sync: %s", path)
+    if eventstore.is_store_path(path):
+        try:
+            df = eventstore.read_dataframe(path, column)
+        except eventstore.EventStoreError as e:
+            log.warning("cannot read event store %s: %s -- do full sync", path, e)
+            return None
+    else:
+        df = pd.read_csv(
+            path,
+            index_col=["time_iso8601"],
+            date_parser=lambda col: pd.to_datetime(col, utc=True),
+        )
+        df.index.rename("time", inplace=True)
+
+    # The event log and the state file are written in two steps. Make sure
+    # they belong together (e.g. the CSV file was not replaced by someone).
+    last_event_time = df.index[-1].isoformat() if len(df) else None
+    if (
+        len(df) != state.get("event_count")
+        or last_event_time != state.get("last_event_time")
+        or column not in df.columns
+    ):
+        log.warning("event log and sync state are inconsistent -- do full sync")
+        return None
+
+    log.info(
+        "event log has %s events, last one at %s (last full sync: %s)",
+        len(df),
+        last_event_time,
+        last_full_sync,
     )
-    df.index.name = "time"
-    df["forks_cumulative"] = df["fork_events"].cumsum()
-    df = df.drop(columns=["fork_events"]).astype(int)
-    log.info("forks df: \n%s", df)
     return df
 
 
-def get_stars_over_time(repo: Repository.Repository) -> pd.DataFrame:
-    # TODO: for ~10k stars repositories, this operation is too costly for doing
-    # it as part of each analyzer invocation. Move this to the fetcher, and
-    # persist the data.
-    log.info("fetch stargazer time series for repo %s", repo)
+def build_cumulative_df(epochs, column: str) -> pd.DataFrame:
+    """
+    Build event log from unix timestamps (seconds, int64 sequence in any
+    order, e.g. `array.array("q")`). Each timestamp corresponds to *1*
+    event: after sorting, the cumulative count is the position in the
+    sequence.
+    """
+    epochs = np.sort(np.asarray(epochs, dtype=np.int64))
+    dtidx = pd.DatetimeIndex(pd.to_datetime(epochs, unit="s", utc=True), name="time")
+    return pd.DataFrame(
+        data={column: np.arange(1, len(epochs) + 1, dtype=np.int64)}, index=dtidx
+    )
 
-    reqlimit_before = GHUB.get_rate_limit().core.remaining
 
-    log.info("GH request limit before fetch operation: %s", reqlimit_before)
+def index_to_epochs(dtidx: pd.DatetimeIndex) -> np.ndarray:
+    # Inverse of what `build_cumulative_df()` does with the timestamps.
+    return dtidx.asi8 // 10**9
 
-    gazers = []
 
-    # TODO for addressing the 10ks challenge: save state to disk, and refresh
-    # using reverse order iteration. See for repo in user.get_repos().reversed
-    for count, gazer in enumerate(repo.get_stargazers_with_dates(), 1):
-        # Store `PullRequest` object with integer key in dictionary.
-        gazers.append(gazer)
-        if count % 200 == 0:
-            log.info("%s gazers fetched", count)
+def get_stars_over_time_incremental(
+    repo: Repository.Repository, df_prev: pd.DataFrame
+) -> pd.DataFrame:
+    log.info("fetch new stargazers for repo %s (incremental)", repo)
 
-    reqlimit_after = GHUB.get_rate_limit().core.remaining
-    log.info("GH request limit after fetch operation: %s", reqlimit_after)
-    log.info("http requests made (approximately): %s", reqlimit_before - reqlimit_after)
-    log.info("stargazer count: %s", len(gazers))
+    # Walk the stargazer list newest first. Stop at the first page which
+    # reaches back beyond the newest known event. Typically, that is the
+    # first page itself: one HTTP request instead of
+    # `stargazers_count / PER_PAGE` requests.
+    prev_epochs = index_to_epochs(df_prev.index)
+    last = int(prev_epochs[-1]) if len(prev_epochs) else None
+    n_known_at_last = int((prev_epochs == last).sum()) if last is not None else 0
 
-    # The GitHub API returns ISO 8601 timestamp strings encoding the timezone
-    # via the Z suffix, i.e. Zulu time, i.e. UTC. pygithub doesn't parze that
-    # timezone. That is, whereas the API returns `starred_at` in UTC, the
-    # datetime obj created by pygithub is a naive one. Correct for that.
-    startimes_aware = [pytz.timezone("UTC").localize(g.starred_at) for g in gazers]
+    if stargazers_events_api(repo) == "graphql":
+        pages: Iterator[array.array] = graphql_stargazer_pages(repo)
+    else:
+        pages = rest_stargazer_pages_newest_first(repo)
+
+    new_times = array.array("q")
+    n_seen_at_last = 0
+    for page_times in pages:
+        new_times.extend(t for t in page_times if last is None or t > last)
+        n_seen_at_last += sum(1 for t in page_times if t == last)
+
+        if last is not None and page_times and min(page_times) < last:
+            break
+
+    # More than one star event may have the same timestamp (second
+    # resolution). Those with the timestamp of the newest known event are
+    # new if there are more of them than known before.
+    if n_seen_at_last > n_known_at_last:
+        new_times.extend([last] * (n_seen_at_last - n_known_at_last))
+
+    log.info("new stargazers: %s", len(new_times))
+
+    df = build_cumulative_df(
+        np.concatenate([prev_epochs, new_times]), "stars_cumulative"
+    )
+
+    if len(df) != repo.stargazers_count:
+        # For example, star removals are not seen by the incremental sync.
+        # Also see --full-sync-every.
+        log.warning(
+            "event count (%s) differs from current stargazer count (%s)",
+            len(df),
+            repo.stargazers_count,
+        )
+
+    log.info("stargazer df\n %s", df)
+    return df
+
+
+def get_stars_over_time(
+    repo: Repository.Repository, journal: Optional["PageJournal"] = None
+) -> pd.DataFrame:
+    # Full sync. For ~10k stars repositories this operation is costly: use
+    # --incremental for building on the data persisted by a previous run.
+    # With `journal`: resume an interrupted full sync.
+    log.info("fetch stargazer time series for repo %s", repo)
+
+    if stargazers_events_api(repo) == "graphql":
+        # Cursor-based pagination: one page after another.
+        pages: Iterable[Tuple[array.array, ...]] = graphql_pages(
+            GRAPHQL_STARGAZERS_QUERY, repo, graphql_stargazer_page_arrays, journal
+        )
+    else:
+        pages = fetch_all_pages(
+            f"{repo.url}/stargazers",
+            lambda items: (epochs_from_items(items, "starred_at"),),
+            accept=STARGAZER_MEDIA_TYPE,
+            journal=journal,
+        )
+
+    startimes = array.array("q")
+    for (page_times,) in pages:
+        startimes.extend(page_times)
+    log.info("stargazer count: %s", len(startimes))
 
     # Work towards a dataframe of the following shape:
     #                            star_events  stars_cumulative
@@ -412,75 +1901,1081 @@ def get_stars_over_time(repo: Repository.Repository) -> pd.DataFrame:
     # 2020-12-25 05:01:42+00:00            1               330
     # 2020-12-28 01:07:55+00:00            1               331
 
-    # Create sorted pandas DatetimeIndex
-    dtidx = pd.to_datetime(startimes_aware)
-    dtidx = dtidx.sort_values()
+    df = build_cumulative_df(startimes, "stars_cumulative")
+    log.info("stargazer df\n %s", df)
+    return df
 
-    # Each timestamp corresponds to *1* star event. Build cumulative sum over
-    # time.
-    df = pd.DataFrame(
-        data={"star_events": [1] * len(gazers)},
-        index=dtidx,
+
+def stargazers_events_api(repo: Repository.Repository) -> str:
+    # With more than REST_STARGAZERS_MAX_PAGES pages, the newest stargazers
+    # are not accessible via the REST API at all (neither in a full walk nor
+    # newest-first): use the GraphQL API (no such limit) instead.
+    n_pages = math.ceil(repo.stargazers_count / PER_PAGE)
+    if EVENTS_API == "rest" and n_pages > REST_STARGAZERS_MAX_PAGES:
+        log.info(
+            "stargazer pages: %s, REST API serves %s only: use GraphQL API",
+            n_pages,
+            REST_STARGAZERS_MAX_PAGES,
+        )
+        return "graphql"
+    return EVENTS_API
+
+
+def rest_stargazer_pages_newest_first(
+    repo: Repository.Repository,
+) -> Iterator[array.array]:
+    # The REST stargazer list is ordered by time of starring, oldest first:
+    # walk the pages in reverse order, starting with the last one.
+    # `stargazers_count` is part of the repo object, no extra request. Never
+    # start beyond the last page served (see `stargazers_events_api()`).
+    n_pages = min(
+        math.ceil(repo.stargazers_count / PER_PAGE), REST_STARGAZERS_MAX_PAGES
     )
-    df.index.name = "time"
+    log.info("stargazer count: %s, pages: %s", repo.stargazers_count, n_pages)
+
+    for page in reversed(range(1, n_pages + 1)):
+        log.info("fetch stargazer page %s", page)
+        yield epochs_from_items(
+            fetch_page(
+                f"{repo.url}/stargazers", page, accept=STARGAZER_MEDIA_TYPE
+            ).json(),
+            "starred_at",
+        )
 
-    df["stars_cumulative"] = df["star_events"].cumsum()
-    df = df.drop(columns=["star_events"]).astype(int)
-    log.info("stargazer df\n %s", df)
-    return df
 
+def graphql_stargazer_page_arrays(edges: list) -> Tuple[array.array]:
+    return (array.array("q", (parse_api_timestamp(e["starredAt"]) for e in edges)),)
+
+
+def graphql_stargazer_pages(repo: Repository.Repository) -> Iterator[array.array]:
+    # Newest first.
+    for (page_times,) in graphql_pages(
+        GRAPHQL_STARGAZERS_QUERY, repo, graphql_stargazer_page_arrays
+    ):
+        yield page_times
+
+
+def graphql_pages(
+    query: str,
+    repo: Repository.Repository,
+    transform: Callable[[list], Tuple[array.array, ...]],
+    journal: Optional["PageJournal"] = None,
+) -> Iterator[Tuple[array.array, ...]]:
+    """
+    Cursor-based pagination through a connection of the repository object:
+    `query` must select it as `conn`, its `pageInfo` (`hasNextPage`,
+    `endCursor`), and the list of edges or nodes as `items`. Yield
+    `transform(items)` per page. The next page is requested only when the
+    consumer asks for it.
+
+    With `journal`: take pages (and the cursor for the next one) from there
+    if present, record fetched pages.
+    """
+    owner, name = repo.full_name.split("/")
+    cursor = None
+    page = 0
+    while True:
+        page += 1
+        rec = journal.get(page) if journal is not None else None
+        if rec is None:
+            log.info("fetch GraphQL page %s (%s)", page, repo.full_name)
+            conn = api_graphql(
+                query,
+                {"owner": owner, "name": name, "perPage": PER_PAGE, "cursor": cursor},
+            )["repository"]["conn"]
+            rec = {
+                "columns": transform(conn["items"]),
+                "cursor": conn["pageInfo"]["endCursor"],
+                "last": not conn["pageInfo"]["hasNextPage"],
+            }
+            if journal is not None:
+                journal.add(
+                    page, rec["columns"], cursor=rec["cursor"], last=rec["last"]
+                )
+
+        yield rec["columns"]
+        if rec["last"]:
+            return
+        cursor = rec["cursor"]
+
+
+def journal_path(event_log_path: str) -> str:
+    # stars-raw.csv -> stars-raw.journal
+    return os.path.splitext(event_log_path)[0] + ".journal"
+
+
+class PageJournal:
+    """
+    Checkpoint file for a full sync of a paginated list: the (transformed)
+    content of each page is appended as one JSON line as soon as the page
+    has been fetched, in any order. When the process dies (killed runner,
+    crash, interrupted while waiting for the quota reset), the journal stays
+    behind, and the next full sync of the same list resumes from it: pages
+    already fetched are not requested again. Removed after success.
+
+    The first line identifies the list (`key`, page size) and the time the
+    journal was created. A journal for a different list, or an old one, is
+    discarded: pages shift when stars or forks are removed.
+
+    Use as context manager: the file is closed upon leaving the context (also
+    if the sync failed). `remove()` after success.
+    """
+
+    MAX_AGE = timedelta(days=2)
+
+    def __init__(self, path: str, key: str):
+        self.path = path
+        self.key = key
+        self._lock = threading.Lock()
+        self._pages: Dict[int, dict] = {}
+        header = {"key": key, "per_page": PER_PAGE, "created": NOW.isoformat()}
+
+        old_header = self._load()
+        if old_header is not None:
+            header["created"] = old_header["created"]
+
+        # Rewrite the file: the last line may be incomplete (process killed
+        # while writing it). Start a new file with a new header if the old
+        # one was discarded.
+        tpath = path + ".tmp"
+        with open(tpath, "wb") as f:
+            for rec in [header] + [self._encode(p, r) for p, r in self._pages.items()]:
+                f.write(json.dumps(rec).encode("utf-8") + b"\n")
+        os.rename(tpath, path)
+        self._f = open(path, "ab")
+
+    def _load(self) -> Optional[dict]:
+        if not os.path.exists(self.path):
+            return None
+
+        with open(self.path, "rb") as f:
+            lines = f.read().decode("utf-8").splitlines()
+
+        try:
+            header = json.loads(lines[0])
+            created = datetime.fromisoformat(header["created"])
+        except (IndexError, KeyError, ValueError) as e:
+            log.warning("discard bad journal %s: %s", self.path, e)
+            return None
+
+        if header.get("key") != self.key or header.get("per_page") != PER_PAGE:
+            log.info("discard journal %s: for different list", self.path)
+            return None
+
+        if NOW - created > self.MAX_AGE:
+            log.info("discard journal %s: created at %s", self.path, created)
+            return None
+
+        for line in lines[1:]:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                log.info("journal %s: ignore incomplete line", self.path)
+                break
+            page = rec.pop("page")
+            self._pages[page] = {
+                **rec,
+                "columns": tuple(array.array("q", c) for c in rec["columns"]),
+            }
+
+        log.info(
+            "resume from journal %s (created at %s): %s pages",
+            self.path,
+            created,
+            len(self._pages),
+        )
+        return header
+
+    @staticmethod
+    def _encode(page: int, rec: dict) -> dict:
+        return {
+            "page": page,
+            **rec,
+            "columns": [c.tolist() for c in rec["columns"]],
+        }
+
+    def get(self, page: int) -> Optional[dict]:
+        """
+        Return the record for `page` (`columns`, plus what has been passed to
+        `add()` as keyword arguments), or `None`.
+        """
+        return self._pages.get(page)
+
+    def add(self, page: int, columns: Tuple[array.array, ...], **extra) -> None:
+        rec = {"columns": columns, **extra}
+        line = json.dumps(self._encode(page, rec)).encode("utf-8") + b"\n"
+        with self._lock:
+            # Flush, but do not fsync: surviving the process is what matters.
+            self._f.write(line)
+            self._f.flush()
+            self._pages[page] = rec
+
+    def close(self) -> None:
+        self._f.close()
+
+    def __enter__(self) -> "PageJournal":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def remove(self) -> None:
+        self.close()
+        log.info("remove journal %s", self.path)
+        os.unlink(self.path)
+
+
+class RequestScheduler:
+    """
+    Decide when the next HTTP request may be issued, based on the rate limit
+    information in the headers of every response (`X-RateLimit-Remaining`,
+    `X-RateLimit-Reset`, `Retry-After`). One instance is shared by all
+    threads.
+
+    - Quota exhausted: hold back all requests until the quota reset time.
+    - Quota low: spread the remaining requests evenly across the time left
+      until the quota reset, instead of running into the limit.
+    - `Retry-After` (secondary rate limit): hold back all requests for
+      exactly that long.
+    """
+
+    # Start pacing requests when fewer than this many are left in the
+    # current rate limit window.
+    PACING_THRESHOLD = 100
+
+    def __init__(self, clock=time.time, sleep=time.sleep, resource: str = "core"):
+        # Rate limit resource (as in the `X-RateLimit-Resource` header).
+        self.resource = resource
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._remaining: Optional[int] = None
+        self._reset: Optional[float] = None
+        # Earliest point in time (unix time) for issuing the next request.
+        self._next_slot = 0.0
+
+    def wait(self) -> None:
+        """
+        Block until a request may be issued, and account for that request.
+        """
+        with self._lock:
+            now = self._clock()
+            slot = max(now, self._next_slot)
+            interval = 0.0
+
+            if self._reset is not None and now >= self._reset:
+                # New rate limit window. The next response tells the quota.
+                self._remaining = None
+                self._reset = None
+
+            if self._remaining is not None and self._reset is not None:
+                if self._remaining <= 0:
+                    # Add a second as tolerance for clock skew.
+                    slot = max(slot, self._reset + 1)
+                    log.warning(
+                        "request quota exhausted, wait until %s (%.0f s)",
+                        datetime.fromtimestamp(slot).strftime("%Y-%m-%d %H:%M:%S"),
+                        slot - now,
+                    )
+                    self._remaining = None
+                    self._reset = None
+                elif self._remaining < self.PACING_THRESHOLD:
+                    interval = max(0.0, self._reset - slot) / self._remaining
+                    self._remaining -= 1
+                else:
+                    self._remaining -= 1
+
+            self._next_slot = slot + interval
+
+        delay = slot - now
+        if delay > 0:
+            if delay > 1:
+                log.info("rate limit: wait %.1f s before next request", delay)
+            self._sleep(delay)
+
+    def quota(self) -> Tuple[Optional[int], Optional[float]]:
+        """
+        Return the number of requests left in the current rate limit window,
+        and its reset time (`None`: not known).
+        """
+        with self._lock:
+            if self._reset is not None and self._clock() >= self._reset:
+                return None, None
+            return self._remaining, self._reset
+
+    def record_response(self, resp: requests.Response) -> None:
+        h = resp.headers
+        with self._lock:
+            if "X-RateLimit-Remaining" in h and "X-RateLimit-Reset" in h:
+                remaining = int(h["X-RateLimit-Remaining"])
+                reset = float(h["X-RateLimit-Reset"])
+                # Responses to concurrent requests may arrive out of order.
+                # Within the same window, the quota only ever decreases.
+                if reset == self._reset and self._remaining is not None:
+                    remaining = min(remaining, self._remaining)
+                self._remaining, self._reset = remaining, reset
+
+            if "Retry-After" in h:
+                self._next_slot = max(
+                    self._next_slot, self._clock() + float(h["Retry-After"])
+                )
+
+    def retry_delay(self, resp: requests.Response, attempt: int) -> Optional[float]:
+        """
+        For a non-2xx response: return the number of seconds to wait before
+        retrying (in addition to what `wait()` imposes), or `None` if the
+        request must not be retried.
+        """
+        text = resp.text
+
+        if resp.status_code in (403, 429):
+            if "Retry-After" in resp.headers:
+                # Already taken care of by `record_response()`.
+                log.warning("got Retry-After: %s s", resp.headers["Retry-After"])
+                return 0.0
+
+            if resp.headers.get("X-RateLimit-Remaining") == "0":
+                # `wait()` sleeps until the reset time.
+                log.warning("request quota exhausted")
+                return 0.0
+
+            # Any other 403 is a permanent error unless the message says
+            # otherwise ("Must have push access to repository", "Resource not
+            # accessible by integration", ...).
+            try:
+                message = str(resp.json().get("message", ""))
+            except (ValueError, AttributeError):
+                message = text
+            if resp.status_code == 403 and not re.search(
+                r"rate limit|abuse", message, re.IGNORECASE
+            ):
+                log.error(
+                    'this appears to be a permanent error, as in "access denied -- do not retry": %s',
+                    text,
+                )
+                return None
+
+            # Secondary rate limit w/o Retry-After header ("You have exceeded
+            # a secondary rate limit", "wait a few minutes before you try
+            # again", or the older "You have triggered an abuse detection
+            # mechanism"). The docs say: wait at least one minute, then back
+            # off exponentially.
+            delay = max(60.0, backoff_delay(attempt))
+            log.warning(
+                "%s response, retry in %.1f s: %s", resp.status_code, delay, text
+            )
+            return delay
+
+        if resp.status_code >= 500:
+            delay = backoff_delay(attempt)
+            log.warning(
+                "%s response, retry in %.1f s: %s", resp.status_code, delay, text
+            )
+            return delay
+
+        return None
+
+
+class Credential:
+    """
+    An API token, along with the state of its request quota: one
+    `RequestScheduler` per rate limit resource (the GraphQL API has a
+    separate quota).
+    """
+
+    def __init__(self, name: str, token: Optional[str] = None):
+        # For log messages. Never the token itself.
+        self.name = name
+        self._token = token
+        # For keying cached responses. Derived from, but not revealing, the
+        # token.
+        self.identity = (
+            "token:" + hashlib.sha256(token.encode("utf-8")).hexdigest()[:16]
+            if token
+            else name
+        )
+        self.schedulers = {r: RequestScheduler(resource=r) for r in ("core", "graphql")}
+        self.requests = 0
+
+    def token(self) -> Optional[str]:
+        return self._token
 
-def handle_rate_limit_error(exc):
 
-    if "wait a few minutes before you try again" in str(exc):
-        log.warning("GitHub abuse mechanism triggered, wait 60 s, retry")
-        return True
+class AppInstallationCredential(Credential):
+    """
+    GitHub App installation: the token is minted via the API (authenticated
+    with a JWT signed by the App's private key) and expires after one hour.
+    The request quota is the one of the installation (up to 15000 requests
+    per hour), which survives token renewal: the schedulers are kept.
 
-    if "403" in str(exc):
-        if "Resource not accessible by integration" in str(exc):
-            log.error(
-                'this appears to be a permanent error, as in "access denied -- do not retry": %s',
-                str(exc),
+    Signing the JWT (RS256) requires the `cryptography` package.
+    """
+
+    # Renew the token when it expires in less than this.
+    RENEW_MARGIN_SECONDS = 300
+
+    def __init__(self, app_id: str, private_key: str, installation_id: int):
+        super().__init__(f"app {app_id} installation {installation_id}")
+        # The token changes upon renewal, the installation does not.
+        self.identity = f"app:{app_id}:{installation_id}"
+        self._integration = GithubIntegration(
+            app_id, private_key, base_url=GITHUB_API_BASE_URL
+        )
+        self._installation_id = installation_id
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def token(self) -> Optional[str]:
+        with self._lock:
+            if time.time() > self._expires_at - self.RENEW_MARGIN_SECONDS:
+                auth = self._integration.get_access_token(self._installation_id)
+                self._token = auth.token
+                # Naive datetime object, UTC.
+                self._expires_at = calendar.timegm(auth.expires_at.timetuple())
+                log.info("%s: new token, expires at %s", self.name, auth.expires_at)
+            return self._token
+
+
+class TokenPool:
+    """
+    The credentials used for issuing requests. Each request is issued with
+    the credential that has the most quota left for its rate limit resource
+    (with an unknown quota, i.e. before the first response, counting as
+    unlimited). If the quota of all of them is exhausted, pick the one whose
+    quota is reset first: its scheduler then waits for the reset.
+    """
+
+    def __init__(self, credentials: List[Credential]):
+        self.credentials = credentials
+        self._lock = threading.Lock()
+
+    def acquire(self, resource: str) -> Credential:
+        def key(c):
+            # Ties (e.g. concurrent requests before the first response): the
+            # credential used least so far.
+            remaining, reset = c.schedulers[resource].quota()
+            if remaining is None:
+                return (1, math.inf, -c.requests)
+            if remaining > 0:
+                return (1, remaining, -c.requests)
+            return (0, -reset, -c.requests)
+
+        with self._lock:
+            c = max(self.credentials, key=key)
+            c.requests += 1
+        return c
+
+    def remaining(self, resource: str) -> Optional[int]:
+        # Sum across credentials with a known quota (`None`: none known).
+        quotas = [c.schedulers[resource].quota()[0] for c in self.credentials]
+        known = [r for r in quotas if r is not None]
+        return sum(known) if known else None
+
+    def summary(self) -> str:
+        parts = []
+        for c in self.credentials:
+            remaining, _ = c.schedulers["core"].quota()
+            parts.append(f"{c.name}: {c.requests} requests, {remaining} remaining")
+        return "; ".join(parts)
+
+
+def token_pool_from_env() -> TokenPool:
+    """
+    GHRS_GITHUB_API_TOKEN: API token. GHRS_GITHUB_API_TOKENS: additional
+    tokens (comma-separated), each with its own request quota.
+
+    GitHub App: GHRS_GITHUB_APP_ID, GHRS_GITHUB_APP_PRIVATE_KEY_PATH (PEM
+    file) and GHRS_GITHUB_APP_INSTALLATION_IDS (comma-separated).
+    """
+    tokens = [os.environ.get("GHRS_GITHUB_API_TOKEN", "").strip()]
+    tokens += os.environ.get("GHRS_GITHUB_API_TOKENS", "").split(",")
+    credentials: List[Credential] = [
+        Credential(f"token {i}", t.strip())
+        for i, t in enumerate((t for t in tokens if t.strip()), 1)
+    ]
+
+    app_id = os.environ.get("GHRS_GITHUB_APP_ID", "").strip()
+    if app_id:
+        with open(os.environ["GHRS_GITHUB_APP_PRIVATE_KEY_PATH"], "rb") as f:
+            private_key = f.read().decode("utf-8")
+        for iid in os.environ["GHRS_GITHUB_APP_INSTALLATION_IDS"].split(","):
+            credentials.append(AppInstallationCredential(app_id, private_key, int(iid)))
+
+    if not credentials:
+        sys.exit("error: environment variable GHRS_GITHUB_API_TOKEN empty or not set")
+
+    log.info("API credentials: %s", ", ".join(c.name for c in credentials))
+    return TokenPool(credentials)
+
+
+# Replaced in main(). Unauthenticated requests.
+TOKEN_POOL = TokenPool([Credential("anonymous")])
+
+
+class ResponseCache:
+    """
+    On-disk cache for GET responses, keyed by URL, query parameters, media
+    type and credential (`Credential.identity`: the same resource may look
+    different to another credential). Only responses carrying an `ETag` or
+    `Last-Modified` header are stored (one JSON file per response). These
+    validators are sent along with the next request for the same resource
+    (`If-None-Match`, `If-Modified-Since`). Upon `304 Not Modified` the cached
+    body is used.
+
+    GitHub does not count 304 responses against the rate limit, i.e. pages
+    which do not change (e.g. old stargazers) cost nothing.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.lookups = 0
+        self.hits = 0
+        log.info("HTTP cache directory: %s", directory)
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(
+        self, url: str, params: Optional[dict], accept: Optional[str], identity: str
+    ) -> str:
+        key = json.dumps([url, sorted((params or {}).items()), accept, identity])
+        return os.path.join(
+            self.directory, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json"
+        )
+
+    def get(
+        self, url: str, params: Optional[dict], accept: Optional[str], identity: str
+    ) -> Optional[dict]:
+        self.lookups += 1
+        path = self._path(url, params, accept, identity)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                return json.loads(f.read().decode("utf-8"))
+        except ValueError as e:
+            log.warning("ignore bad cache file %s: %s", path, e)
+            return None
+
+    def put(
+        self,
+        url: str,
+        params: Optional[dict],
+        accept: Optional[str],
+        identity: str,
+        resp: requests.Response,
+    ) -> None:
+        entry = {
+            "url": resp.url,
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+            # The `Link` header is needed for pagination.
+            "link": resp.headers.get("Link"),
+            "body": resp.text,
+        }
+        path = self._path(url, params, accept, identity)
+        # Unique temp file name: the same resource may be fetched from more
+        # than one thread.
+        tpath = f"{path}.{threading.get_ident()}.tmp"
+        with open(tpath, "wb") as f:
+            f.write(json.dumps(entry).encode("utf-8"))
+        os.replace(tpath, path)
+
+    @staticmethod
+    def conditional_headers(entry: dict) -> dict:
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def response_from_entry(self, entry: dict) -> requests.Response:
+        # Build a response object equivalent to the original 200 response, as
+        # far as callers of `api_get()` are concerned (`json()`, `links`).
+        self.hits += 1
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.url = entry["url"]
+        resp.encoding = "utf-8"
+        resp._content = entry["body"].encode("utf-8")
+        if entry.get("link"):
+            resp.headers["Link"] = entry["link"]
+        return resp
+
+
+class RequestAccounting:
+    """
+    Per-run bookkeeping of all HTTP requests issued by `api_get()`: number of
+    requests, response body bytes and latency, per API endpoint. Also keeps
+    track of the request quota as reported by the `X-RateLimit-*` headers of
+    the responses, so that no separate `/rate_limit` request is needed. One
+    instance is shared by all threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._t_start = time.monotonic()
+        self.endpoints: Dict[str, dict] = {}
+        # Quota as reported by the first and by the most recent response, per
+        # rate limit resource (`core`, `graphql`).
+        self.quota_first: Dict[str, dict] = {}
+        self.quota_last: Dict[str, dict] = {}
+        # Per repository (batch mode): requests, bytes, seconds.
+        self.repos: Dict[str, dict] = {}
+
+    @staticmethod
+    def endpoint_path(url: str) -> str:
+        # Path relative to the API base URL, query parameters dropped. Lower
+        # case: owner and repository names are case-insensitive (one bucket
+        # for `Owner/Repo` and `owner/repo`).
+        path = urlparse(url).path
+        base_path = urlparse(GITHUB_API_BASE_URL).path
+        if base_path and path.startswith(base_path):
+            path = path[len(base_path) :]
+        return path.lower()
+
+    @classmethod
+    def endpoint(cls, url: str) -> str:
+        # Group by resource, not by repository: for example
+        # `/repos/{owner}/{repo}/stargazers`.
+        path = cls.endpoint_path(url)
+        return re.sub(r"^/repos/[^/]+/[^/]+", "/repos/{owner}/{repo}", path)
+
+    def record(
+        self,
+        url: str,
+        resp: Optional[requests.Response],
+        seconds: float,
+        repospec: Optional[str] = None,
+    ) -> None:
+        """
+        Account for one HTTP request. `resp` is `None` if no response was
+        received (connection error, timeout). `repospec`: the repository the
+        request is about (if any).
+        """
+        with self._lock:
+            if repospec is not None:
+                r = self.repos.setdefault(
+                    repospec.lower(), {"requests": 0, "bytes": 0, "seconds": 0.0}
+                )
+                r["requests"] += 1
+                r["seconds"] += seconds
+                if resp is not None:
+                    r["bytes"] += len(resp.content)
+
+            e = self.endpoints.setdefault(
+                self.endpoint(url),
+                {
+                    "requests": 0,
+                    "not_modified": 0,
+                    "failed": 0,
+                    "bytes": 0,
+                    "seconds_total": 0.0,
+                    "seconds_max": 0.0,
+                    "status_codes": {},
+                },
             )
-            sys.exit(1)
+            e["requests"] += 1
+            e["seconds_total"] += seconds
+            e["seconds_max"] = max(e["seconds_max"], seconds)
+
+            if resp is None:
+                e["failed"] += 1
+                return
+
+            codes = e["status_codes"]
+            codes[str(resp.status_code)] = codes.get(str(resp.status_code), 0) + 1
+            if resp.status_code == 304:
+                e["not_modified"] += 1
+            elif not resp.ok:
+                e["failed"] += 1
+            e["bytes"] += len(resp.content)
+
+            h = resp.headers
+            if "X-RateLimit-Remaining" not in h or "X-RateLimit-Reset" not in h:
+                return
+            quota = {
+                "limit": int(h.get("X-RateLimit-Limit", 0)),
+                "remaining": int(h["X-RateLimit-Remaining"]),
+                "reset": int(h["X-RateLimit-Reset"]),
+            }
+            resource = h.get("X-RateLimit-Resource", "core")
+            self.quota_first.setdefault(resource, quota)
+            # Responses to concurrent requests may arrive out of order. The
+            # most recent state is the one with the latest reset time and,
+            # within the same window, the lowest remaining quota.
+            last = self.quota_last.get(resource)
+            if (
+                last is None
+                or quota["reset"] > last["reset"]
+                or (
+                    quota["reset"] == last["reset"]
+                    and quota["remaining"] < last["remaining"]
+                )
+            ):
+                self.quota_last[resource] = quota
+
+    def repo_cost(self, repospec: str) -> dict:
+        with self._lock:
+            return dict(self.repos.get(repospec.lower(), {"requests": 0, "bytes": 0}))
+
+    def totals(self) -> dict:
+        with self._lock:
+            keys = ("requests", "not_modified", "failed", "bytes")
+            return {k: sum(e[k] for e in self.endpoints.values()) for k in keys}
+
+    def summary(self) -> str:
+        t = self.totals()
+        return (
+            f"HTTP requests: {t['requests']} ({t['not_modified']} not modified, "
+            f"{t['failed']} failed), {t['bytes'] / 1e6:.2f} MB response bodies"
+        )
 
-        log.warning("Exception contains 403, wait 60 s, retry: %s", str(exc))
-        # The request count quota is not necessarily responsible for this
-        # exception, but it usually is. Log the expected local time when the
-        # new quota arrives.
-        unix_timestamp_quota_reset = GHUB.rate_limiting_resettime
-        local_time = datetime.fromtimestamp(unix_timestamp_quota_reset)
-        log.info("New req count quota at: %s", local_time.strftime("%Y-%m-%d %H:%M:%S"))
-        return True
+    def quota_summary(self, resource: str = "core") -> str:
+        q = self.quota_last.get(resource)
+        if q is None:
+            return "unknown (no rate limit headers seen)"
+        return "%s of %s remaining, reset at %s" % (
+            q["remaining"],
+            q["limit"],
+            datetime.utcfromtimestamp(q["reset"]).strftime("%Y-%m-%d %H:%M:%S UTC"),
+        )
 
-    # For example, `RemoteDisconnected` is a case I have seen in production.
-    if isinstance(exc, requests.exceptions.RequestException):
-        log.warning("RequestException, wait 60 s, retry: %s", str(exc))
-        return True
+    def report(self) -> dict:
+        with self._lock:
+            endpoints = {
+                name: {
+                    **e,
+                    "seconds_mean": e["seconds_total"] / e["requests"],
+                }
+                for name, e in sorted(self.endpoints.items())
+            }
+        return {
+            "invocation_time": NOW.isoformat(),
+            "wall_seconds": time.monotonic() - self._t_start,
+            "totals": self.totals(),
+            "rate_limit_first_seen": self.quota_first,
+            "rate_limit_last_seen": self.quota_last,
+            "endpoints": endpoints,
+        }
+
+    def write_report(self, path: str, repospec: str) -> None:
+        log.info("write request cost report to %s", path)
+        report = {"repo": repospec, **self.report()}
+        tpath = path + ".tmp"
+        with open(tpath, "wb") as f:
+            f.write(json.dumps(report, indent=2).encode("utf-8"))
+        os.rename(tpath, path)
+
+
+ACCOUNTING = RequestAccounting()
+
+
+class RequestBudgetExceeded(Exception):
+    pass
+
+
+class BatchBudget:
+    """
+    Share the request quota fairly between the repositories of a batch.
+    Every repository is guaranteed BATCH_MIN_REQUESTS_PER_REPO requests for
+    fetching its stars/forks. Beyond that, a repository may use more only as
+    long as the remaining quota (as seen in the response headers, see
+    `RequestAccounting`) covers the guaranteed share of all other
+    repositories not yet finished. Otherwise, `charge()` raises
+    `RequestBudgetExceeded`: a large full sync then stops early, and is
+    resumed by the next run (see `PageJournal`) instead of starving the
+    other repositories (or waiting for the quota reset).
+
+    Traffic API requests are not charged: they are few per repository, and
+    time-critical (the API only returns the last 14 days).
+    """
+
+    def __init__(self, repospecs: List[str]):
+        self._lock = threading.Lock()
+        self._pending = set(repospecs)
+        self.used = {r: 0 for r in repospecs}
+
+    def finish(self, repospec: str) -> None:
+        with self._lock:
+            self._pending.discard(repospec)
+
+    def charge(self, repospec: str, resource: str) -> None:
+        with self._lock:
+            self.used[repospec] += 1
+            if self.used[repospec] <= BATCH_MIN_REQUESTS_PER_REPO:
+                return
+
+            remaining = TOKEN_POOL.remaining(resource)
+            if remaining is None:
+                return
+
+            others = len(self._pending - {repospec})
+            reserved = others * BATCH_MIN_REQUESTS_PER_REPO
+            if remaining <= reserved:
+                raise RequestBudgetExceeded(
+                    f"{repospec} used {self.used[repospec] - 1} requests, "
+                    f"{remaining} left ({resource}), reserved for "
+                    f"{others} other repositories: {reserved}"
+                )
+
+
+def backoff_delay(attempt: int) -> float:
+    # Exponential backoff with jitter: 1 s, 2 s, 4 s, ... (capped), each
+    # scaled by a random factor between 0.5 and 1. The jitter prevents
+    # concurrent retries from happening in lockstep.
+    return min(BACKOFF_MAX_SECONDS, 2.0 ** (attempt - 1)) * random.uniform(0.5, 1)
+
+
+def api_get(
+    url: str, params: Optional[dict] = None, accept: Optional[str] = None
+) -> requests.Response:
+    return api_request("GET", url, params, accept)
+
+
+def api_request(
+    method: str,
+    url: str,
+    params: Optional[dict] = None,
+    accept: Optional[str] = None,
+    json_body: Optional[dict] = None,
+    resource: str = "core",
+) -> requests.Response:
+    """
+    Issue request via `HTTP_SESSION`, with a credential from `TOKEN_POOL`
+    (picked per attempt), paced by that credential's scheduler for the rate
+    limit `resource`. Retry upon rate limiting and upon transient errors.
+    For GET requests, use `HTTP_CACHE` (if enabled) for conditional
+    requests. Safe to be called from multiple threads.
+
+    Raise `GithubException` for a non-2xx response that is not retried (or
+    for which all attempts failed).
+    """
+    headers = {"Accept": accept} if accept else {}
+
+    budget = REQUEST_BUDGET.get()
+    if budget is not None:
+        budget[0].charge(budget[1], resource)
+
+    repospec = request_repospec(url, json_body)
+
+    attempt = 0
+    while True:
+        attempt += 1
+        credential = TOKEN_POOL.acquire(resource)
+        scheduler = credential.schedulers[resource]
+        scheduler.wait()
+        token = credential.token()
+        if token:
+            headers["Authorization"] = f"token {token}"
+
+        # The cache entry depends on the credential, which may differ across
+        # attempts.
+        cache_entry = None
+        headers.pop("If-None-Match", None)
+        headers.pop("If-Modified-Since", None)
+        if HTTP_CACHE is not None and method == "GET":
+            cache_entry = HTTP_CACHE.get(url, params, accept, credential.identity)
+            if cache_entry is not None:
+                headers.update(HTTP_CACHE.conditional_headers(cache_entry))
+
+        t0 = time.monotonic()
+        try:
+            resp = HTTP_SESSION.request(
+                method,
+                url,
+                params=params,
+                json=json_body,
+                headers=headers,
+                timeout=HTTP_TIMEOUT_SECONDS,
+            )
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            ACCOUNTING.record(url, None, time.monotonic() - t0, repospec)
+            # For example, `RemoteDisconnected` is a case I have seen in
+            # production.
+            if attempt >= MAX_ATTEMPTS:
+                raise
+            delay = backoff_delay(attempt)
+            log.warning("%s, retry in %.1f s: %s", type(e).__name__, delay, e)
+            time.sleep(delay)
+            continue
+
+        ACCOUNTING.record(url, resp, time.monotonic() - t0, repospec)
+        scheduler.record_response(resp)
+
+        if resp.status_code == 304 and cache_entry is not None:
+            log.debug("not modified, use cached response: %s", url)
+            return HTTP_CACHE.response_from_entry(cache_entry)
+
+        if resp.ok:
+            if (
+                HTTP_CACHE is not None
+                and method == "GET"
+                and ("ETag" in resp.headers or "Last-Modified" in resp.headers)
+            ):
+                HTTP_CACHE.put(url, params, accept, credential.identity, resp)
+            return resp
+
+        delay = scheduler.retry_delay(resp, attempt)
+        # Waiting for a quota reset (delay 0) does not count as an attempt.
+        if delay == 0.0:
+            attempt -= 1
+        if delay is None or attempt >= MAX_ATTEMPTS:
+            try:
+                data = resp.json()
+            except ValueError:
+                data = resp.text
+            raise GithubException(resp.status_code, data, resp.headers)
+
+        time.sleep(delay)
+
+
+def request_repospec(url: str, json_body: Optional[dict]) -> Optional[str]:
+    # The repository a request is about, for cost accounting: REST
+    # `/repos/{owner}/{repo}/...`, GraphQL `owner` and `name` variables.
+    if json_body is not None:
+        v = json_body.get("variables") or {}
+        return f"{v['owner']}/{v['name']}" if "owner" in v and "name" in v else None
+    m = re.match(r"/repos/([^/]+/[^/]+)", RequestAccounting.endpoint_path(url))
+    return m.group(1) if m else None
+
+
+def api_get_json(url: str, params: Optional[dict] = None):
+    return api_get(url, params).json()
+
+
+def api_graphql(query: str, variables: dict) -> dict:
+    """
+    Issue GraphQL query, return the `data` part of the response. Errors are
+    reported with a 200 response; raise `GithubException` for those. Retry
+    if the GraphQL request quota is exhausted (the scheduler waits for the
+    quota reset).
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        resp = api_request(
+            "POST",
+            GITHUB_GRAPHQL_URL,
+            json_body={"query": query, "variables": variables},
+            resource="graphql",
+        )
+        body = resp.json()
+        errors = body.get("errors")
+        if not errors:
+            return body["data"]
 
-    return False
+        if attempt < MAX_ATTEMPTS and any(
+            e.get("type") == "RATE_LIMITED" for e in errors
+        ):
+            log.warning("GraphQL request quota exhausted: %s", errors)
+            continue
+
+        raise GithubException(resp.status_code, body, resp.headers)
+
+
+def fetch_repo(repospec: str) -> Repository.Repository:
+    # Like `GHUB.get_repo()`, but via `api_get()`: paced, retried and
+    # accounted for like every other request.
+    return GHUB.create_from_raw_data(
+        Repository.Repository, api_get_json(f"{GITHUB_API_BASE_URL}/repos/{repospec}")
+    )
+
+
+def parse_api_timestamp(s: str) -> int:
+    # The GitHub API returns ISO 8601 timestamp strings encoding the timezone
+    # via the Z suffix, i.e. Zulu time, i.e. UTC. Example:
+    # 2020-11-26T16:25:37Z. Return unix time (seconds).
+    return calendar.timegm(time.strptime(s, "%Y-%m-%dT%H:%M:%SZ"))
+
+
+def epochs_from_items(items: list, key: str) -> array.array:
+    # Compact representation of the event times of one page of a list
+    # resource: 8 bytes per event.
+    return array.array("q", (parse_api_timestamp(i[key]) for i in items))
+
+
+def fetch_page(
+    url: str, page: int, params: Optional[dict] = None, accept: Optional[str] = None
+) -> requests.Response:
+    params = {**(params or {}), "per_page": PER_PAGE, "page": page}
+    return api_get(url, params, accept)
+
+
+def fetch_all_pages(
+    url: str,
+    transform: Callable[[list], Any],
+    params: Optional[dict] = None,
+    accept: Optional[str] = None,
+    journal: Optional[PageJournal] = None,
+) -> list:
+    """
+    Fetch all pages of a paginated list resource. Get the first page, read
+    the number of pages from its `Link` header (`rel="last"`), then fetch the
+    remaining pages concurrently (with at most PAGE_FETCH_CONCURRENCY
+    requests in flight).
+
+    Call `transform()` with the items of each page as soon as the page has
+    been fetched: only its return value is kept (not the decoded JSON
+    document). Return the list of these values, in page order.
+
+    With `journal`, `transform()` must return a tuple of int64 arrays. Take
+    pages from the journal if present there, record fetched pages. The first
+    page is always requested (for the page count).
+    """
+
+    def fetch(page: int, resp: Optional[requests.Response] = None):
+        if journal is not None:
+            rec = journal.get(page)
+            if rec is not None:
+                return rec["columns"]
+        if resp is None:
+            resp = fetch_page(url, page, params, accept)
+        result = transform(resp.json())
+        if journal is not None:
+            journal.add(page, result)
+        return result
+
+    first_page_resp = fetch_page(url, 1, params, accept)
+    results = [fetch(1, first_page_resp)]
+
+    # No `last` link: there is only one page. Example for a `last` link:
+    # https://api.github.com/repositories/1/stargazers?per_page=100&page=35
+    if "last" not in first_page_resp.links:
+        return results
+
+    last_page_url = first_page_resp.links["last"]["url"]
+    n_pages = int(parse_qs(urlparse(last_page_url).query)["page"][0])
+    log.info("fetch pages 2 to %s of %s", n_pages, url)
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=PAGE_FETCH_CONCURRENCY, thread_name_prefix="pages"
+    ) as executor:
+        futures = [
+            submit_in_context(executor, fetch, page) for page in range(2, n_pages + 1)
+        ]
+        # Collect results in page order.
+        for count, fut in enumerate(futures, 2):
+            results.append(fut.result())
+            if count % 10 == 0:
+                log.info("%s of %s pages fetched", count, n_pages)
+
+    return results
 
 
-@retrying.retry(wait_fixed=60000, retry_on_exception=handle_rate_limit_error)
 def fetch_clones(repo):
-    clones = repo.get_clones_traffic()
-    return clones["clones"]
+    return api_get_json(f"{repo.url}/traffic/clones")["clones"]
 
 
-@retrying.retry(wait_fixed=60000, retry_on_exception=handle_rate_limit_error)
 def fetch_views(repo):
-    views = repo.get_views_traffic()
-    return views["views"]
+    return api_get_json(f"{repo.url}/traffic/views")["views"]
 
 
-@retrying.retry(wait_fixed=60000, retry_on_exception=handle_rate_limit_error)
 def fetch_top_referrers(repo):
-    return repo.get_top_referrers()
+    return api_get_json(f"{repo.url}/traffic/popular/referrers")
 
 
-@retrying.retry(wait_fixed=60000, retry_on_exception=handle_rate_limit_error)
 def fetch_top_paths(repo):
-    return repo.get_top_paths()
+    return api_get_json(f"{repo.url}/traffic/popular/paths")
 
 
 if __name__ == "__main__":
@@ -92,3 +92,261 @@ setup() {
   run python pdf.py $BATS_TEST_TMPDIR/outdir/report_for_pdf.html $BATS_TEST_TMPDIR/report.pdf
   assert_exist $BATS_TEST_TMPDIR/report.pdf
 }
+
+@test "analyze.py: stars/forks from event store (.events) same as from CSV" {
+  python eventstore.py from-csv tests/data/A/stars.csv $BATS_TEST_TMPDIR/stars.events
+  python eventstore.py from-csv tests/data/A/forks.csv $BATS_TEST_TMPDIR/forks.events
+
+  run python analyze.py owner/repo tests/data/A/snapshots \
+    --resources-directory=resources \
+    --output-directory $BATS_TEST_TMPDIR/outdir-csv \
+    --stargazer-ts-resampled-outpath $BATS_TEST_TMPDIR/stargazers-rs-csv.csv \
+    --fork-ts-resampled-outpath $BATS_TEST_TMPDIR/forks-rs-csv.csv \
+    --stargazer-ts-inpath=tests/data/A/stars.csv \
+    --fork-ts-inpath=tests/data/A/forks.csv
+  [ "$status" -eq 0 ]
+
+  run python analyze.py owner/repo tests/data/A/snapshots \
+    --resources-directory=resources \
+    --output-directory $BATS_TEST_TMPDIR/outdir-events \
+    --stargazer-ts-resampled-outpath $BATS_TEST_TMPDIR/stargazers-rs-events.csv \
+    --fork-ts-resampled-outpath $BATS_TEST_TMPDIR/forks-rs-events.csv \
+    --stargazer-ts-inpath=$BATS_TEST_TMPDIR/stars.events \
+    --fork-ts-inpath=$BATS_TEST_TMPDIR/forks.events
+  [ "$status" -eq 0 ]
+
+  run diff $BATS_TEST_TMPDIR/stargazers-rs-csv.csv $BATS_TEST_TMPDIR/stargazers-rs-events.csv
+  [ "$status" -eq 0 ]
+  run diff $BATS_TEST_TMPDIR/forks-rs-csv.csv $BATS_TEST_TMPDIR/forks-rs-events.csv
+  [ "$status" -eq 0 ]
+}
+
+@test "analyze.py: unchanged snapshot marker files" {
+  cp -a tests/data/A/snapshots $BATS_TEST_TMPDIR/snapshots
+  touch $BATS_TEST_TMPDIR/snapshots/2021-11-25_120000_top_referrers_snapshot.csv.unchanged
+  # No snapshot before that time: ignored.
+  touch $BATS_TEST_TMPDIR/snapshots/2000-01-01_000000_top_paths_snapshot.csv.unchanged
+  run python analyze.py owner/repo $BATS_TEST_TMPDIR/snapshots \
+    --resources-directory=resources \
+    --output-directory $BATS_TEST_TMPDIR/outdir \
+    --stargazer-ts-resampled-outpath $BATS_TEST_TMPDIR/stargazers-rs.csv \
+    --fork-ts-resampled-outpath $BATS_TEST_TMPDIR/forks-rs.csv \
+    --views-clones-aggregate-inpath tests/data/A/views_clones_aggregate.csv
+  [ "$status" -eq 0 ]
+  assert_output --partial "number of CSV files discovered for *_top_referrers_snapshot.csv.unchanged: 1"
+  assert_output --partial "ignore marker file"
+}
+
+@test "analyze.py: --snapshot-cache-dir: parse only new snapshot files" {
+  cp -a tests/data/A/snapshots $BATS_TEST_TMPDIR/snapshots
+  run python analyze.py owner/repo $BATS_TEST_TMPDIR/snapshots \
+    --resources-directory=resources \
+    --output-directory $BATS_TEST_TMPDIR/outdir \
+    --views-clones-aggregate-inpath tests/data/A/views_clones_aggregate.csv \
+    --snapshot-cache-dir $BATS_TEST_TMPDIR/cache
+  [ "$status" -eq 0 ]
+  assert_output --partial "snapshot cache: 0 files known, 29 new or changed"
+  assert_output --partial "snapshot cache: add 271 rows (271 in total, 1 chunks)"
+
+  # One new snapshot (10 referrers), one marker repeating it.
+  cp $BATS_TEST_TMPDIR/snapshots/2021-11-24_231835_top_referrers_snapshot.csv \
+    $BATS_TEST_TMPDIR/snapshots/2021-11-30_120000_top_referrers_snapshot.csv
+  touch $BATS_TEST_TMPDIR/snapshots/2021-12-01_120000_top_referrers_snapshot.csv.unchanged
+  run python analyze.py owner/repo $BATS_TEST_TMPDIR/snapshots \
+    --resources-directory=resources \
+    --output-directory $BATS_TEST_TMPDIR/outdir \
+    --views-clones-aggregate-inpath tests/data/A/views_clones_aggregate.csv \
+    --snapshot-cache-dir $BATS_TEST_TMPDIR/cache
+  [ "$status" -eq 0 ]
+  assert_output --partial "snapshot cache: 29 files known, 2 new or changed"
+  assert_output --partial "about to deserialize 1 snapshot CSV files"
+  assert_output --partial "snapshot cache: add 20 rows (291 in total, 2 chunks)"
+  # Top paths: nothing new, nothing written.
+  assert_output --partial "about to deserialize 0 snapshot CSV files"
+  assert_output --partial "snapshot cache: unchanged"
+
+  # Changed and deleted snapshot files: their rows are dropped, all rows are
+  # rewritten as one chunk.
+  echo "example.com,1000,100" >> $BATS_TEST_TMPDIR/snapshots/2021-11-30_120000_top_referrers_snapshot.csv
+  rm $BATS_TEST_TMPDIR/snapshots/2021-12-01_120000_top_referrers_snapshot.csv.unchanged
+  run python analyze.py owner/repo $BATS_TEST_TMPDIR/snapshots \
+    --resources-directory=resources \
+    --output-directory $BATS_TEST_TMPDIR/outdir \
+    --views-clones-aggregate-inpath tests/data/A/views_clones_aggregate.csv \
+    --snapshot-cache-dir $BATS_TEST_TMPDIR/cache
+  [ "$status" -eq 0 ]
+  assert_output --partial "2021-11-30_120000_top_referrers_snapshot.csv changed, parse again"
+  assert_output --partial "snapshot cache: add 11 rows (282 in total, 1 chunks)"
+  run ls $BATS_TEST_TMPDIR/cache/top_referrers.chunks
+  assert_output "000002.pkl"
+
+  # Same report (tables and chart data, values included) as without cache.
+  run python analyze.py owner/repo $BATS_TEST_TMPDIR/snapshots \
+    --resources-directory=resources \
+    --output-directory $BATS_TEST_TMPDIR/outdir-cache \
+    --outfile-prefix "" \
+    --views-clones-aggregate-inpath tests/data/A/views_clones_aggregate.csv \
+    --snapshot-cache-dir $BATS_TEST_TMPDIR/cache
+  [ "$status" -eq 0 ]
+  assert_output --partial "snapshot cache: unchanged"
+  run python analyze.py owner/repo $BATS_TEST_TMPDIR/snapshots \
+    --resources-directory=resources \
+    --output-directory $BATS_TEST_TMPDIR/outdir-nocache \
+    --outfile-prefix "" \
+    --views-clones-aggregate-inpath tests/data/A/views_clones_aggregate.csv
+  [ "$status" -eq 0 ]
+  # Apart from the time of report generation.
+  run diff <(sed '/^% Generated for/d' $BATS_TEST_TMPDIR/outdir-nocache/report.md) \
+    <(sed '/^% Generated for/d' $BATS_TEST_TMPDIR/outdir-cache/report.md)
+  [ "$status" -eq 0 ]
+}
+
+@test "analyze.py: --parse-processes: same report as parsing in the main process" {
+  cp -a tests/data/A/snapshots $BATS_TEST_TMPDIR/snapshots
+  # More snapshots than PARSE_PROCESS_POOL_MIN_FILES.
+  for day in $(seq -w 1 31); do
+    cp tests/data/A/snapshots/2021-11-24_231835_top_referrers_snapshot.csv \
+      $BATS_TEST_TMPDIR/snapshots/2022-01-${day}_120000_top_referrers_snapshot.csv
+  done
+
+  for nproc in 1 4; do
+    run python analyze.py owner/repo $BATS_TEST_TMPDIR/snapshots \
+      --resources-directory=resources \
+      --output-directory $BATS_TEST_TMPDIR/outdir-$nproc \
+      --outfile-prefix "" \
+      --views-clones-aggregate-inpath tests/data/A/views_clones_aggregate.csv \
+      --parse-processes $nproc
+    [ "$status" -eq 0 ]
+  done
+  assert_output --partial "parse 60 CSV files with 4 processes"
+
+  run grep "Top 15 referrers" $BATS_TEST_TMPDIR/outdir-1/report.md
+  top_referrers_serial="$output"
+  run grep "Top 15 referrers" $BATS_TEST_TMPDIR/outdir-4/report.md
+  assert_output "$top_referrers_serial"
+}
+
+@test "analyze.py: per-entity time series: same as with resample() per entity" {
+  run python tests/check_entity_dfs.py tests/data/A/snapshots
+  [ "$status" -eq 0 ]
+  assert_output --partial "all equal"
+
+  # More than one snapshot per day (some values higher, some lower than in
+  # the other snapshot of that day), and days without snapshot.
+  cp -a tests/data/A/snapshots $BATS_TEST_TMPDIR/snapshots
+  for kind in referrers paths; do
+    awk -F, -v OFS=, 'NR > 1 { $3 = (NR % 2) ? $3 * 3 : int($3 / 2) } 1' \
+      tests/data/A/snapshots/2021-11-06_231815_top_${kind}_snapshot.csv \
+      > $BATS_TEST_TMPDIR/snapshots/2021-11-07_080000_top_${kind}_snapshot.csv
+  done
+  rm $BATS_TEST_TMPDIR/snapshots/2021-11-0[45]_*
+  # Two raw paths that are the same after transformation: on one day, the
+  # root path with a trailing slash (merged with the root path).
+  sed -i 's|^/jgehrcke/covid-19-germany-gae,|/jgehrcke/covid-19-germany-gae/,|' \
+    $BATS_TEST_TMPDIR/snapshots/2021-11-10_*_top_paths_snapshot.csv
+  run python tests/check_entity_dfs.py $BATS_TEST_TMPDIR/snapshots
+  [ "$status" -eq 0 ]
+  assert_output --partial "path: compared"
+  assert_output --partial "(1 merged)"
+  assert_output --partial "all equal"
+}
+
+@test "analyze.py: --top-x-aggregate-outpath compacts top referrers/paths snapshots" {
+  cp -a tests/data/A/snapshots $BATS_TEST_TMPDIR/snapshots
+  run python analyze.py owner/repo tests/data/A/snapshots \
+    --resources-directory=resources \
+    --output-directory $BATS_TEST_TMPDIR/outdir-csv \
+    --outfile-prefix "" \
+    --views-clones-aggregate-inpath tests/data/A/views_clones_aggregate.csv
+  [ "$status" -eq 0 ]
+
+  run python analyze.py owner/repo $BATS_TEST_TMPDIR/snapshots \
+    --resources-directory=resources \
+    --output-directory $BATS_TEST_TMPDIR/outdir-compact \
+    --outfile-prefix "" \
+    --views-clones-aggregate-inpath tests/data/A/views_clones_aggregate.csv \
+    --top-x-aggregate-outpath "$BATS_TEST_TMPDIR/top_{entity}s_aggregate.parquet" \
+    --top-x-aggregate-inpath "$BATS_TEST_TMPDIR/top_{entity}s_aggregate.parquet" \
+    --delete-top-x-snapshots
+  [ "$status" -eq 0 ]
+  assert_output --partial "write aggregate (271 rows)"
+  assert_exist $BATS_TEST_TMPDIR/top_referrers_aggregate.parquet
+  assert_exist $BATS_TEST_TMPDIR/top_paths_aggregate.parquet
+  run bash -c "ls $BATS_TEST_TMPDIR/snapshots | wc -l"
+  assert_output "0"
+
+  # Snapshots only in the aggregate now. A new marker refers to the newest one.
+  touch $BATS_TEST_TMPDIR/snapshots/2021-11-25_120000_top_referrers_snapshot.csv.unchanged
+  run python analyze.py owner/repo $BATS_TEST_TMPDIR/snapshots \
+    --resources-directory=resources \
+    --output-directory $BATS_TEST_TMPDIR/outdir-agg \
+    --outfile-prefix "" \
+    --views-clones-aggregate-inpath tests/data/A/views_clones_aggregate.csv \
+    --top-x-aggregate-outpath "$BATS_TEST_TMPDIR/top_{entity}s_aggregate.parquet" \
+    --top-x-aggregate-inpath "$BATS_TEST_TMPDIR/top_{entity}s_aggregate.parquet"
+  [ "$status" -eq 0 ]
+  refute_output --partial "ignore marker file"
+  assert_output --partial "271 rows in previous aggregate"
+
+  run grep "Top 15" $BATS_TEST_TMPDIR/outdir-csv/report.md
+  top_csv="$output"
+  run grep "Top 15" $BATS_TEST_TMPDIR/outdir-agg/report.md
+  assert_output "$top_csv"
+}
+
+@test "analyze.py: --snapshot-cache-dir: top referrers/paths from the time x entity matrix" {
+  cp -a tests/data/A/snapshots $BATS_TEST_TMPDIR/snapshots
+  # Root path with trailing slash: after name transformation, the same path
+  # (`/`) as the root path in the other snapshots.
+  sed -i 's|^/jgehrcke/covid-19-germany-gae,|/jgehrcke/covid-19-germany-gae/,|' \
+    $BATS_TEST_TMPDIR/snapshots/2021-11-10_*_top_paths_snapshot.csv
+  # Top referrer for now, removed from the file later on.
+  referrers=$(ls $BATS_TEST_TMPDIR/snapshots/2021-11-10_*_top_referrers_snapshot.csv)
+  echo "example.com,10000,5000" >> $referrers
+
+  analyze_cached() {
+    python analyze.py owner/repo $BATS_TEST_TMPDIR/snapshots \
+      --resources-directory=resources \
+      --output-directory $BATS_TEST_TMPDIR/outdir-cache \
+      --outfile-prefix "" \
+      --views-clones-aggregate-inpath tests/data/A/views_clones_aggregate.csv \
+      --snapshot-cache-dir $BATS_TEST_TMPDIR/cache
+  }
+
+  run analyze_cached
+  [ "$status" -eq 0 ]
+  run analyze_cached
+  [ "$status" -eq 0 ]
+  # Second run: matrix complete.
+  assert_output --partial "top_referrers_matrix: add 0 of 272 rows"
+  assert_exist $BATS_TEST_TMPDIR/cache/top_paths_matrix/meta.json
+
+  # Changed snapshot file: rebuild, no stale cells.
+  sed -i '/^example.com,/d' $referrers
+  run analyze_cached
+  [ "$status" -eq 0 ]
+  assert_output --partial "top_referrers_matrix: snapshots changed or removed, rebuild"
+
+  # New snapshot file: appended, no relayout.
+  cp $BATS_TEST_TMPDIR/snapshots/2021-11-24_231835_top_referrers_snapshot.csv \
+    $BATS_TEST_TMPDIR/snapshots/2021-11-30_120000_top_referrers_snapshot.csv
+  run analyze_cached
+  [ "$status" -eq 0 ]
+  assert_output --partial "top_referrers_matrix: add 10 of 281 rows"
+  refute_output --partial "top_referrers_matrix: relayout"
+  run grep "Top 15 referrers" $BATS_TEST_TMPDIR/outdir-cache/report.md
+  refute_output --partial "example.com"
+
+  run python analyze.py owner/repo $BATS_TEST_TMPDIR/snapshots \
+    --resources-directory=resources \
+    --output-directory $BATS_TEST_TMPDIR/outdir-nocache \
+    --outfile-prefix "" \
+    --views-clones-aggregate-inpath tests/data/A/views_clones_aggregate.csv
+  [ "$status" -eq 0 ]
+
+  # Same report (top referrers/paths tables and chart data, values included),
+  # apart from the time of report generation.
+  run diff <(sed '/^% Generated for/d' $BATS_TEST_TMPDIR/outdir-nocache/report.md) \
+    <(sed '/^% Generated for/d' $BATS_TEST_TMPDIR/outdir-cache/report.md)
+  [ "$status" -eq 0 ]
+}
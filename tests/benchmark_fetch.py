@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# Copyright 2018 - 2020 Dr. Jan-Philip Gehrcke
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+Benchmark fetch.py against the mock GitHub HTTP API (tests/mock_github_api.py).
+Standard library only (fetch.py itself of course needs its dependencies).
+
+For each run, measure wall time, number of HTTP requests (from the
+--cost-report-outpath report), requests per second, and peak RSS of the
+fetch.py process. Example:
+
+    python tests/benchmark_fetch.py --stars 100000 --forks 10000 --repeat 3
+
+Arguments after `--` are passed on to fetch.py. The runs share one output
+directory: with `-- --incremental`, the first run is a full sync and the
+following ones are incremental.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+log = logging.getLogger()
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s.%(msecs)03d %(levelname)s: %(message)s",
+    datefmt="%y%m%d-%H:%M:%S",
+)
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+FETCH_PY = os.path.join(TESTS_DIR, "..", "fetch.py")
+MOCK_API_PY = os.path.join(TESTS_DIR, "mock_github_api.py")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark fetch.py against the mock GitHub HTTP API"
+    )
+    parser.add_argument("--stars", type=int, default=100000, metavar="N")
+    parser.add_argument("--forks", type=int, default=1000, metavar="N")
+    parser.add_argument(
+        "--fixture",
+        default="",
+        metavar="PATH",
+        help="Have the mock API serve this fixture (see mock_github_api.py)",
+    )
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=0,
+        metavar="MS",
+        help="Response latency injected by the mock API. Default: 0",
+    )
+    parser.add_argument(
+        "--abuse-every",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Mock API: respond to every N-th request with a secondary rate "
+        "limit error. Default: 0 (never)",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=int,
+        default=5000,
+        metavar="N",
+        help="Mock API: request quota per window. Default: 5000",
+    )
+    parser.add_argument(
+        "--rate-limit-window",
+        type=float,
+        default=3600,
+        metavar="SECONDS",
+        help="Mock API: length of the rate limit window. Default: 3600",
+    )
+    parser.add_argument("--repeat", type=int, default=1, metavar="N")
+    parser.add_argument(
+        "--json-outpath",
+        default="",
+        metavar="PATH",
+        help="Write the results of all runs to this JSON file",
+    )
+    parser.add_argument(
+        "--keep-workdir",
+        default=False,
+        action="store_true",
+        help="Do not delete the directory holding fetch.py output and logs",
+    )
+    parser.add_argument("fetch_args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    fetch_args = args.fetch_args
+    if fetch_args and fetch_args[0] == "--":
+        fetch_args = fetch_args[1:]
+
+    workdir = tempfile.mkdtemp(prefix="ghrs-bench-")
+    log.info("work directory: %s", workdir)
+
+    mock_args = [
+        "--rate-limit",
+        str(args.rate_limit),
+        "--rate-limit-window",
+        str(args.rate_limit_window),
+        "--abuse-every",
+        str(args.abuse_every),
+        "--latency-ms",
+        str(args.latency_ms),
+    ]
+    if args.fixture:
+        mock_args += ["--fixture", args.fixture]
+    else:
+        mock_args += ["--stars", str(args.stars), "--forks", str(args.forks)]
+
+    mock_proc, base_url = start_mock_api(workdir, mock_args)
+    results = []
+    try:
+        for i in range(1, args.repeat + 1):
+            log.info("run %s of %s", i, args.repeat)
+            r = run_fetch(base_url, workdir, fetch_args)
+            log.info(
+                "run %s: %.2f s, %s requests, %.1f requests/s, peak RSS %.1f MB",
+                i,
+                r["wall_seconds"],
+                r["requests"],
+                r["requests_per_second"],
+                r["peak_rss_mb"],
+            )
+            results.append(r)
+    finally:
+        mock_proc.terminate()
+        mock_proc.wait()
+
+    print_summary(results)
+
+    if args.json_outpath:
+        with open(args.json_outpath, "wb") as f:
+            report = {"args": vars(args), "runs": results}
+            f.write(json.dumps(report, indent=2).encode("utf-8"))
+        log.info("wrote %s", args.json_outpath)
+
+    if args.keep_workdir:
+        log.info("keep work directory: %s", workdir)
+    else:
+        shutil.rmtree(workdir)
+
+
+def start_mock_api(workdir: str, mock_args: list):
+    port_file = os.path.join(workdir, "mockport")
+    logf = open(os.path.join(workdir, "mock_api.log"), "wb")
+    proc = subprocess.Popen(
+        [sys.executable, MOCK_API_PY, "--port-file", port_file] + mock_args,
+        stdout=logf,
+        stderr=subprocess.STDOUT,
+    )
+
+    # Generating a large synthetic data set takes a few seconds.
+    deadline = time.monotonic() + 120
+    while not os.path.exists(port_file):
+        if proc.poll() is not None or time.monotonic() > deadline:
+            proc.kill()
+            sys.exit(f"mock API did not start, see {logf.name}")
+        time.sleep(0.1)
+
+    with open(port_file) as f:
+        base_url = f"http://127.0.0.1:{f.read().strip()}"
+    log.info("mock API listening at %s", base_url)
+    return proc, base_url
+
+
+def run_fetch(base_url: str, workdir: str, fetch_args: list) -> dict:
+    cost_report_path = os.path.join(workdir, "cost-report.json")
+    cmd = [
+        sys.executable,
+        FETCH_PY,
+        "owner/repo",
+        "--snapshot-directory",
+        os.path.join(workdir, "snapshots"),
+        "--stargazer-ts-outpath",
+        os.path.join(workdir, "stars-raw.csv"),
+        "--fork-ts-outpath",
+        os.path.join(workdir, "forks-raw.csv"),
+        "--cost-report-outpath",
+        cost_report_path,
+    ] + fetch_args
+    env = {
+        **os.environ,
+        "GHRS_GITHUB_API_TOKEN": "benchmark",
+        "GHRS_GITHUB_API_BASE_URL": base_url,
+    }
+
+    log_path = os.path.join(workdir, "fetch.log")
+    with open(log_path, "ab") as logf:
+        t0 = time.monotonic()
+        proc = subprocess.Popen(cmd, env=env, stdout=logf, stderr=subprocess.STDOUT)
+        # Unlike `proc.wait()`, `wait4()` reports resource usage of exactly
+        # this child process.
+        _, status, rusage = os.wait4(proc.pid, 0)
+        wall_seconds = time.monotonic() - t0
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    if proc.returncode != 0:
+        with open(log_path, "rb") as f:
+            sys.stderr.write(f.read()[-5000:].decode("utf-8", errors="replace"))
+        sys.exit(f"fetch.py failed with code {proc.returncode}, see {log_path}")
+
+    with open(cost_report_path, "rb") as f:
+        totals = json.loads(f.read().decode("utf-8"))["totals"]
+
+    return {
+        "wall_seconds": wall_seconds,
+        "requests": totals["requests"],
+        "requests_per_second": totals["requests"] / wall_seconds,
+        "response_bytes": totals["bytes"],
+        # Linux: kilobytes.
+        "peak_rss_mb": rusage.ru_maxrss / 1024.0,
+        "cpu_seconds": rusage.ru_utime + rusage.ru_stime,
+    }
+
+
+def print_summary(results: list) -> None:
+    print(
+        f"\n{'run':>4} {'wall [s]':>9} {'requests':>9} {'req/s':>8} "
+        f"{'MB recv':>8} {'CPU [s]':>8} {'RSS [MB]':>9}"
+    )
+    for i, r in enumerate(results, 1):
+        print(
+            f"{i:>4} {r['wall_seconds']:>9.2f} {r['requests']:>9} "
+            f"{r['requests_per_second']:>8.1f} {r['response_bytes'] / 1e6:>8.1f} "
+            f"{r['cpu_seconds']:>8.2f} {r['peak_rss_mb']:>9.1f}"
+        )
+    if len(results) > 1:
+        print(
+            f"median wall time: "
+            f"{statistics.median(r['wall_seconds'] for r in results):.2f} s, "
+            f"max peak RSS: {max(r['peak_rss_mb'] for r in results):.1f} MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
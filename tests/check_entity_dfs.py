@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# Copyright 2018 - 2020 Dr. Jan-Philip Gehrcke
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+Check that `analyze._build_entity_dfs()` (one groupby pass over all rows)
+builds exactly the same per-entity dataframes (index, values, dtypes) as the
+previous implementation (one subselection and `resample()` per entity),
+kept here as reference. For the top referrers and top paths snapshots in
+SNAPSHOT_DIRECTORY:
+
+    python tests/check_entity_dfs.py tests/data/A/snapshots
+
+One deliberate difference: paths that are the same after transformation
+(e.g. `/o/r` and `/o/r/`) are merged into one entity. The reference did not
+merge them; one dataframe overwrote the other, depending on set iteration
+order. Here, the reference subselects the rows of all colliding names for
+such an entity (and otherwise is unchanged).
+
+Exit code 0 if all dataframes are equal.
+"""
+
+import argparse
+import glob
+import logging
+import os
+import sys
+from types import SimpleNamespace
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import analyze  # noqa: E402
+
+
+log = logging.getLogger()
+
+
+def build_entity_dfs_resample(dfa, entity_type, unique_entity_names):
+    # The implementation before the groupby pass, unchanged except for
+    # logging, and for merging colliding names (see above).
+    cmn_ename_prefix = os.path.commonprefix(list(unique_entity_names))
+    colliding = {}
+    for ename in unique_entity_names:
+        tname = analyze._transform_entity_name(ename, entity_type, cmn_ename_prefix)
+        colliding.setdefault(tname, []).append(ename)
+
+    entity_dfs = {}
+    for ename in unique_entity_names:
+        # Do a subselection
+        tname = analyze._transform_entity_name(ename, entity_type, cmn_ename_prefix)
+        edf = dfa[dfa[entity_type].isin(colliding[tname])]
+        # Now use datetime column as index
+        newindex = edf["time"]
+        edf = edf.drop(columns=["time"])
+
+        edf.index = newindex
+        edf = edf.sort_index()
+
+        # Do entity name processing
+        if entity_type == "path":
+            entity_name_transformed = ename[len(cmn_ename_prefix) :]
+            if entity_name_transformed == "":
+                entity_name_transformed = "/"
+            edf.rename(columns={ename: entity_name_transformed}, inplace=True)
+            ename = entity_name_transformed
+
+        # Resample the DF into 24-hour bins. Take max() for each group, remove
+        # all up-sampled data points.
+        edf = edf.resample("24h").max().dropna()
+        entity_dfs[ename] = edf
+
+    return entity_dfs
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("snapshot_directory", metavar="SNAPSHOT_DIRECTORY")
+    args = parser.parse_args()
+
+    analyze.ARGS = SimpleNamespace(parse_processes=1)
+    # The reference implementation does not log; neither should this one.
+    logging.getLogger().setLevel(logging.WARNING)
+
+    failed = False
+    for entity_type in ("referrer", "path"):
+        basename_suffix = f"_top_{entity_type}s_snapshot.csv"
+        csvpaths = glob.glob(
+            os.path.join(args.snapshot_directory, f"*{basename_suffix}")
+        )
+        dfa = pd.concat(analyze._get_snapshot_dfs(csvpaths, basename_suffix))
+        enames = set(dfa[entity_type].values)
+
+        new = analyze._build_entity_dfs(dfa, entity_type, enames)
+        ref = build_entity_dfs_resample(dfa, entity_type, enames)
+
+        if set(new) != set(ref):
+            log.error("%s: entity names differ: %s", entity_type, set(new) ^ set(ref))
+            failed = True
+            continue
+
+        for ename in sorted(ref):
+            try:
+                # The groupby result has no `freq` set on its DatetimeIndex.
+                pd.testing.assert_frame_equal(new[ename], ref[ename], check_freq=False)
+            except AssertionError as e:
+                log.error("%s %s: dataframes differ:\n%s", entity_type, ename, e)
+                failed = True
+
+        merged = len(enames) - len(ref)
+        print(f"{entity_type}: compared {len(ref)} entity dataframes ({merged} merged)")
+
+    if failed:
+        sys.exit(1)
+    print("all equal")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,550 @@
+setup() {
+  load '/bats-libraries/bats-support/load.bash'
+  load '/bats-libraries/bats-assert/load.bash'
+  load '/bats-libraries/bats-file/load.bash'
+  export GHRS_GITHUB_API_TOKEN="mocktoken"
+}
+
+# Start tests/mock_github_api.py in the background, point fetch.py to it.
+# Arguments are passed on to the mock server.
+start_mock_api() {
+  rm -f $BATS_TEST_TMPDIR/mockport
+  # Close fd 3 for the background process, so that bats does not wait for it.
+  python tests/mock_github_api.py --port-file $BATS_TEST_TMPDIR/mockport "$@" 3>&- &
+  MOCK_API_PID=$!
+  for _ in $(seq 50); do
+    [ -f $BATS_TEST_TMPDIR/mockport ] && break
+    sleep 0.1
+  done
+  export GHRS_GITHUB_API_BASE_URL="http://127.0.0.1:$(cat $BATS_TEST_TMPDIR/mockport)"
+}
+
+stop_mock_api() {
+  kill $MOCK_API_PID || true
+  wait $MOCK_API_PID 2>/dev/null || true
+}
+
+teardown() {
+  stop_mock_api
+}
+
+@test "fetch.py: mock API: paginated stargazer/fork fetch" {
+  start_mock_api --stars 1234 --forks 567
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.csv \
+    --fork-ts-outpath $BATS_TEST_TMPDIR/forks-raw.csv
+  [ "$status" -eq 0 ]
+
+  # One header line plus one line per event.
+  run wc -l < $BATS_TEST_TMPDIR/stars-raw.csv
+  assert_output "1235"
+  run wc -l < $BATS_TEST_TMPDIR/forks-raw.csv
+  assert_output "568"
+
+  run tail -n 1 $BATS_TEST_TMPDIR/stars-raw.csv
+  assert_output --partial ",1234"
+
+  run ls $BATS_TEST_TMPDIR/snapshots
+  assert_output --partial "_views_clones_series_fragment.csv"
+  assert_output --partial "_top_referrers_snapshot.csv"
+  assert_output --partial "_top_paths_snapshot.csv"
+}
+
+@test "fetch.py: mock API: incremental stargazer/fork sync" {
+  start_mock_api --stars 250 --forks 30
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.csv \
+    --fork-ts-outpath $BATS_TEST_TMPDIR/forks-raw.csv \
+    --incremental
+  [ "$status" -eq 0 ]
+  assert_output --partial "do full sync"
+  assert_exist $BATS_TEST_TMPDIR/stars-raw.state.json
+  assert_exist $BATS_TEST_TMPDIR/forks-raw.state.json
+  stop_mock_api
+
+  # Same seed: the first 250 stargazers / 30 forks are the same as before.
+  start_mock_api --stars 321 --forks 45
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.csv \
+    --fork-ts-outpath $BATS_TEST_TMPDIR/forks-raw.csv \
+    --incremental
+  [ "$status" -eq 0 ]
+  assert_output --partial "new stargazers: 71"
+  assert_output --partial "new forks: 15"
+
+  run wc -l < $BATS_TEST_TMPDIR/stars-raw.csv
+  assert_output "322"
+  run wc -l < $BATS_TEST_TMPDIR/forks-raw.csv
+  assert_output "46"
+
+  # The sync state holds the newest fork only, not the IDs of all forks.
+  run python -c "import json; s = json.load(open('$BATS_TEST_TMPDIR/forks-raw.state.json')); print('fork_ids' in s, s['fork_watermark']['ids'])"
+  assert_output "False [5044]"
+
+  # Sync state of a previous version (IDs of all forks): full sync, once.
+  python -c "import json; p = '$BATS_TEST_TMPDIR/forks-raw.state.json'; s = json.load(open(p)); s['fork_ids'] = list(range(5000, 5045)); del s['fork_watermark']; json.dump(s, open(p, 'w'))"
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --fork-ts-outpath $BATS_TEST_TMPDIR/forks-raw.csv \
+    --incremental
+  [ "$status" -eq 0 ]
+  refute_output --partial "fetch new forks"
+  run wc -l < $BATS_TEST_TMPDIR/forks-raw.csv
+  assert_output "46"
+  run python -c "import json; s = json.load(open('$BATS_TEST_TMPDIR/forks-raw.state.json')); print('fork_ids' in s, s['fork_watermark']['ids'])"
+  assert_output "False [5044]"
+}
+
+@test "fetch.py: mock API: more than 40000 stars (REST API page limit)" {
+  # The REST API serves 400 pages of the stargazer list: use the GraphQL API.
+  start_mock_api --stars 40500 --forks 5
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.csv \
+    --incremental
+  [ "$status" -eq 0 ]
+  assert_output --partial "stargazer pages: 405, REST API serves 400 only: use GraphQL API"
+  run wc -l < $BATS_TEST_TMPDIR/stars-raw.csv
+  assert_output "40501"
+  stop_mock_api
+
+  start_mock_api --stars 40620 --forks 5
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.csv \
+    --incremental
+  [ "$status" -eq 0 ]
+  assert_output --partial "use GraphQL API"
+  assert_output --partial "new stargazers: 120"
+  refute_output --partial "pagination is limited"
+  run wc -l < $BATS_TEST_TMPDIR/stars-raw.csv
+  assert_output "40621"
+}
+
+@test "fetch.py: mock API: conditional requests via --http-cache-dir" {
+  start_mock_api --stars 450 --forks 5
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.csv \
+    --http-cache-dir $BATS_TEST_TMPDIR/httpcache
+  [ "$status" -eq 0 ]
+  assert_output --partial "HTTP cache: 0 of"
+
+  # Nothing changed: every request is answered with 304 Not Modified. Five
+  # stargazer pages, four traffic API endpoints.
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.csv \
+    --http-cache-dir $BATS_TEST_TMPDIR/httpcache
+  [ "$status" -eq 0 ]
+  assert_output --partial "HTTP cache: 9 of 9 responses served from cache (304)"
+
+  # Responses cached for one token are not used for another one.
+  run env GHRS_GITHUB_API_TOKEN=othertoken python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.csv \
+    --http-cache-dir $BATS_TEST_TMPDIR/httpcache
+  [ "$status" -eq 0 ]
+  assert_output --partial "HTTP cache: 0 of"
+
+  run wc -l < $BATS_TEST_TMPDIR/stars-raw.csv
+  assert_output "451"
+}
+
+@test "fetch.py: mock API: GitHub App installation token" {
+  start_mock_api --stars 250 --forks 5
+  python -c "
+import sys
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+open(sys.argv[1], 'wb').write(key.private_bytes(
+    serialization.Encoding.PEM,
+    serialization.PrivateFormat.TraditionalOpenSSL,
+    serialization.NoEncryption(),
+))" $BATS_TEST_TMPDIR/app.pem
+
+  # The mock rejects installation tokens it did not issue.
+  run env -u GHRS_GITHUB_API_TOKEN GHRS_GITHUB_APP_ID=123 \
+    GHRS_GITHUB_APP_PRIVATE_KEY_PATH=$BATS_TEST_TMPDIR/app.pem \
+    GHRS_GITHUB_APP_INSTALLATION_IDS=42 \
+    python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.csv
+  [ "$status" -eq 0 ]
+  assert_output --partial "API credentials: app 123 installation 42"
+  assert_output --partial "app 123 installation 42: new token, expires at"
+
+  run wc -l < $BATS_TEST_TMPDIR/stars-raw.csv
+  assert_output "251"
+}
+
+@test "fetch.py: mock API: --cost-report-outpath" {
+  start_mock_api --stars 250 --forks 5
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.csv \
+    --cost-report-outpath $BATS_TEST_TMPDIR/cost.json
+  [ "$status" -eq 0 ]
+  # Repository, three stargazer pages, four traffic API endpoints. No request
+  # to the /rate_limit endpoint.
+  assert_output --partial "HTTP requests: 8 (0 not modified, 0 failed)"
+  assert_output --partial "Request quota: 4992 of 5000 remaining"
+
+  run python -c "import json; r = json.load(open('$BATS_TEST_TMPDIR/cost.json')); print(r['endpoints']['/repos/{owner}/{repo}/stargazers']['requests'], r['rate_limit_last_seen']['core']['remaining'])"
+  assert_output "3 4992"
+}
+
+@test "fetch.py: mock API: --events-api=graphql" {
+  start_mock_api --stars 250 --forks 130
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.csv \
+    --fork-ts-outpath $BATS_TEST_TMPDIR/forks-raw.csv \
+    --events-api=graphql --incremental
+  [ "$status" -eq 0 ]
+  assert_output --partial "GraphQL request quota: 4995 of 5000 remaining"
+  cp $BATS_TEST_TMPDIR/stars-raw.csv $BATS_TEST_TMPDIR/stars-raw-graphql.csv
+  stop_mock_api
+
+  # Same data as fetched via the REST API.
+  start_mock_api --stars 250 --forks 130
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots-rest \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw-rest.csv
+  [ "$status" -eq 0 ]
+  run diff $BATS_TEST_TMPDIR/stars-raw-rest.csv $BATS_TEST_TMPDIR/stars-raw-graphql.csv
+  [ "$status" -eq 0 ]
+  stop_mock_api
+
+  # Incremental sync via GraphQL, based on the state written above.
+  start_mock_api --stars 321 --forks 145
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.csv \
+    --fork-ts-outpath $BATS_TEST_TMPDIR/forks-raw.csv \
+    --events-api=graphql --incremental
+  [ "$status" -eq 0 ]
+  assert_output --partial "new stargazers: 71"
+  assert_output --partial "new forks: 15"
+
+  run wc -l < $BATS_TEST_TMPDIR/stars-raw.csv
+  assert_output "322"
+  run wc -l < $BATS_TEST_TMPDIR/forks-raw.csv
+  assert_output "146"
+}
+
+@test "fetch.py: mock API: secondary rate limit and quota exhaustion" {
+  # Every 4th request fails with 403 and Retry-After. The quota (8 requests
+  # per 3 s window) is smaller than the number of requests needed.
+  start_mock_api --stars 1234 --forks 5 --abuse-every 4 --retry-after 1 \
+    --rate-limit 8 --rate-limit-window 3 --latency-ms 20
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.csv
+  [ "$status" -eq 0 ]
+  assert_output --partial "got Retry-After: 1 s"
+  assert_output --partial "request quota exhausted"
+
+  run wc -l < $BATS_TEST_TMPDIR/stars-raw.csv
+  assert_output "1235"
+}
+
+@test "fetch.py: mock API: 403 w/o rate limit message is not retried" {
+  # repo6: no push access, the traffic API responds with 403.
+  start_mock_api --stars 150 --forks 5
+  printf "owner/repo5\nowner/repo6\n" > $BATS_TEST_TMPDIR/repos.txt
+  SECONDS=0
+  run python fetch.py --repos-file $BATS_TEST_TMPDIR/repos.txt \
+    --snapshot-directory "$BATS_TEST_TMPDIR/_ghrs_{owner}_{repo}"
+  [ "$status" -eq 1 ]
+  [ "$SECONDS" -lt 30 ]
+  assert_output --partial "Must have push access to repository"
+  assert_output --partial "batch: 2 repositories processed, 1 failed ['owner/repo6']"
+  refute_output --partial "retry in"
+}
+
+@test "fetch.py: no API token" {
+  run env GHRS_GITHUB_API_TOKEN= python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots
+  [ "$status" -eq 1 ]
+  assert_output --partial "GHRS_GITHUB_API_TOKEN empty or not set"
+}
+
+@test "fetch.py: mock API: resume interrupted full sync from journal" {
+  # The request quota runs low after about 50 requests. fetch.py then spreads
+  # the remaining requests across the rate limit window (one hour). Kill it
+  # while it waits.
+  start_mock_api --stars 10000 --rate-limit 150
+  run timeout -s KILL 15 python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.csv
+  [ "$status" -eq 137 ]
+  assert_exist $BATS_TEST_TMPDIR/stars-raw.journal
+  assert_not_exist $BATS_TEST_TMPDIR/stars-raw.csv
+  stop_mock_api
+
+  start_mock_api --stars 10000
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.csv
+  [ "$status" -eq 0 ]
+  assert_output --partial "resume from journal"
+  assert_not_exist $BATS_TEST_TMPDIR/stars-raw.journal
+
+  run wc -l < $BATS_TEST_TMPDIR/stars-raw.csv
+  assert_output "10001"
+}
+
+@test "fetch.py: mock API: event store (.events), incremental append" {
+  start_mock_api --stars 250 --forks 30
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.events \
+    --fork-ts-outpath $BATS_TEST_TMPDIR/forks-raw.events \
+    --incremental
+  [ "$status" -eq 0 ]
+  # 16 bytes file header, 16 bytes chunk header, 8 bytes per event.
+  run stat -c %s $BATS_TEST_TMPDIR/stars-raw.events
+  assert_output "$((16 + 16 + 250 * 8))"
+  stop_mock_api
+
+  start_mock_api --stars 321 --forks 45
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.events \
+    --fork-ts-outpath $BATS_TEST_TMPDIR/forks-raw.events \
+    --incremental
+  [ "$status" -eq 0 ]
+  assert_output --partial "new stargazers: 71"
+  assert_output --partial "append 71 events"
+  run stat -c %s $BATS_TEST_TMPDIR/stars-raw.events
+  assert_output "$((16 + 16 + 250 * 8 + 16 + 71 * 8))"
+
+  # CSV export is the same as what fetch.py writes for a .csv path.
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.csv
+  [ "$status" -eq 0 ]
+  run python eventstore.py to-csv $BATS_TEST_TMPDIR/stars-raw.events $BATS_TEST_TMPDIR/stars-export.csv
+  [ "$status" -eq 0 ]
+  run diff $BATS_TEST_TMPDIR/stars-raw.csv $BATS_TEST_TMPDIR/stars-export.csv
+  [ "$status" -eq 0 ]
+
+  # An empty store file (e.g. truncated) is rewritten.
+  truncate -s 0 $BATS_TEST_TMPDIR/stars-raw.events
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.events \
+    --fork-ts-outpath $BATS_TEST_TMPDIR/forks-raw.events \
+    --incremental
+  [ "$status" -eq 0 ]
+  assert_output --partial "empty file -- do full sync"
+  assert_output --partial "empty file -- rewrite"
+  run stat -c %s $BATS_TEST_TMPDIR/stars-raw.events
+  assert_output "$((16 + 16 + 321 * 8))"
+}
+
+@test "fetch.py: mock API: --repos-file batch mode" {
+  start_mock_api --stars 250 --forks 30
+  printf "# comment\nowner/repo1\nowner/repo2\n\nother/repo3\n" > $BATS_TEST_TMPDIR/repos.txt
+  run python fetch.py --repos-file $BATS_TEST_TMPDIR/repos.txt \
+    --batch-concurrency 2 \
+    --snapshot-directory "$BATS_TEST_TMPDIR/_ghrs_{owner}_{repo}" \
+    --stargazer-ts-outpath "$BATS_TEST_TMPDIR/{owner}_{repo}_stars.csv" \
+    --fork-ts-outpath "$BATS_TEST_TMPDIR/{owner}_{repo}_forks.csv"
+  [ "$status" -eq 0 ]
+  assert_output --partial "batch: 3 repositories processed, 0 failed"
+
+  for r in owner_repo1 owner_repo2 other_repo3; do
+    run wc -l < $BATS_TEST_TMPDIR/${r}_stars.csv
+    assert_output "251"
+    run wc -l < $BATS_TEST_TMPDIR/${r}_forks.csv
+    assert_output "31"
+    run ls $BATS_TEST_TMPDIR/_ghrs_${r}
+    assert_output --partial "_views_clones_series_fragment.csv"
+  done
+
+  # Output paths must be distinct per repository.
+  run python fetch.py --repos-file $BATS_TEST_TMPDIR/repos.txt \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars.csv
+  [ "$status" -eq 1 ]
+  assert_output --partial "must contain {repo}"
+}
+
+@test "fetch.py: mock API: --org discovery and manifest" {
+  # repo3, repo7: forks. repo4: archived. repo6: no push access.
+  start_mock_api --stars 150 --forks 5 --org-repos 8
+  run python fetch.py --org acme --skip-archived --skip-forks \
+    --snapshot-directory "$BATS_TEST_TMPDIR/_ghrs_{owner}_{repo}" \
+    --stargazer-ts-outpath "$BATS_TEST_TMPDIR/{owner}_{repo}_stars.csv" \
+    --manifest-outpath $BATS_TEST_TMPDIR/manifest.json
+  [ "$status" -eq 0 ]
+  assert_output --partial "batch: 4 repositories processed, 0 failed"
+  assert_exist $BATS_TEST_TMPDIR/acme_repo5_stars.csv
+  assert_not_exist $BATS_TEST_TMPDIR/acme_repo3_stars.csv
+
+  # Repository, two stargazer pages, four traffic API endpoints.
+  run python -c "import json; m = json.load(open('$BATS_TEST_TMPDIR/manifest.json')); print(' '.join(f\"{r}:{v['status']}:{v.get('cost', {}).get('requests', '-')}\" for r, v in m['repos'].items()))"
+  assert_output "acme/repo0:ok:7 acme/repo1:ok:7 acme/repo2:ok:7 acme/repo3:skipped:- acme/repo4:skipped:- acme/repo5:ok:7 acme/repo6:skipped:- acme/repo7:skipped:-"
+}
+
+@test "fetch.py: mock API: skip stargazer/fork fetch if counts are unchanged" {
+  start_mock_api --stars 250 --forks 30
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.csv \
+    --fork-ts-outpath $BATS_TEST_TMPDIR/forks-raw.csv \
+    --incremental
+  [ "$status" -eq 0 ]
+
+  # Repository and four traffic API endpoints, nothing else.
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.csv \
+    --fork-ts-outpath $BATS_TEST_TMPDIR/forks-raw.csv \
+    --incremental
+  [ "$status" -eq 0 ]
+  assert_output --partial "stargazer count unchanged: skip fetching stargazers"
+  assert_output --partial "fork count unchanged: skip fetching forks"
+  assert_output --partial "HTTP requests: 5 (0 not modified, 0 failed)"
+
+  run wc -l < $BATS_TEST_TMPDIR/stars-raw.csv
+  assert_output "251"
+}
+
+@test "fetch.py: mock API: --dedup-state-path skips unchanged snapshots" {
+  start_mock_api --stars 5
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --dedup-state-path $BATS_TEST_TMPDIR/dedup.state.json
+  [ "$status" -eq 0 ]
+  run ls $BATS_TEST_TMPDIR/snapshots
+  assert_output --partial "_top_referrers_snapshot.csv"
+  assert_output --partial "_views_clones_series_fragment.csv"
+
+  # Snapshot file names have a resolution of one second.
+  sleep 1
+  run python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --dedup-state-path $BATS_TEST_TMPDIR/dedup.state.json
+  [ "$status" -eq 0 ]
+  assert_output --partial "unchanged since"
+
+  # One CSV file per kind, plus one zero-byte marker for referrers and paths.
+  run bash -c "ls $BATS_TEST_TMPDIR/snapshots | wc -l"
+  assert_output "5"
+  run find $BATS_TEST_TMPDIR/snapshots -name "*_top_paths_snapshot.csv.unchanged" -empty
+  assert_output --partial ".unchanged"
+}
+
+@test "fetch.py: mock API: rotate across tokens (GHRS_GITHUB_API_TOKENS)" {
+  # The mock API tracks the request quota per token.
+  start_mock_api --stars 1000
+  run env GHRS_GITHUB_API_TOKENS=mocktoken2,mocktoken3 python fetch.py owner/repo \
+    --snapshot-directory $BATS_TEST_TMPDIR/snapshots \
+    --stargazer-ts-outpath $BATS_TEST_TMPDIR/stars-raw.csv
+  [ "$status" -eq 0 ]
+  assert_output --partial "API credentials: token 1, token 2, token 3"
+  # Repository, ten stargazer pages, four traffic API endpoints: 15 requests,
+  # spread across all tokens.
+  assert_output --regexp "token 1: [1-9][0-9]* requests, 499[0-9] remaining"
+  assert_output --regexp "token 2: [1-9][0-9]* requests, 499[0-9] remaining"
+  assert_output --regexp "token 3: [1-9][0-9]* requests, 499[0-9] remaining"
+
+  run wc -l < $BATS_TEST_TMPDIR/stars-raw.csv
+  assert_output "1001"
+}
+
+@test "fetch.py: mock API: --dry-run plan defers stars/forks beyond the quota" {
+  start_mock_api --stars 1500 --rate-limit 40
+  printf "owner/repo1\nowner/repo2\nowner/repo3\n" > $BATS_TEST_TMPDIR/repos.txt
+  # Three repository requests: 37 left. Traffic: 3 * 4 requests reserved, 25
+  # left: enough for the 15 stargazer pages of only one repository.
+  run python fetch.py --repos-file $BATS_TEST_TMPDIR/repos.txt --dry-run \
+    --snapshot-directory "$BATS_TEST_TMPDIR/_ghrs_{owner}_{repo}" \
+    --stargazer-ts-outpath "$BATS_TEST_TMPDIR/{owner}_{repo}_stars.csv"
+  [ "$status" -eq 0 ]
+  assert_output --partial "15 stars (full), 0 forks (not requested), 4 traffic requests"
+  assert_output --partial "plan: 57 requests for 3 repositories, stars/forks deferred for 2"
+  assert_output --partial "HTTP requests: 3 (0 not modified, 0 failed)"
+  assert_not_exist $BATS_TEST_TMPDIR/_ghrs_owner_repo1
+}
+
+@test "fetch.py: mock API: --schedule fetches the most urgent repository first" {
+  start_mock_api --stars 5
+  printf "owner/recent\nowner/old\nowner/fresh\n" > $BATS_TEST_TMPDIR/repos.txt
+  # Newest snapshots: 12 days and 2 hours before the (fake) start time,
+  # 2026-01-01 00:00:00 UTC. owner/fresh: none.
+  mkdir -p $BATS_TEST_TMPDIR/_ghrs_owner_old $BATS_TEST_TMPDIR/_ghrs_owner_recent
+  touch $BATS_TEST_TMPDIR/_ghrs_owner_old/2025-12-20_000000_views_clones_series_fragment.csv
+  touch $BATS_TEST_TMPDIR/_ghrs_owner_recent/2025-12-31_220000_views_clones_series_fragment.csv
+
+  run env GHRS_FAKE_CLOCK_START=1767225600 python fetch.py \
+    --repos-file $BATS_TEST_TMPDIR/repos.txt \
+    --snapshot-directory "$BATS_TEST_TMPDIR/_ghrs_{owner}_{repo}" \
+    --schedule --schedule-interval 24 --schedule-max-rounds 2 --schedule-jitter 0
+  [ "$status" -eq 0 ]
+  assert_output --partial "round 1, fetch (most urgent first): ['owner/fresh', 'owner/old']"
+  assert_output --partial "next fetch in 79200 s"
+  assert_output --partial "round 2, fetch (most urgent first): ['owner/recent']"
+
+  assert_exist $BATS_TEST_TMPDIR/_ghrs_owner_fresh/2026-01-01_000000_views_clones_series_fragment.csv
+  assert_exist $BATS_TEST_TMPDIR/_ghrs_owner_recent/2026-01-01_220000_views_clones_series_fragment.csv
+}
+
+@test "fetch.py: mock API: --schedule uses the last fetch time from the dedup state" {
+  start_mock_api --stars 5
+  printf "owner/repo\n" > $BATS_TEST_TMPDIR/repos.txt
+  # The newest snapshot file is 12 days old, but the previous fetch two hours
+  # ago did not write one (all snapshots unchanged).
+  mkdir -p $BATS_TEST_TMPDIR/_ghrs_owner_repo
+  touch $BATS_TEST_TMPDIR/_ghrs_owner_repo/2025-12-20_000000_views_clones_series_fragment.csv
+  echo '{"last_fetch": "2025-12-31_220000"}' > $BATS_TEST_TMPDIR/owner_repo.dedup.json
+
+  run env GHRS_FAKE_CLOCK_START=1767225600 python fetch.py \
+    --repos-file $BATS_TEST_TMPDIR/repos.txt \
+    --snapshot-directory "$BATS_TEST_TMPDIR/_ghrs_{owner}_{repo}" \
+    --dedup-state-path "$BATS_TEST_TMPDIR/{owner}_{repo}.dedup.json" \
+    --schedule --schedule-interval 24 --schedule-max-rounds 1 --schedule-jitter 0
+  [ "$status" -eq 0 ]
+  assert_output --partial "next fetch in 79200 s"
+  assert_exist $BATS_TEST_TMPDIR/_ghrs_owner_repo/2026-01-01_220000_views_clones_series_fragment.csv
+  run grep -c '"last_fetch": "2026-01-01_220000"' $BATS_TEST_TMPDIR/owner_repo.dedup.json
+  assert_output "1"
+}
+
+@test "fetch.py: mock API: --daemon serves /metrics and /healthz, exits upon SIGTERM" {
+  start_mock_api --stars 5
+  # Per-repository interval (hours) for owner/repo2.
+  printf "owner/repo1\nowner/repo2 6\n" > $BATS_TEST_TMPDIR/repos.txt
+  port=$(python -c 'import socket; s = socket.socket(); s.bind(("127.0.0.1", 0)); print(s.getsockname()[1])')
+
+  python fetch.py --repos-file $BATS_TEST_TMPDIR/repos.txt \
+    --snapshot-directory "$BATS_TEST_TMPDIR/_ghrs_{owner}_{repo}" \
+    --daemon --metrics-port $port > $BATS_TEST_TMPDIR/daemon.log 2>&1 3>&- &
+  daemon_pid=$!
+
+  for _ in $(seq 100); do
+    curl -sf http://127.0.0.1:$port/metrics | grep -q "ghrs_schedule_rounds_total 1" && break
+    sleep 0.1
+  done
+  run curl -sf http://127.0.0.1:$port/metrics
+  assert_output --partial "ghrs_schedule_rounds_total 1"
+  assert_output --partial 'ghrs_repo_consecutive_failures{repo="owner/repo2"} 0'
+  assert_output --partial 'ghrs_repo_next_fetch_timestamp_seconds{repo="owner/repo1"}'
+  assert_output --regexp "ghrs_http_requests_total [1-9]"
+
+  run curl -s -w " %{http_code}" http://127.0.0.1:$port/healthz
+  assert_output '{"rounds": 1, "at_risk": []} 200'
+
+  kill -TERM $daemon_pid
+  run wait $daemon_pid
+  [ "$status" -eq 0 ]
+  run cat $BATS_TEST_TMPDIR/daemon.log
+  assert_output --partial "schedule: stop after 1 rounds"
+  assert_exist $BATS_TEST_TMPDIR/_ghrs_owner_repo2
+}
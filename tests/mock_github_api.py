@@ -0,0 +1,639 @@
+#!/usr/bin/env python
+# Copyright 2018 - 2020 Dr. Jan-Philip Gehrcke
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+Local stand-in for the parts of the GitHub HTTP API used by fetch.py (REST,
+and the stargazers/forks connections of the GraphQL API). Serves synthetic
+data for any owner/repo. Standard library only.
+
+Point fetch.py to it via the GHRS_GITHUB_API_BASE_URL environment variable:
+
+    python tests/mock_github_api.py --port 8080 --stars 12345 --forks 678 &
+    GHRS_GITHUB_API_TOKEN=x GHRS_GITHUB_API_BASE_URL=http://127.0.0.1:8080 \\
+        python fetch.py owner/repo --stargazer-ts-outpath=stars.csv
+
+Failure modes of the real API can be emulated: request quota exhaustion
+(--rate-limit, --rate-limit-window), secondary rate limit responses
+(--abuse-every, --retry-after) and response latency (--latency-ms).
+
+Instead of synthetic stargazers/forks, a fixture file can be served
+(--fixture): a JSON object with the keys `stargazers` and `forks`, holding
+the concatenated pages of the REST list resources (stargazers as returned
+for the star+json media type). --dump-fixture writes the synthetic data in
+that format, e.g. for editing or for re-use across runs.
+
+GitHub App authentication: POST /app/installations/{id}/access_tokens
+issues an installation token (expiring after one hour) for a JWT whose
+payload has an `iss` claim (the signature is not checked). Requests
+authenticated with an installation token (`ghs_` prefix) that was not
+issued are rejected (401).
+
+Also see tests/benchmark_fetch.py.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+
+log = logging.getLogger()
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s.%(msecs)03d %(levelname)s: %(message)s",
+    datefmt="%y%m%d-%H:%M:%S",
+)
+
+# Set in main().
+ARGS: argparse.Namespace
+STARGAZERS: list
+FORKS: list
+# Precomputed list resources, as served (this matters for large lists).
+STARGAZER_USERS: list
+FORKS_NEWEST_FIRST: list
+GRAPHQL_ITEMS: dict
+
+# Request quota per API token (Authorization header) and resource (REST:
+# core, GraphQL: graphql), reported via X-RateLimit-* response headers. Like
+# GitHub, count successful responses only (not 304, not 403).
+# RATE_LIMIT_RESET is set in main().
+RATE_LIMIT_RESET = 0
+RATE_LIMIT_USED: dict = {}
+RATE_LIMIT_LOCK = threading.Lock()
+REQUEST_COUNT = 0
+
+# Installation tokens issued (GitHub App authentication).
+ISSUED_TOKENS: set = set()
+
+
+def main() -> None:
+    global ARGS, STARGAZERS, FORKS, RATE_LIMIT_RESET
+    global STARGAZER_USERS, FORKS_NEWEST_FIRST, GRAPHQL_ITEMS
+
+    parser = argparse.ArgumentParser(description="Mock GitHub HTTP API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument(
+        "--port", type=int, default=0, help="Default: 0 (pick a free port)"
+    )
+    parser.add_argument(
+        "--port-file",
+        default="",
+        metavar="PATH",
+        help="Write the port number to this file once the server listens",
+    )
+    parser.add_argument("--stars", type=int, default=0, metavar="N")
+    parser.add_argument("--forks", type=int, default=0, metavar="N")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--org-repos",
+        type=int,
+        default=3,
+        metavar="N",
+        help="Number of repositories listed for any organization/user. Every "
+        "4th one is a fork, every 5th one is archived, every 7th one is "
+        "read-only for the token. Default: 3",
+    )
+    parser.add_argument(
+        "--fixture",
+        default="",
+        metavar="PATH",
+        help="Serve stargazers/forks from this JSON file (ignore --stars, "
+        "--forks)",
+    )
+    parser.add_argument(
+        "--dump-fixture",
+        default="",
+        metavar="PATH",
+        help="Write stargazers/forks to this JSON file and exit",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=int,
+        default=5000,
+        metavar="N",
+        help="Request quota per window and resource. Default: 5000",
+    )
+    parser.add_argument(
+        "--rate-limit-window",
+        type=float,
+        default=3600,
+        metavar="SECONDS",
+        help="Length of the rate limit window. Default: 3600",
+    )
+    parser.add_argument(
+        "--abuse-every",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Respond to every N-th request with a secondary rate limit error "
+        "(403). Default: 0 (never)",
+    )
+    parser.add_argument(
+        "--retry-after",
+        type=int,
+        default=1,
+        metavar="SECONDS",
+        help="Retry-After header value for secondary rate limit errors. "
+        "0: do not send the header. Default: 1",
+    )
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=0,
+        metavar="MS",
+        help="Delay each response by MS milliseconds (+/- 50 %% jitter)",
+    )
+    ARGS = parser.parse_args()
+
+    if ARGS.fixture:
+        log.info("read fixture %s", ARGS.fixture)
+        with open(ARGS.fixture, "rb") as f:
+            fixture = json.loads(f.read().decode("utf-8"))
+        STARGAZERS, FORKS = fixture["stargazers"], fixture["forks"]
+    else:
+        STARGAZERS = gen_stargazers(ARGS.stars, ARGS.seed)
+        FORKS = gen_forks(ARGS.forks, ARGS.seed)
+    log.info("stargazers: %s, forks: %s", len(STARGAZERS), len(FORKS))
+
+    if ARGS.dump_fixture:
+        with open(ARGS.dump_fixture, "wb") as f:
+            f.write(json.dumps({"stargazers": STARGAZERS, "forks": FORKS}).encode())
+        log.info("wrote %s", ARGS.dump_fixture)
+        sys.exit(0)
+
+    STARGAZER_USERS = [g["user"] for g in STARGAZERS]
+    FORKS_NEWEST_FIRST = list(reversed(FORKS))
+    GRAPHQL_ITEMS = {
+        "stargazers": [{"starredAt": g["starred_at"]} for g in STARGAZERS],
+        "forks": [
+            {"databaseId": f["id"], "createdAt": f["created_at"]} for f in FORKS
+        ],
+    }
+
+    RATE_LIMIT_RESET = int(time.time() + ARGS.rate_limit_window)
+
+    server = ThreadingHTTPServer((ARGS.host, ARGS.port), Handler)
+    port = server.server_address[1]
+    log.info("listening on %s:%s", ARGS.host, port)
+
+    if ARGS.port_file:
+        with open(ARGS.port_file + ".tmp", "w") as f:
+            f.write(str(port))
+        # Make the file appear atomically for whoever waits for it.
+        os.rename(ARGS.port_file + ".tmp", ARGS.port_file)
+
+    server.serve_forever()
+
+
+def _timestamps(n: int, seed: int, start: datetime) -> list:
+    # Monotonically increasing, with a few duplicates (same second).
+    rnd = random.Random(seed)
+    t = start
+    result = []
+    for _ in range(n):
+        t += timedelta(seconds=rnd.choice([0, 1, 60, 3600, 20000, 86400]))
+        result.append(t.strftime("%Y-%m-%dT%H:%M:%SZ"))
+    return result
+
+
+def gen_stargazers(n: int, seed: int) -> list:
+    # The user objects returned by GitHub are bigger (about 1 kB): they
+    # contain about 15 URLs. Keep the size realistic for benchmarks.
+    return [
+        {"starred_at": ts, "user": gen_user(f"user{i}", 1000 + i)}
+        for i, ts in enumerate(_timestamps(n, seed, datetime(2015, 1, 1)))
+    ]
+
+
+def gen_user(login: str, uid: int) -> dict:
+    api = f"https://api.github.com/users/{login}"
+    return {
+        "login": login,
+        "id": uid,
+        "node_id": f"MDQ6VXNlcj{uid:08d}",
+        "avatar_url": f"https://avatars.githubusercontent.com/u/{uid}?v=4",
+        "gravatar_id": "",
+        "url": api,
+        "html_url": f"https://github.com/{login}",
+        "followers_url": f"{api}/followers",
+        "following_url": f"{api}/following{{/other_user}}",
+        "gists_url": f"{api}/gists{{/gist_id}}",
+        "starred_url": f"{api}/starred{{/owner}}{{/repo}}",
+        "subscriptions_url": f"{api}/subscriptions",
+        "organizations_url": f"{api}/orgs",
+        "repos_url": f"{api}/repos",
+        "events_url": f"{api}/events{{/privacy}}",
+        "received_events_url": f"{api}/received_events",
+        "type": "User",
+        "site_admin": False,
+    }
+
+
+def gen_forks(n: int, seed: int) -> list:
+    # Real fork objects are about 6 kB (full repository objects, including
+    # the owner object and ~40 URLs). Add the owner object as a bulk of it.
+    return [
+        {
+            "id": 5000 + i,
+            "name": "fork",
+            "full_name": f"user{i}/fork",
+            "owner": gen_user(f"user{i}", 1000 + i),
+            "created_at": ts,
+        }
+        for i, ts in enumerate(_timestamps(n, seed + 1, datetime(2015, 2, 1)))
+    ]
+
+
+def is_read_only(name: str) -> bool:
+    # See --org-repos: every 7th repository (repo6, repo13, ...) is read-only
+    # for the token (no push access: the traffic API responds with 403).
+    m = re.fullmatch(r"repo(\d+)", name)
+    return bool(m) and int(m.group(1)) % 7 == 6
+
+
+def gen_traffic_series(metric: str) -> dict:
+    # 15 daily samples, the newest one for today (UTC).
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    samples = [
+        {
+            "timestamp": (today - timedelta(days=d)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "count": 10 + d,
+            "uniques": 5 + d,
+        }
+        for d in reversed(range(15))
+    ]
+    return {
+        "count": sum(s["count"] for s in samples),
+        "uniques": sum(s["uniques"] for s in samples),
+        metric: samples,
+    }
+
+
+def graphql_response(query: str, variables: dict) -> dict:
+    """
+    Answer the queries issued by fetch.py: one page of the `stargazers` or
+    `forks` connection of a repository (optionally aliased, with `first`,
+    `after` and `orderBy`). This is pattern matching, not a GraphQL
+    implementation. The cursor is the offset into the list.
+    """
+    m = re.search(r"(?:(\w+)\s*:\s*)?(stargazers|forks)\s*\(", query)
+    if not m:
+        return {"errors": [{"message": "mock: unsupported query"}]}
+    conn_alias, conn = m.group(1) or m.group(2), m.group(2)
+
+    def arg(name):
+        # Literal or $variable.
+        am = re.search(name + r"\s*:\s*(\$?\w+)", query[m.end() :])
+        if not am:
+            return None
+        v = am.group(1)
+        return variables.get(v[1:]) if v.startswith("$") else v
+
+    items = GRAPHQL_ITEMS[conn]
+    if arg("direction") == "DESC":
+        items = list(reversed(items))
+
+    first = min(int(arg("first") or 100), 100)
+    offset = int(arg("after") or 0)
+    page_items = items[offset : offset + first]
+    has_next = offset + first < len(items)
+
+    im = re.search(r"(?:(\w+)\s*:\s*)?(edges|nodes)\b", query[m.end() :])
+    items_alias = (im.group(1) or im.group(2)) if im else "nodes"
+
+    return {
+        "data": {
+            "repository": {
+                conn_alias: {
+                    "totalCount": len(items),
+                    "pageInfo": {
+                        "hasNextPage": has_next,
+                        "endCursor": str(offset + len(page_items)),
+                    },
+                    items_alias: page_items,
+                }
+            }
+        }
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        resource = "graphql" if url.path == "/graphql" else "core"
+        if self.reject_credentials() or self.inject_failure(resource):
+            return
+
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        if url.path == "/rate_limit":
+            reset = int(time.time()) + 3600
+            rate = {"limit": 5000, "remaining": 5000, "reset": reset, "used": 0}
+            return self.send_json(
+                {
+                    "resources": {"core": rate, "search": rate, "graphql": rate},
+                    "rate": rate,
+                }
+            )
+
+        m = re.fullmatch(r"/(orgs|users)/([^/]+)/repos", url.path)
+        if m:
+            return self.send_page(url.path, query, self.org_repos_json(m.group(2)))
+
+        m = re.fullmatch(r"/repos/([^/]+)/([^/]+)(/.*)?", url.path)
+        if not m:
+            return self.send_json({"message": "Not Found"}, status=404)
+
+        owner, name, sub = m.group(1), m.group(2), m.group(3) or ""
+
+        if sub == "":
+            return self.send_json(self.repo_json(owner, name))
+
+        if sub == "/stargazers":
+            if "star+json" in self.headers.get("Accept", ""):
+                items = STARGAZERS
+            else:
+                items = STARGAZER_USERS
+            return self.send_page(url.path, query, items, max_pages=400)
+
+        if sub == "/forks":
+            items = FORKS
+            if query.get("sort", "newest") == "newest":
+                items = FORKS_NEWEST_FIRST
+            return self.send_page(url.path, query, items)
+
+        if sub.startswith("/traffic/") and is_read_only(name):
+            return self.send_json(
+                {
+                    "message": "Must have push access to repository",
+                    "documentation_url": "https://docs.github.com/rest/metrics/traffic#get-page-views",
+                },
+                status=403,
+            )
+
+        if sub == "/traffic/views":
+            return self.send_json(gen_traffic_series("views"))
+
+        if sub == "/traffic/clones":
+            return self.send_json(gen_traffic_series("clones"))
+
+        if sub == "/traffic/popular/referrers":
+            return self.send_json(
+                [
+                    {"referrer": "github.com", "count": 50, "uniques": 20},
+                    {"referrer": "google.com", "count": 10, "uniques": 8},
+                ]
+            )
+
+        if sub == "/traffic/popular/paths":
+            return self.send_json(
+                [
+                    {
+                        "path": f"/{owner}/{name}",
+                        "title": name,
+                        "count": 40,
+                        "uniques": 15,
+                    }
+                ]
+            )
+
+        return self.send_json({"message": "Not Found"}, status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        req = json.loads(self.rfile.read(length).decode("utf-8"))
+
+        path = urlparse(self.path).path
+        m = re.fullmatch(r"/app/installations/(\d+)/access_tokens", path)
+        if m:
+            return self.send_installation_token(m.group(1))
+
+        if path != "/graphql":
+            return self.send_json({"message": "Not Found"}, status=404)
+        if self.reject_credentials() or self.inject_failure("graphql"):
+            return
+        return self.send_json(
+            graphql_response(req["query"], req.get("variables") or {}),
+            resource="graphql",
+        )
+
+    def send_installation_token(self, installation_id: str) -> None:
+        # JWT: header, payload, signature (base64url, without padding).
+        auth = self.headers.get("Authorization", "")
+        parts = auth[len("Bearer ") :].split(".")
+        claims: dict = {}
+        if auth.startswith("Bearer ") and len(parts) == 3:
+            try:
+                claims = json.loads(base64.urlsafe_b64decode(parts[1] + "=="))
+            except ValueError:
+                pass
+        if "iss" not in claims:
+            return self.send_json(
+                {"message": "A JSON web token could not be decoded"}, status=401
+            )
+
+        token = f"ghs_mock{installation_id}_{len(ISSUED_TOKENS)}"
+        ISSUED_TOKENS.add(token)
+        log.info("app %s: issue token for installation %s", claims["iss"], token)
+        expires_at = datetime.utcnow() + timedelta(hours=1)
+        return self.send_json(
+            {
+                "token": token,
+                "expires_at": expires_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "permissions": {"metadata": "read", "administration": "read"},
+                "repository_selection": "all",
+            },
+            status=201,
+        )
+
+    def reject_credentials(self) -> bool:
+        """
+        Reject installation tokens that were not issued. Return True if an
+        error response has been sent.
+        """
+        token = self.headers.get("Authorization", "").split(" ")[-1]
+        if token.startswith("ghs_") and token not in ISSUED_TOKENS:
+            self.send_json({"message": "Bad credentials"}, status=401)
+            return True
+        return False
+
+    def inject_failure(self, resource: str) -> bool:
+        """
+        Apply --latency-ms, --abuse-every, --rate-limit. Return True if an
+        error response has been sent.
+        """
+        global REQUEST_COUNT, RATE_LIMIT_RESET
+
+        if ARGS.latency_ms:
+            time.sleep(ARGS.latency_ms / 1000.0 * random.uniform(0.5, 1.5))
+
+        with RATE_LIMIT_LOCK:
+            REQUEST_COUNT += 1
+            n = REQUEST_COUNT
+            if time.time() >= RATE_LIMIT_RESET:
+                RATE_LIMIT_USED.clear()
+                RATE_LIMIT_RESET = int(time.time() + ARGS.rate_limit_window)
+            used = RATE_LIMIT_USED.get(self.quota_key(resource), 0)
+            exhausted = used >= ARGS.rate_limit
+
+        if ARGS.abuse_every and n % ARGS.abuse_every == 0:
+            log.info("inject secondary rate limit error (request %s)", n)
+            headers = {"Retry-After": str(ARGS.retry_after)} if ARGS.retry_after else {}
+            self.send_json(
+                {
+                    "message": "You have exceeded a secondary rate limit. Please "
+                    "wait a few minutes before you try again.",
+                    "documentation_url": "https://docs.github.com/rest/overview/resources-in-the-rest-api#secondary-rate-limits",
+                },
+                status=403,
+                headers=headers,
+                resource=resource,
+            )
+            return True
+
+        if exhausted:
+            log.info("request quota exhausted (request %s)", n)
+            self.send_json(
+                {
+                    "message": "API rate limit exceeded for user ID 1.",
+                    "documentation_url": "https://docs.github.com/rest/overview/resources-in-the-rest-api#rate-limiting",
+                },
+                status=403,
+                resource=resource,
+            )
+            return True
+
+        return False
+
+    def quota_key(self, resource: str) -> tuple:
+        return (self.headers.get("Authorization", ""), resource)
+
+    def base_url(self) -> str:
+        return f"http://{self.headers.get('Host')}"
+
+    def repo_json(self, owner: str, name: str) -> dict:
+        r = {
+            "id": 1,
+            "name": name,
+            "full_name": f"{owner}/{name}",
+            "owner": {"login": owner, "id": 1},
+            "url": f"{self.base_url()}/repos/{owner}/{name}",
+            "html_url": f"https://github.com/{owner}/{name}",
+            "stargazers_count": len(STARGAZERS),
+            "forks_count": len(FORKS),
+            "archived": False,
+            "fork": False,
+            "permissions": {"admin": True, "push": True, "pull": True},
+        }
+        if is_read_only(name):
+            r["permissions"] = {"admin": False, "push": False, "pull": True}
+        return r
+
+    def org_repos_json(self, owner: str) -> list:
+        repos = []
+        for i in range(ARGS.org_repos):
+            r = self.repo_json(owner, f"repo{i}")
+            r["fork"] = i % 4 == 3
+            r["archived"] = i % 5 == 4
+            repos.append(r)
+        return repos
+
+    def send_page(
+        self, path: str, query: dict, items: list, max_pages: int = 0
+    ) -> None:
+        # `max_pages`: like GitHub for some lists (e.g. stargazers), do not
+        # serve pages beyond that (the `last` link points to it).
+        per_page = min(int(query.get("per_page", 30)), 100)
+        page = int(query.get("page", 1))
+        n_pages = max(1, -(-len(items) // per_page))
+        if max_pages:
+            n_pages = min(n_pages, max_pages)
+            if page > max_pages:
+                return self.send_json(
+                    {
+                        "message": "In order to keep the API fast for everyone, "
+                        "pagination is limited for this resource. Check the rel=last "
+                        "link relation in the Link response header to see how far "
+                        "back you can traverse.",
+                        "documentation_url": "https://docs.github.com/v3/#pagination",
+                    },
+                    status=422,
+                )
+        page_items = items[(page - 1) * per_page : page * per_page]
+
+        def page_url(p):
+            return f"{self.base_url()}{path}?{urlencode({**query, 'page': p})}"
+
+        links = []
+        if page < n_pages:
+            links.append(f'<{page_url(page + 1)}>; rel="next"')
+            links.append(f'<{page_url(n_pages)}>; rel="last"')
+        if page > 1:
+            links.append(f'<{page_url(1)}>; rel="first"')
+            links.append(f'<{page_url(page - 1)}>; rel="prev"')
+
+        headers = {"Link": ", ".join(links)} if links else {}
+        self.send_json(page_items, headers=headers)
+
+    def send_json(
+        self, data, status: int = 200, headers=None, resource: str = "core"
+    ) -> None:
+        body = json.dumps(data).encode("utf-8")
+
+        # Conditional requests: like GitHub, send an ETag with every 200
+        # response, and respond with 304 (without body) if it matches.
+        if status == 200:
+            etag = f'"{hashlib.sha1(body).hexdigest()}"'
+            headers = {**(headers or {}), "ETag": etag}
+            if self.headers.get("If-None-Match") == etag:
+                status, body = 304, b""
+
+        with RATE_LIMIT_LOCK:
+            key = self.quota_key(resource)
+            if status < 300:
+                RATE_LIMIT_USED[key] = RATE_LIMIT_USED.get(key, 0) + 1
+            used = RATE_LIMIT_USED.get(key, 0)
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("X-RateLimit-Limit", str(ARGS.rate_limit))
+        self.send_header("X-RateLimit-Remaining", str(max(0, ARGS.rate_limit - used)))
+        self.send_header("X-RateLimit-Used", str(used))
+        self.send_header("X-RateLimit-Reset", str(RATE_LIMIT_RESET))
+        self.send_header("X-RateLimit-Resource", resource)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+if __name__ == "__main__":
+    main()